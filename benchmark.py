@@ -0,0 +1,367 @@
+"""
+ End-to-end throughput benchmark
+
+ Runs the API with fetch worker and proxy checker against local stand-ins:
+ HTTP target server (configurable latency, body size and error rate), forwarding proxy
+ and storage - MongoDB when --mongo-url is given, otherwise SQLite database in temporary directory.
+
+ Usage: python benchmark.py --tasks 2000 --batch 500 --latency 20 --output bench.json
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from urllib.parse import urlsplit
+
+import httpx
+
+from consts import *
+
+
+class TargetServer:
+    """
+    Local HTTP/1.1 server with keep-alive answering every request after fixed latency
+    """
+
+    def __init__(self, latency: float, body_size: int, error_rate: float):
+        """Init server
+        :param latency: response delay in seconds
+        :param body_size: size of response body in bytes
+        :param error_rate: fraction of requests answered with 503
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.body = os.urandom(body_size // 2 + 1).hex().encode()[:body_size]
+        self.requests = 0
+        self.port = None
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self.handle, "0.0.0.0", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                lines = head.decode("latin-1").split("\r\n")
+                target = lines[0].split(" ")[1]
+                length = 0
+                for line in lines[1:]:
+                    name, _, value = line.partition(":")
+                    if name.strip().lower() == "content-length":
+                        length = int(value)
+                if length:
+                    await reader.readexactly(length)
+                self.requests += 1
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+
+                if random.random() < self.error_rate:
+                    status, body = b"503 Service Unavailable", b"error"
+                else:
+                    status, body = b"200 OK", self.body + target.encode()  # every URL has its own body
+                writer.write(b"HTTP/1.1 %s\r\nContent-Type: text/plain\r\nContent-Length: %d\r\n\r\n"
+                             % (status, len(body)))
+                writer.write(body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+
+class ForwardingProxy:
+    """
+    Local HTTP proxy forwarding absolute-form requests and CONNECT tunnels
+    """
+
+    def __init__(self):
+        self.connections = 0
+        self.port = None
+        self._server = None
+        self._tunnels = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        for tunnel in list(self._tunnels):
+            tunnel.cancel()
+        await self._server.wait_closed()
+
+    async def handle(self, reader, writer):
+        upstream_writer = None
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+            method, target, _ = head.split(b"\r\n", 1)[0].split(b" ", 2)
+            self.connections += 1
+            if method == b"CONNECT":
+                host, _, port = target.decode().rpartition(":")
+                upstream_reader, upstream_writer = await asyncio.open_connection(host, int(port))
+                writer.write(b"HTTP/1.1 200 Connection established\r\n\r\n")
+            else:
+                url = urlsplit(target.decode())
+                upstream_reader, upstream_writer = await asyncio.open_connection(url.hostname, url.port or 80)
+                upstream_writer.write(head)  # target server accepts absolute-form requests
+            tunnel = asyncio.gather(self.pipe(reader, upstream_writer), self.pipe(upstream_reader, writer))
+            self._tunnels.add(tunnel)
+            try:
+                await tunnel
+            finally:
+                self._tunnels.discard(tunnel)
+        except (asyncio.IncompleteReadError, ConnectionError, OSError, ValueError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+            if upstream_writer:
+                upstream_writer.close()
+
+    @staticmethod
+    async def pipe(reader, writer):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            if writer.can_write_eof():
+                try:
+                    writer.write_eof()
+                except OSError:
+                    pass
+
+
+def percentile(values: list, q: float) -> float:
+    """Percentile with linear interpolation
+    :param values: sorted values
+    :param q: percentile (0-100)
+    :return: value
+    """
+    if not values:
+        return 0.0
+    k = (len(values) - 1) * q / 100
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def memory_usage() -> dict:
+    """Current and peak resident memory of the process
+    :return: dict with values in MB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kB on Linux
+    current = None
+    try:
+        with open("/proc/self/statm") as fd:
+            current = int(fd.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except OSError:
+        pass
+    return {"rss_mb": current, "peak_rss_mb": peak}
+
+
+async def submit(client: httpx.AsyncClient, urls: list, batch: int, task: dict) -> list:
+    """Enqueue tasks through the API
+    :param client: client bound to the app
+    :param urls: URLs to fetch
+    :param batch: URLs per /fetch_many request, 0 - one /fetch_one request per URL
+    :param task: task options
+    :return: list of task ids
+    """
+    if batch <= 0:
+        responses = await asyncio.gather(*[client.post("/fetch_one", json={"url": url, **task}) for url in urls])
+        return [r.json()["task_id"] for r in responses]
+    ids = []
+    for i in range(0, len(urls), batch):
+        r = await client.post("/fetch_many", json={"urls": urls[i:i + batch], **task})
+        r.raise_for_status()
+        ids.extend(item["task_id"] for item in r.json())
+    return ids
+
+
+async def run_phase(storage, client: httpx.AsyncClient, urls: list, batch: int, task: dict, timeout: float) -> dict:
+    """Enqueue tasks and wait until all of them are finished
+    :param storage: Storage object
+    :param client: client bound to the app
+    :param urls: URLs to fetch
+    :param batch: URLs per /fetch_many request
+    :param task: task options
+    :param timeout: max seconds to wait
+    :return: dict with phase results
+    """
+    from bson import ObjectId
+    from storage import FINISHED_STATUSES
+
+    ts1 = time.monotonic()
+    ids = [ObjectId(i) for i in await submit(client, urls, batch, task)]
+    enqueue_time = time.monotonic() - ts1
+    done = 0
+    while time.monotonic() - ts1 < timeout:
+        done = len(await storage.find_tasks(ids, ["status"], FINISHED_STATUSES))
+        if done >= len(ids):
+            break
+        await asyncio.sleep(0.05)
+    elapsed = time.monotonic() - ts1
+
+    latencies, statuses, cached = [], {}, 0
+    for doc in await storage.find_tasks(ids, ["insert_ts", "update_ts", "status", "cache"], FINISHED_STATUSES):
+        latencies.append((doc["update_ts"] - doc["insert_ts"]).total_seconds())
+        statuses[TaskStatus(doc["status"]).name] = statuses.get(TaskStatus(doc["status"]).name, 0) + 1
+        cached += bool(doc.get("cache"))
+    latencies.sort()
+    return {"tasks": len(ids), "finished": done, "statuses": statuses, "cache_hits": cached,
+            "enqueue_seconds": enqueue_time, "elapsed_seconds": elapsed,
+            "tasks_per_second": done / elapsed if elapsed else 0.0,
+            "latency": {"mean": statistics.mean(latencies) if latencies else 0.0,
+                        "p50": percentile(latencies, 50), "p95": percentile(latencies, 95),
+                        "p99": percentile(latencies, 99), "max": latencies[-1] if latencies else 0.0}}
+
+
+async def benchmark(args) -> dict:
+    """Run benchmark
+    :param args: parsed command line arguments
+    :return: dict with results
+    """
+    import storage as storage_module
+    from blob_store import BlobStore
+
+    cache_dir = tempfile.TemporaryDirectory(prefix="unicorn-bench-")
+    if args.mongo_url:
+        import motor.motor_asyncio
+        from mongo_storage import MongoStorage
+        db = motor.motor_asyncio.AsyncIOMotorClient(args.mongo_url)[args.db_name]
+        await db.client.drop_database(args.db_name)
+        storage = MongoStorage(db)
+    else:
+        from sqlite_storage import SqliteStorage
+        storage = SqliteStorage(os.path.join(cache_dir.name, "benchmark.db"))
+    storage_module.open_storage = lambda backend=None: storage
+    await storage.prepare()
+
+    import main
+    import proxy_manager as proxy_manager_module
+    logging.getLogger().setLevel(args.log_level)
+    from fetch_worker import FetchWorker
+    from proxy_manager import ProxyManager
+    from write_back import WriteBack
+
+    target, proxy = TargetServer(args.latency / 1000, args.body_size, args.error_rate), ForwardingProxy()
+    await target.start()
+    await proxy.start()
+
+    blobs = BlobStore(storage, root=os.path.join(cache_dir.name, "blobs"), write_back=WriteBack(storage))
+    main.blob_store = blobs
+    main.fetch_worker = FetchWorker(storage, args.workers, blobs)
+    main.proxy_manager = ProxyManager(storage)
+
+    # local proxy verified by the proxy checker before the worker loads the pool
+    proxy_manager_module.PROXY_CHECK_URL_HTTP = f"http://127.0.0.1:{target.port}/check"
+    await storage.sync_proxies([{"proxy_server": f"127.0.0.1:{proxy.port}", "https": False}], [])
+    ts1 = time.monotonic()
+    await main.proxy_manager.check()
+    proxy_check_time = time.monotonic() - ts1
+
+    worker = asyncio.create_task(main.fetch_worker.run())
+    task = {"no_proxy": not args.proxy, "retries": args.retries, "timeout": 30,
+            "rate_limit": 1e6, "burst": 1000}  # politeness is not measured
+    urls = [f"http://127.0.0.{i % args.hosts + 1}:{target.port}/item/{i}" for i in range(args.tasks)]
+    memory_before = memory_usage()
+    results = {"config": vars(args), "started": datetime.datetime.utcnow().isoformat(),
+               "proxy_check_seconds": proxy_check_time}
+    try:
+        async with httpx.AsyncClient(app=main.app, base_url="http://benchmark", timeout=None) as client:
+            results["fetch"] = await run_phase(storage, client, urls, args.batch, {**task, "use_cache": False},
+                                               args.timeout)
+            results["cache"] = await run_phase(storage, client, urls, args.batch, {**task, "use_cache": True},
+                                               args.timeout)
+            r = await client.get("/worker_stats")
+            results["worker_stats"] = r.json()
+    finally:
+        worker.cancel()
+        await main.fetch_worker.close()
+        await target.stop()
+        await proxy.stop()
+        await storage.close()
+        cache_dir.cleanup()
+
+    fetch_mean, cache_mean = results["fetch"]["latency"]["mean"], results["cache"]["latency"]["mean"]
+    results["cache_speedup"] = fetch_mean / cache_mean if cache_mean else None
+    results["target_requests"] = target.requests
+    results["proxy_connections"] = proxy.connections
+    results["memory"] = {"before": memory_before, "after": memory_usage()}
+    return results
+
+
+def compare(results: dict, baseline: dict):
+    """Print change of key numbers against baseline run
+    :param results: current results
+    :param baseline: results of previous run
+    :return:
+    """
+    keys = [("fetch", "tasks_per_second"), ("fetch", "latency", "p50"), ("fetch", "latency", "p95"),
+            ("fetch", "latency", "p99"), ("cache", "tasks_per_second"), ("cache_speedup",),
+            ("memory", "after", "peak_rss_mb")]
+    for key in keys:
+        current, previous = results, baseline
+        for part in key:
+            current, previous = (current or {}).get(part), (previous or {}).get(part)
+        if current is None or not previous:
+            continue
+        print(f"{'.'.join(key):32} {previous:12.4f} -> {current:12.4f} ({(current / previous - 1) * 100:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end throughput benchmark")
+    parser.add_argument("--tasks", type=int, default=1000, help="number of tasks in each phase")
+    parser.add_argument("--batch", type=int, default=500, help="URLs per /fetch_many request, 0 - use /fetch_one")
+    parser.add_argument("--workers", type=int, default=MAX_FETCH_WORKERS, help="max in-flight tasks")
+    parser.add_argument("--hosts", type=int, default=20, help="number of target hosts (127.0.0.x addresses)")
+    parser.add_argument("--latency", type=float, default=20, help="target server latency in milliseconds")
+    parser.add_argument("--body-size", type=int, default=16384, help="response body size in bytes")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of 503 responses")
+    parser.add_argument("--retries", type=int, default=0, help="task retries")
+    parser.add_argument("--proxy", action="store_true", help="fetch through local forwarding proxy")
+    parser.add_argument("--mongo-url", help="MongoDB connection string, SQLite storage is used if not set")
+    parser.add_argument("--db-name", default="unicorn_benchmark", help="database name (dropped before run)")
+    parser.add_argument("--timeout", type=float, default=600, help="max seconds of single phase")
+    parser.add_argument("--log-level", default="WARNING", help="logging level of the app")
+    parser.add_argument("--output", default="benchmark.json", help="file with results")
+    parser.add_argument("--baseline", help="results of previous run to compare with")
+    args = parser.parse_args()
+
+    results = asyncio.run(benchmark(args))
+    with open(args.output, "wt") as fd:
+        json.dump(results, fd, indent=2, default=str)
+
+    for phase in ("fetch", "cache"):
+        r = results[phase]
+        print(f"{phase:6} {r['finished']}/{r['tasks']} tasks in {r['elapsed_seconds']:.2f}s, "
+              f"{r['tasks_per_second']:.1f} tasks/s, latency p50 {r['latency']['p50']:.3f}s "
+              f"p95 {r['latency']['p95']:.3f}s p99 {r['latency']['p99']:.3f}s")
+    print(f"cache speedup {results['cache_speedup'] or 0:.1f}x, "
+          f"peak memory {results['memory']['after']['peak_rss_mb']:.0f} MB, results in {args.output}")
+    if args.baseline:
+        with open(args.baseline) as fd:
+            compare(results, json.load(fd))
+    return 0 if results["fetch"]["finished"] == results["fetch"]["tasks"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,107 @@
+import os
+import typing
+
+import anyio
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+
+def parse_range(value: str, size: int):
+    """Parse Range header with single byte range
+    :param value: Range header value, e.g. "bytes=0-499", "bytes=500-", "bytes=-500"
+    :param size: size of the file
+    :return: tuple (start, end) with inclusive end, None if range should be ignored (full body is sent),
+             raises ValueError if range is not satisfiable
+    """
+    unit, _, ranges = value.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        return None  # other units and multiple ranges are not supported
+    first, sep, last = ranges.strip().partition("-")
+    if not sep or not (first.isdigit() or last.isdigit()):
+        return None
+    if not first:
+        length = int(last)
+        if length == 0 or size == 0:
+            raise ValueError("Range not satisfiable")
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last.isdigit() else size - 1
+    if start >= size or start > end:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+
+def accepts_encoding(accept_encoding: str, encoding: str) -> bool:
+    """Check if client accepts content encoding
+    :param accept_encoding: Accept-Encoding header value
+    :param encoding: content encoding
+    :return: True if encoding is acceptable
+    """
+    aliases = {encoding, "x-gzip" if encoding == "gzip" else encoding}
+    wildcard = False
+    for item in accept_encoding.lower().split(","):
+        token, _, params = item.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        token = token.strip()
+        if token in aliases:
+            return q > 0
+        if token == "*":
+            wildcard = q > 0
+    return wildcard
+
+
+class BlobResponse(Response):
+    """
+    Response sending file or byte range of the file - with zero-copy transfer (sendfile) when
+    ASGI server supports "http.response.zerocopysend" extension
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, path: str, start: int = 0, end: int = None, status_code: int = 200,
+                 headers: typing.Mapping[str, str] = None, media_type: str = None):
+        """Init response
+        :param path: path to file
+        :param start: first byte sent
+        :param end: last byte sent (inclusive), None - end of file
+        :param status_code: HTTP status code (206 for ranges)
+        :param headers: additional headers
+        :param media_type: content type
+        """
+        self.path = path
+        self.start = start
+        self.end = os.path.getsize(path) - 1 if end is None else end
+        self.status_code = status_code
+        self.media_type = media_type or "application/octet-stream"
+        self.background = None
+        self.init_headers(headers)
+        self.headers["content-length"] = str(self.end - self.start + 1)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        count = self.end - self.start + 1
+        if scope.get("method") == "HEAD" or count <= 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        if "http.response.zerocopysend" in scope.get("extensions", {}):
+            with open(self.path, "rb") as file:
+                await send({"type": "http.response.zerocopysend", "file": file,
+                            "offset": self.start, "count": count, "more_body": False})
+            return
+
+        async with await anyio.open_file(self.path, mode="rb") as file:
+            await file.seek(self.start)
+            while count > 0:
+                chunk = await file.read(min(self.chunk_size, count))
+                if not chunk:
+                    break
+                count -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": count > 0})
+        if count > 0:  # file was truncated while sending
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
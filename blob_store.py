@@ -0,0 +1,301 @@
+import datetime
+import hashlib
+import logging
+import os
+import time
+import uuid
+import zlib
+
+import anyio
+
+from consts import *
+
+try:
+    import zstandard
+except ImportError:  # zstd compression is optional
+    zstandard = None
+
+
+def make_compressor(compression: str):
+    """Create streaming compressor
+    :param compression: "gzip" or "zstd"
+    :return: object with compress() and flush() methods
+    """
+    if compression == "gzip":
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    if compression == "zstd":
+        return zstandard.ZstdCompressor().compressobj()
+    raise ValueError(f"Unsupported compression: {compression}")
+
+
+def make_decompressor(encoding: str):
+    """Create streaming decompressor
+    :param encoding: "gzip", "x-gzip", "deflate" or "zstd"
+    :return: object with decompress() method, None if encoding is not supported
+    """
+    if encoding in ("gzip", "x-gzip"):
+        return zlib.decompressobj(31)
+    if encoding == "deflate":
+        return zlib.decompressobj()
+    if encoding == "zstd" and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+    return None
+
+
+def read_decoded(filename: str, encoding: str, chunk_size: int = 64 * 1024):
+    """Read stored blob decoding it on the fly
+    :param filename: path to blob
+    :param encoding: encoding of stored bytes
+    :param chunk_size: size of chunks read from file
+    :return: iterator of decoded chunks
+    """
+    decompressor = make_decompressor(encoding)
+    with open(filename, "rb") as fd:
+        while True:
+            chunk = fd.read(chunk_size)
+            if not chunk:
+                break
+            yield decompressor.decompress(chunk)
+
+
+class BlobWriter:
+    """
+    Streaming writer of single blob - data goes to temporary file and is renamed to its digest on commit.
+    Compression, hashing and file operations run in worker threads, data is passed to them in CACHE_WRITE_BATCH
+    batches, so downloading bodies does not block the event loop
+    """
+
+    def __init__(self, store, encoding: str = "identity", compression: str = None):
+        """Init writer
+        :param store: blob store
+        :param encoding: encoding of stored bytes (compression or encoding of data as received)
+        :param compression: compress data written with "gzip" or "zstd"
+        """
+        self._store = store
+        self.encoding = compression or encoding
+        self._compressor = make_compressor(compression) if compression else None
+        self._hash = hashlib.sha256()
+        self._tmp_filename = os.path.join(store.root, "tmp", uuid.uuid4().hex)
+        self._fd = None
+        self._pending = []  # chunks not passed to worker thread yet
+        self._pending_size = 0
+        self.size = 0
+
+    async def write(self, data: bytes):
+        """Add chunk of data
+        :param data: bytes
+        :return:
+        """
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size >= CACHE_WRITE_BATCH:
+            await self._flush_pending()
+
+    async def commit(self):
+        """Finish blob - file is kept only if the same content is not stored yet
+        :return: tuple (digest, size)
+        """
+        await self._flush_pending()
+        digest = await anyio.to_thread.run_sync(self._finish)
+        await self._store.register(digest, self.size, self.encoding)
+        await anyio.to_thread.run_sync(self._place, digest)
+        return digest, self.size
+
+    def abort(self):
+        """Drop written data
+        :return:
+        """
+        if self._fd is not None:
+            self._fd.close()
+        try:
+            os.remove(self._tmp_filename)
+        except FileNotFoundError:
+            pass
+
+    async def _flush_pending(self):
+        if self._pending:
+            data = b"".join(self._pending)
+            self._pending.clear()
+            self._pending_size = 0
+            await anyio.to_thread.run_sync(self._compress_write, data)
+
+    # methods below run in worker thread
+
+    def _compress_write(self, data: bytes):
+        if self._compressor:
+            data = self._compressor.compress(data)
+        self._write(data)
+
+    def _write(self, data: bytes):
+        if self._fd is None:
+            self._fd = open(self._tmp_filename, "wb")
+        if data:
+            self._hash.update(data)
+            self._fd.write(data)
+            self.size += len(data)
+
+    def _finish(self) -> str:
+        if self._compressor:
+            self._write(self._compressor.flush())
+        else:
+            self._write(b"")  # empty body
+        self._fd.close()
+        return self._hash.hexdigest()
+
+    def _place(self, digest: str):
+        filename = self._store.path(digest)
+        if self._store.mark_used(filename):
+            os.remove(self._tmp_filename)
+        else:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            os.replace(self._tmp_filename, filename)
+
+
+class BlobStore:
+    """
+    Content-addressed store of downloaded bodies - every body is kept once under its sha256 digest,
+    tasks refer to it with the "blob" field
+    """
+
+    def __init__(self, storage, root: str = BLOBS_DIR, max_size: int = CACHE_MAX_SIZE, ttl: int = CACHE_TTL,
+                 compression: str = CACHE_COMPRESSION, write_back=None):
+        """Init blob store
+        :param storage: Storage object
+        :param root: directory with blobs
+        :param max_size: disk budget in bytes, least recently used blobs above it are evicted
+        :param ttl: seconds since last use after which blob is evicted (0 - no limit)
+        :param compression: compression of stored bodies - "gzip", "zstd" or empty for none
+        :param write_back: WriteBack buffer for blob records, None - records are written immediately
+        """
+        self._storage = storage
+        self._write_back = write_back
+        self.root = root
+        self._max_size = max_size
+        self._ttl = ttl
+        if compression == "zstd" and zstandard is None:
+            logging.warning("zstandard package not installed, cache bodies are compressed with gzip")
+            compression = "gzip"
+        self.compression = compression or None
+        os.makedirs(os.path.join(self.root, "tmp"), exist_ok=True)
+
+    def path(self, digest: str) -> str:
+        """Location of blob file
+        :param digest: sha256 hex digest of the body
+        :return: path to file
+        """
+        return os.path.join(self.root, digest[:2], digest)
+
+    async def check_shared(self):
+        """Verify that the directory is the cache used by other nodes of the storage - blob records are shared
+        through storage, blob files must be shared as well (raises RuntimeError otherwise)
+        :return:
+        """
+        marker = os.path.join(self.root, CACHE_ID_FILE)
+        tmp_filename = os.path.join(self.root, "tmp", uuid.uuid4().hex)
+        with open(tmp_filename, "wt") as fd:
+            fd.write(uuid.uuid4().hex)
+        try:
+            os.link(tmp_filename, marker)  # new cache gets its id atomically, existing one keeps it
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_filename)
+        with open(marker, "rt") as fd:
+            cache_id = fd.read().strip()
+
+        stored_id = await self._storage.init_setting("cache_id", cache_id)
+        if stored_id != cache_id:
+            raise RuntimeError(f"Cache {self.root} is not the cache of other nodes using this storage - "
+                               f"set CACHE_DIR to directory shared by all nodes (or write {stored_id} "
+                               f"to {marker} if the cache was deleted on purpose)")
+
+    def writer(self, encoding: str = "identity", compression: str = None) -> BlobWriter:
+        """Start writing new blob
+        :param encoding: encoding of data written
+        :param compression: compress data with "gzip" or "zstd"
+        :return: BlobWriter object
+        """
+        return BlobWriter(self, encoding, compression)
+
+    async def register(self, digest: str, size: int, encoding: str):
+        """Record blob in storage (or mark existing one as used)
+        :param digest: sha256 hex digest of stored bytes
+        :param size: size of stored bytes
+        :param encoding: encoding of stored bytes
+        :return:
+        """
+        now = datetime.datetime.utcnow()
+        await self._save(digest, {"size": size, "encoding": encoding, "insert_ts": now, "last_access_ts": now})
+
+    async def touch(self, digest: str):
+        """Mark blob as recently used
+        :param digest: sha256 hex digest of the body
+        :return:
+        """
+        self.mark_used(self.path(digest))
+        await self._save(digest, {"last_access_ts": datetime.datetime.utcnow()})
+
+    @staticmethod
+    def mark_used(filename: str) -> bool:
+        """Update modification time of blob file - compaction running now keeps the file, even if it selected
+        the blob before its record was updated
+        :param filename: path to blob
+        :return: False if file does not exist
+        """
+        try:
+            os.utime(filename)
+            return True
+        except FileNotFoundError:
+            return False
+
+    async def _save(self, digest: str, fields: dict):
+        if self._write_back is not None:
+            self._write_back.add("save_blobs", digest, fields)  # written with next bulk write
+        else:
+            await self._storage.save_blobs([(digest, fields)])
+
+    async def compact(self):
+        """Evict blobs not used longer than TTL and least recently used blobs above disk budget
+        :return: number of evicted blobs
+        """
+        now = datetime.datetime.utcnow()
+        scan_ts = time.time() - 1  # margin for coarse file timestamps
+        expire_ts = now - datetime.timedelta(seconds=self._ttl) if self._ttl > 0 else None
+        evicted, removed, total = [], 0, 0
+        async for blob in self._storage.iter_blobs():
+            total += blob.get("size", 0)
+            if total > self._max_size or (expire_ts and blob.get("last_access_ts") < expire_ts):
+                evicted.append(blob["_id"])
+
+        for i in range(0, len(evicted), 1000):
+            # blobs stored or used again since the scan started are kept
+            batch = [digest for digest in evicted[i:i + 1000] if not self._used_since(digest, scan_ts)]
+            await self._storage.delete_blobs(batch)
+            for digest in batch:
+                if self._used_since(digest, scan_ts):
+                    continue  # record is written again by register/touch
+                removed += 1
+                try:
+                    os.remove(self.path(digest))
+                except FileNotFoundError:
+                    pass
+
+        # temporary files left by interrupted writes
+        tmp_dir = os.path.join(self.root, "tmp")
+        for name in os.listdir(tmp_dir):
+            filename = os.path.join(tmp_dir, name)
+            try:
+                if os.path.getmtime(filename) < time.time() - 3600:
+                    os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+        if removed:
+            logging.info(f"Cache compaction - evicted {removed} blobs")
+        return removed
+
+    def _used_since(self, digest: str, ts: float) -> bool:
+        try:
+            return os.path.getmtime(self.path(digest)) >= ts
+        except FileNotFoundError:
+            return False
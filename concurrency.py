@@ -0,0 +1,205 @@
+import asyncio
+import collections
+import contextlib
+import time
+
+from consts import *
+
+
+class AdaptiveLimit:
+    """
+    Concurrency limit adjusted AIMD-style (additive increase, multiplicative decrease) with FIFO queue of waiters
+    """
+
+    def __init__(self, initial: float, min_limit: float, max_limit: float):
+        """Init limit
+        :param initial: starting limit
+        :param min_limit: lower bound of the limit
+        :param max_limit: upper bound of the limit
+        """
+        self.min_limit = max(1.0, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = min(max(float(initial), self.min_limit), self.max_limit)
+        self.in_flight = 0
+        self._waiters = collections.deque()
+        self._decrease_ts = 0.0
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self):
+        """Wait for free slot
+        :return:
+        """
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()  # slot was granted just before cancellation
+            else:
+                self._waiters.remove(fut)
+            raise
+
+    def acquire_nowait(self):
+        """Take slot regardless of the limit (keeps accounting balanced when waiting was interrupted)
+        :return:
+        """
+        self.in_flight += 1
+
+    def release(self):
+        """Return slot and wake up waiters
+        :return:
+        """
+        self.in_flight -= 1
+        self._wake()
+
+    def increase(self):
+        """Additive increase - the limit grows by one after a full window of successes
+        :return:
+        """
+        self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+        self._wake()
+
+    def decrease(self):
+        """Multiplicative decrease, applied at most once per CONCURRENCY_DECREASE_INTERVAL
+        so one congestion event is not counted many times
+        :return:
+        """
+        now = time.monotonic()
+        if now - self._decrease_ts < CONCURRENCY_DECREASE_INTERVAL:
+            return
+        self._decrease_ts = now
+        self.limit = max(self.min_limit, self.limit * CONCURRENCY_BACKOFF)
+
+    def stats(self) -> dict:
+        return {"limit": int(self.limit), "in_flight": self.in_flight, "waiting": self.waiting}
+
+    def _wake(self):
+        while self._waiters and self.in_flight < int(self.limit):
+            fut = self._waiters.popleft()
+            if not fut.done():
+                self.in_flight += 1
+                fut.set_result(None)
+
+
+class HostLimit(AdaptiveLimit):
+    """
+    Concurrency limit of single host driven by observed latency and errors
+    """
+
+    def __init__(self, initial: float, min_limit: float, max_limit: float):
+        super().__init__(initial, min_limit, max_limit)
+        self.base_latency = None  # lowest latency seen recently
+        self.latency = None  # moving average of latency
+
+    def record(self, latency: float, congested: bool):
+        """Adjust limit with outcome of single request
+        :param latency: request time in seconds
+        :param congested: True for timeouts, connection errors and throttling responses
+        :return:
+        """
+        if congested:
+            self.decrease()
+            return
+        if self.base_latency is None:
+            self.base_latency = self.latency = latency
+        else:
+            self.base_latency = min(self.base_latency * 1.01, latency)  # baseline slowly forgets old minimum
+            self.latency = 0.8 * self.latency + 0.2 * latency
+        if self.latency > self.base_latency * CONCURRENCY_LATENCY_FACTOR:
+            self.decrease()
+        else:
+            self.increase()
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats["latency"] = self.latency
+        return stats
+
+
+class ConcurrencyController:
+    """
+    Process-wide and per-host limits of in-flight downloads
+    """
+
+    def __init__(self, max_workers: int, max_per_host: int = FETCH_POOL_PER_HOST):
+        """Init controller
+        :param max_workers: upper bound of in-flight tasks in the process
+        :param max_per_host: upper bound of in-flight requests to single host
+        """
+        self._global = AdaptiveLimit(CONCURRENCY_INITIAL, min(CONCURRENCY_MIN, max_workers), max_workers)
+        self._max_per_host = max_per_host
+        self._hosts = {}
+        self._error_rate = 0.0  # moving average of failed requests fraction
+
+    async def acquire(self):
+        """Take process-wide slot for a task
+        :return:
+        """
+        await self._global.acquire()
+
+    def acquire_nowait(self):
+        """Take process-wide slot without waiting, even above the limit
+        :return:
+        """
+        self._global.acquire_nowait()
+
+    def release(self):
+        """Return process-wide slot
+        :return:
+        """
+        self._global.release()
+
+    @contextlib.asynccontextmanager
+    async def host_slot(self, host: str):
+        """Hold slot of the host while request is sent
+        :param host: target host name
+        :return:
+        """
+        limit = self._hosts.get(host)
+        if limit is None:
+            limit = HostLimit(CONCURRENCY_HOST_INITIAL, 1, self._max_per_host)
+            self._hosts[host] = limit
+        await limit.acquire()
+        try:
+            yield limit
+        finally:
+            limit.release()
+            if limit.in_flight == 0 and not limit.waiting and len(self._hosts) > CONCURRENCY_MAX_HOSTS:
+                self._hosts.pop(host, None)
+
+    def record(self, host: str, latency: float, status: HttpCheckStatus, http_code: int = None):
+        """Feed outcome of single request
+        :param host: target host name
+        :param latency: request time in seconds
+        :param status: fetching status
+        :param http_code: HTTP response code (for HTTP errors)
+        :return:
+        """
+        congested = status in (HttpCheckStatus.TIMEOUT_ERROR, HttpCheckStatus.CONN_ERROR) or \
+            http_code in (429, 503)
+        failed = congested or status not in (HttpCheckStatus.OK, HttpCheckStatus.HTTP_ERROR,
+                                             HttpCheckStatus.BODY_TOO_LARGE)
+
+        limit = self._hosts.get(host)
+        if limit is not None:
+            limit.record(latency, congested)
+
+        self._error_rate = 0.95 * self._error_rate + 0.05 * failed
+        if failed and self._error_rate > CONCURRENCY_ERROR_RATE:
+            self._global.decrease()
+        elif not failed:
+            self._global.increase()
+
+    def stats(self) -> dict:
+        """Current limits and queue depth
+        :return: dict with process-wide and per-host stats
+        """
+        return {**self._global.stats(), "error_rate": self._error_rate,
+                "hosts": {host: limit.stats() for host, limit in self._hosts.items()}}
@@ -12,20 +12,146 @@ UA_FILE = os.path.join(os.path.dirname(__file__), "assets/user-agents.csv")
 PROXY_PREMIUM_FILE = os.path.join(os.path.dirname(__file__), "assets/proxy-premium.txt")
 
 
-# CACHE DIR
-CACHE_DIR = os.path.join(os.path.dirname(__file__), "cache")
-
 CONF = dotenv_values( os.path.join(os.path.dirname(__file__), "unicorn.conf") )
+
+# CACHE DIR - blob records are shared through storage, so all nodes of the storage must use the same (shared) directory
+CACHE_DIR = os.path.join(os.path.dirname(__file__), CONF.get("CACHE_DIR", "cache"))
+CACHE_ID_FILE = "cache_id"  # marker with id of the cache, compared with id kept in storage at startup
+
+# CONTENT-ADDRESSED STORE OF CACHED BODIES
+BLOBS_DIR = os.path.join(CACHE_DIR, "blobs")
+
+STORAGE = CONF.get("STORAGE", "mongo")  # storage backend - "mongo" or "sqlite" (embedded, single node)
+SQLITE_PATH = os.path.join(os.path.dirname(__file__), CONF.get("SQLITE_PATH", "unicorn.db"))  # sqlite database file
+TASK_RETENTION = int(CONF.get("TASK_RETENTION", 0))  # seconds finished tasks are kept (0 - no limit)
+TASK_PURGE_INTERVAL = 600  # seconds between deletions of tasks older than retention
 MONGO_CONN_STR = CONF.get("MONGO_CONN_STR", "mongodb://localhost:27017/")  # mongodb conn string
 DB_NAME = CONF.get("DB_NAME", "unicorn_scraper" )  # database name
 COLLECTION_PROXIES = CONF.get("COLLECTION_PROXIES", "proxies")  # collection with proxies
 COLLECTION_TASKS = CONF.get("COLLECTION_TASKS", "tasks")  # collection with tasks
+COLLECTION_BLOBS = CONF.get("COLLECTION_BLOBS", "blobs")  # collection with cached bodies
+COLLECTION_SETTINGS = CONF.get("COLLECTION_SETTINGS", "settings")  # collection with deployment-wide settings
 
 # CONSTANTS RELATED WITH PROXIES CHECKING PROCESS
-MAX_PROXY_WORKERS = int(CONF.get("MAX_PROXY_WORKERS",20))
+MAX_PROXY_WORKERS = int(CONF.get("MAX_PROXY_WORKERS",1000))  # concurrent probes
+PROXY_EXTRA_FILES = [os.path.join(os.path.dirname(__file__), name.strip())
+                     for name in CONF.get("PROXY_EXTRA_FILES", "").split(",")
+                     if name.strip()]  # additional proxy lists in format of PROXY_FILE
 PROXY_CHECK_TIMEOUT = int(CONF.get("PROXY_CHECK_TIMEOUT", 60))
 PROXY_CONNECT_TIMEOUT = int(CONF.get("PROXY_CONNECT_TIMEOUT", 15))
+PROXY_CHECK_URL_HTTP = CONF.get("PROXY_CHECK_URL_HTTP", "http://lumtest.com/myip.json")  # probe endpoint
+PROXY_CHECK_URL_HTTPS = CONF.get("PROXY_CHECK_URL_HTTPS", "https://lumtest.com/myip.json")
+PROXY_CHECK_INTERVAL = int(CONF.get("PROXY_CHECK_INTERVAL", 900))  # seconds between checks of alive proxy
+PROXY_CHECK_MAX_INTERVAL = int(CONF.get("PROXY_CHECK_MAX_INTERVAL", 6 * 3600))  # max backoff of failing proxy
+PROXY_CHECK_BATCH = int(CONF.get("PROXY_CHECK_BATCH", 5000))  # proxies taken for one pass
+PROXY_CHECK_WRITE_BATCH = 500  # results stored with one bulk write
+PROXY_CHECK_IDLE_TIME = 10  # seconds to wait when no proxy is due
+
+# CONSTANTS RELATED WITH PROXY SELECTION
+PROXY_FAIL_THRESHOLD = int(CONF.get("PROXY_FAIL_THRESHOLD", 3))  # consecutive failures before cooldown
+PROXY_COOLDOWN = int(CONF.get("PROXY_COOLDOWN", 120))  # seconds proxy is not used after failures
+PROXY_EWMA_ALPHA = 0.2  # weight of the newest fetch in proxy moving averages
+PROXY_DEFAULT_LATENCY = 1.0  # latency assumed for proxies not measured yet
+PROXY_POOL_REBUILD_INTERVAL = 1.0  # seconds between recalculations of selection weights
+PROXY_FAILURE_HTTP_CODES = {403, 407, 429}  # responses meaning proxy is blocked
+
+# CONSTANTS RELATED WITH FETCHING ENGINE (CONNECTION POOLS)
+MAX_FETCH_WORKERS = int(CONF.get("MAX_FETCH_WORKERS", 500))  # max number of in-flight downloads
+FETCH_POOL_SIZE = int(CONF.get("FETCH_POOL_SIZE", 100))  # max connections in pool of single proxy (or direct)
+FETCH_POOL_KEEPALIVE = int(CONF.get("FETCH_POOL_KEEPALIVE", 20))  # max idle keep-alive connections in pool
+FETCH_POOL_PER_HOST = int(CONF.get("FETCH_POOL_PER_HOST", 10))  # max concurrent requests to one host via one pool
+FETCH_MAX_BYTES = int(CONF.get("FETCH_MAX_BYTES", 100 * 1024 * 1024))  # default max size of downloaded body
+FETCH_HTTP2 = bool(int(CONF.get("FETCH_HTTP2", 0)))  # HTTP/2 for direct and premium proxy fetches (h2 package)
+FETCH_HTTP2_STREAMS = int(CONF.get("FETCH_HTTP2_STREAMS", 100))  # max concurrent streams over one HTTP/2 connection
+FETCH_HTTP1_ORIGIN_TTL = 3600  # seconds origin which did not negotiate HTTP/2 is fetched over HTTP/1.1 only
+FETCH_HTTP1_ORIGINS_MAX = 10000  # max remembered HTTP/1.1 origins, the oldest are forgotten above it
+REQUEST_SPEC_CACHE_SIZE = 10000  # compiled task options kept by worker (see request_spec.py)
+
+# CONSTANTS RELATED WITH RETRIES AND CIRCUIT BREAKERS
+RETRY_HTTP_CODES = {int(code) for code in CONF.get("RETRY_HTTP_CODES", "408,425,429,500,502,503,504").split(",")
+                    if code.strip()}  # HTTP errors worth another attempt
+RETRY_ERRORS = {name.strip() for name in CONF.get("RETRY_ERRORS", "CONN_ERROR,TIMEOUT_ERROR,HTTP_PROXY_ERROR").split(",")
+                if name.strip()}  # HttpCheckStatus names of transient errors
+RETRY_BACKOFF_BASE = float(CONF.get("RETRY_BACKOFF_BASE", 0.5))  # seconds, doubled with every attempt
+RETRY_BACKOFF_MAX = float(CONF.get("RETRY_BACKOFF_MAX", 30))  # max seconds between attempts (also cap of Retry-After)
+BREAKER_THRESHOLD = int(CONF.get("BREAKER_THRESHOLD", 5))  # consecutive failures of host opening its breaker
+BREAKER_COOLDOWN = float(CONF.get("BREAKER_COOLDOWN", 30))  # seconds host is short-circuited, doubled on failed probe
+BREAKER_MAX_COOLDOWN = 600  # max seconds host is short-circuited
+BREAKER_HTTP_CODES = {500, 502, 503, 504}  # responses counted as failures of the host
+BREAKER_MAX_HOSTS = 10000  # closed breakers are forgotten above this number
+
+# CONSTANTS RELATED WITH ADAPTIVE CONCURRENCY
+CONCURRENCY_MIN = int(CONF.get("CONCURRENCY_MIN", 10))  # lower bound of in-flight tasks limit
+CONCURRENCY_INITIAL = int(CONF.get("CONCURRENCY_INITIAL", 50))  # starting in-flight tasks limit
+CONCURRENCY_HOST_INITIAL = int(CONF.get("CONCURRENCY_HOST_INITIAL", 2))  # starting per-host limit
+CONCURRENCY_BACKOFF = float(CONF.get("CONCURRENCY_BACKOFF", 0.7))  # limit multiplier on congestion
+CONCURRENCY_DECREASE_INTERVAL = float(CONF.get("CONCURRENCY_DECREASE_INTERVAL", 1.0))  # min seconds between decreases
+CONCURRENCY_LATENCY_FACTOR = float(CONF.get("CONCURRENCY_LATENCY_FACTOR", 2.0))  # latency above baseline * factor is congestion
+CONCURRENCY_ERROR_RATE = float(CONF.get("CONCURRENCY_ERROR_RATE", 0.2))  # error rate shrinking process-wide limit
+CONCURRENCY_MAX_HOSTS = 10000  # idle host limits are forgotten above this number
+
+# CONSTANTS RELATED WITH POLITENESS (PER-DOMAIN RATE LIMITS)
+POLITENESS_RATE = float(CONF.get("POLITENESS_RATE", 2.0))  # requests per second to one domain
+POLITENESS_BURST = int(CONF.get("POLITENESS_BURST", 5))  # requests sent at once to idle domain
+POLITENESS_DOMAIN_BUFFER = int(CONF.get("POLITENESS_DOMAIN_BUFFER", 50))  # claimed tasks waiting per domain
+POLITENESS_MAX_DOMAINS = 10000  # idle domain buckets are forgotten above this number
+
+# CONSTANTS RELATED WITH CACHE
+CACHE_MAX_SIZE = int(CONF.get("CACHE_MAX_SIZE_MB", 10240)) * 1024 * 1024  # disk budget for cached bodies
+CACHE_TTL = int(CONF.get("CACHE_TTL", 0))  # seconds since last use before body is evicted (0 - no limit)
+CACHE_COMPACT_INTERVAL = int(CONF.get("CACHE_COMPACT_INTERVAL", 600))  # seconds between cache compactions
+CACHE_COMPRESSION = CONF.get("CACHE_COMPRESSION", "gzip")  # compression of stored bodies: gzip, zstd or empty
+CACHE_DECODABLE_ENCODINGS = {"identity", "gzip", "x-gzip", "deflate"}  # encodings decoded before compression
+CACHE_WRITE_BATCH = 256 * 1024  # body bytes compressed and written to blob file at once, outside of event loop
+BODY_FIELDS = ("blob", "size", "encoding", "content_encoding", "content_type")  # task fields describing body
+VALIDATOR_FIELDS = ("etag", "last_modified", "cache_control", "expires",
+                    "response_ts", "fresh_until", "no_store")  # task fields used for revalidation
+CACHE_HEURISTIC_FRACTION = 0.1  # freshness of responses with Last-Modified only - fraction of their age
+CACHE_HEURISTIC_MAX = 24 * 3600  # max heuristic freshness in seconds
+CACHE_COMPRESSED_TYPES = ("image/", "video/", "audio/", "application/zip", "application/gzip",
+                          "application/x-gzip", "application/zstd")  # content types stored as received
+
+# CONSTANTS RELATED WITH BULK INGESTION (/fetch_stream)
+STREAM_CHUNK_SIZE = int(CONF.get("STREAM_CHUNK_SIZE", 1000))  # tasks inserted with one bulk insert
+STREAM_MAX_LINE = 64 * 1024  # max length of single line
+STREAM_DEFAULT_OPTIONS = {"method", "retries", "no_proxy", "premium_proxy", "use_cache", "timeout", "user_agent",
+                          "priority", "client_id", "batch_id"}  # options accepted as query params
+
+# CONSTANTS RELATED WITH EXPORT OF RESULTS
+EXPORT_PAGE_SIZE = int(CONF.get("EXPORT_PAGE_SIZE", 1000))  # default number of tasks in page of export
+EXPORT_MAX_PAGE = 10000  # max number of tasks in page of export
+EXPORT_CHUNK_SIZE = 48 * 1024  # bytes read from body at once, multiple of 3 for base64 encoding
+
+# CONSTANTS RELATED WITH CLAIMING TASKS
+TASK_LEASE_TIME = int(CONF.get("TASK_LEASE_TIME", 120))  # seconds before unfinished task returns to the queue
+TASK_HEARTBEAT_INTERVAL = int(CONF.get("TASK_HEARTBEAT_INTERVAL", 30))  # seconds between lease renewals
+TASK_CLAIM_POLL_INTERVAL = float(CONF.get("TASK_CLAIM_POLL_INTERVAL", 0.5))  # wait when queue is empty
+TASK_CLAIM_BATCH = int(CONF.get("TASK_CLAIM_BATCH", 100))  # max tasks claimed with one update
+
+# CONSTANTS RELATED WITH PRIORITY LANES AND FAIR SHARE
+TASK_PRIORITY_MAX = 9  # lanes are claimed in strict order, higher first
+TASK_PRIORITY_BULK = int(CONF.get("TASK_PRIORITY_BULK", 0))  # default lane of /fetch_many and /fetch_stream tasks
+TASK_PRIORITY_INTERACTIVE = int(CONF.get("TASK_PRIORITY_INTERACTIVE", 5))  # default lane of /fetch_one tasks
+CLIENT_WEIGHTS = {client.strip(): float(weight) for client, _, weight in
+                  (item.rpartition(":") for item in CONF.get("CLIENT_WEIGHTS", "").split(",") if item.strip())}
+FAIR_SHARE_MAX_CLIENTS = 10000  # clients behind current virtual time are forgotten above this number
+
+# CONSTANTS RELATED WITH WORKER PROCESSES
+API_RUN_WORKER = CONF.get("API_RUN_WORKER", "1") == "1"  # fetch in API process, 0 - only separate workers fetch
+WORKER_PROCESSES = int(CONF.get("WORKER_PROCESSES", 1))  # worker processes started by worker.py
+WORKER_DRAIN_TIMEOUT = float(CONF.get("WORKER_DRAIN_TIMEOUT", 60))  # seconds to finish tasks on shutdown
+WORKER_METRICS_INTERVAL = 5  # seconds between updates of worker gauges of worker.py processes
+PROXY_UPDATE_INTERVAL = int(CONF.get("PROXY_UPDATE_INTERVAL", 3 * 3600))  # seconds between proxy list updates
+
+# CONSTANTS RELATED WITH WRITE-BACK OF TASK RESULTS
+WRITE_BACK_BATCH = int(CONF.get("WRITE_BACK_BATCH", 500))  # buffered updates which trigger bulk write
+WRITE_BACK_INTERVAL = float(CONF.get("WRITE_BACK_INTERVAL", 1.0))  # max seconds update waits in the buffer
+
 
+# CONSTANTS RELATED WITH WAITING FOR TASKS (LONG-POLL AND EVENT STREAM)
+TASK_WAIT_MAX = int(CONF.get("TASK_WAIT_MAX", 60))  # max seconds of long-poll request
+TASK_EVENTS_POLL_INTERVAL = float(CONF.get("TASK_EVENTS_POLL_INTERVAL", 1.0))  # check of watched tasks without change stream
+TASK_EVENTS_KEEPALIVE = 15  # seconds between keep-alive comments of event stream
 
 # FETCHING DATA STATUSES
 class HttpCheckStatus(enum.Enum):
@@ -37,6 +163,8 @@ class HttpCheckStatus(enum.Enum):
     HTTP_PROXY_ERROR = -5
     HTTP_PROXY_INVALID_URL = -6
     SSL_ERROR = -7
+    BODY_TOO_LARGE = -8
+    CIRCUIT_OPEN = -9
     UNKNOWN = -99
 
 
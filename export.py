@@ -0,0 +1,139 @@
+"""
+ Export of batch results - task metadata pages and archives of cached bodies streamed
+ without staging on disk
+"""
+import base64
+import os
+import tarfile
+
+import anyio
+
+from consts import *
+from utils import dumps
+
+EXPORT_FORMATS = {"tar": "application/x-tar", "ndjson": "application/x-ndjson"}
+ENCODING_SUFFIXES = {"identity": "", "gzip": ".gz", "x-gzip": ".gz", "zstd": ".zst"}
+ARCHIVE_FIELDS = ("url", "status", "error_reason", "cache", "update_ts") + BODY_FIELDS
+
+
+async def export_page(storage, ids: list = None, batch_id: str = None, fields: list = None, after=None,
+                      limit: int = EXPORT_PAGE_SIZE):
+    """Page of tasks ordered by _id
+    :param storage: Storage object
+    :param ids: list of exported task ObjectIds
+    :param batch_id: export tasks of the batch instead of ids
+    :param fields: returned fields (None - all fields)
+    :param after: _id of the last task of previous page
+    :param limit: max number of tasks
+    :return: tuple (tasks, _id of the last task if next page may exist, otherwise None)
+    """
+    tasks = await storage.page_tasks(ids, batch_id, fields, after, limit)
+    return tasks, tasks[-1]["_id"] if len(tasks) == limit else None
+
+
+async def iter_tasks(storage, ids: list = None, batch_id: str = None, fields=ARCHIVE_FIELDS,
+                     page_size: int = EXPORT_PAGE_SIZE):
+    """Iterate tasks in order of ids (or tasks of the batch in order of _id), reading them in pages
+    :param storage: Storage object
+    :param ids: list of task ObjectIds
+    :param batch_id: iterate tasks of the batch instead of ids
+    :param fields: returned fields
+    :param page_size: number of tasks read with one query
+    :return: async iterator of task documents, missing tasks are skipped
+    """
+    if batch_id:
+        after = None
+        while True:
+            tasks, after = await export_page(storage, batch_id=batch_id, fields=list(fields), after=after,
+                                             limit=page_size)
+            for task in tasks:
+                yield task
+            if after is None:
+                return
+
+    for i in range(0, len(ids), page_size):
+        page = ids[i:i + page_size]
+        tasks = {task["_id"]: task for task in await storage.find_tasks(page, list(fields))}
+        for task_id in page:
+            if task_id in tasks:
+                yield tasks[task_id]
+
+
+def body_path(blob_store, task: dict):
+    """Location of stored body of the task
+    :param blob_store: BlobStore object
+    :param task: task document
+    :return: path to existing file, None if task has no body
+    """
+    if task.get("blob"):
+        filename = blob_store.path(task["blob"])
+    else:
+        filename = os.path.join(CACHE_DIR, f"{task['_id']}.cache")  # objects stored before blob store
+    return filename if os.path.isfile(filename) else None
+
+
+async def read_file(filename: str, chunk_size: int = EXPORT_CHUNK_SIZE):
+    """Read file without blocking event loop
+    :param filename: path to file
+    :param chunk_size: size of chunks
+    :return: async iterator of chunks
+    """
+    async with await anyio.open_file(filename, mode="rb") as fd:
+        while True:
+            chunk = await fd.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+async def tar_archive(storage, blob_store, ids: list = None, batch_id: str = None):
+    """Tar archive of stored bodies - one member per task with body, named by task id with suffix
+    of its encoding (bodies are stored compressed), task metadata is kept in PAX headers UNICORN.*
+    :param storage: Storage object
+    :param blob_store: BlobStore object
+    :param ids: list of task ObjectIds
+    :param batch_id: export tasks of the batch instead of ids
+    :return: async iterator of archive chunks
+    """
+    async for task in iter_tasks(storage, ids, batch_id):
+        filename = body_path(blob_store, task)
+        if filename is None:
+            continue
+        encoding = task.get("encoding", "identity")
+        info = tarfile.TarInfo(str(task["_id"]) + ENCODING_SUFFIXES.get(encoding, f".{encoding}"))
+        info.size = os.path.getsize(filename)
+        info.mtime = os.path.getmtime(filename)
+        info.pax_headers = {f"UNICORN.{name}": str(task[name]) for name in ARCHIVE_FIELDS
+                            if task.get(name) is not None}
+        yield info.tobuf(format=tarfile.PAX_FORMAT)
+
+        sent = 0
+        async for chunk in read_file(filename):
+            chunk = chunk[:info.size - sent]  # file is not expected to grow, header size is binding
+            sent += len(chunk)
+            yield chunk
+        if sent < info.size:
+            yield bytes(info.size - sent)
+        if info.size % tarfile.BLOCKSIZE:
+            yield bytes(tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE)
+    yield bytes(2 * tarfile.BLOCKSIZE)  # end of archive
+
+
+async def ndjson_archive(storage, blob_store, ids: list = None, batch_id: str = None):
+    """NDJSON with one line per task - metadata and "body" with base64 of stored bytes (null without body)
+    :param storage: Storage object
+    :param blob_store: BlobStore object
+    :param ids: list of task ObjectIds
+    :param batch_id: export tasks of the batch instead of ids
+    :return: async iterator of lines, body of every line is streamed in chunks
+    """
+    async for task in iter_tasks(storage, ids, batch_id):
+        filename = body_path(blob_store, task)
+        task["task_id"] = task.pop("_id")
+        if filename is None:
+            yield dumps({**task, "body": None}) + b"\n"
+            continue
+        yield dumps(task)[:-1] + b',"body":"'
+        async for chunk in read_file(filename):
+            yield base64.b64encode(chunk)  # chunks are multiple of 3 bytes, encoded parts can be joined
+        yield b'"}\n'
@@ -0,0 +1,53 @@
+import heapq
+
+from consts import *
+
+
+class FairShare:
+    """
+    Weighted fair share of claimed tasks across clients - every claimed task advances virtual time
+    of its client by 1/weight and tasks go to clients with the lowest virtual time first
+    """
+
+    def __init__(self, weights: dict = None, default_weight: float = 1.0):
+        """Init fair share
+        :param weights: client id -> weight
+        :param default_weight: weight of clients not listed in weights
+        """
+        self._weights = weights if weights is not None else CLIENT_WEIGHTS
+        self._default_weight = default_weight
+        self._vtime = {}  # client id -> virtual time
+        self._floor = 0.0  # system virtual time - lowest virtual time of clients with waiting tasks
+
+    def weight(self, client) -> float:
+        return self._weights.get(client, self._default_weight)
+
+    def allocate(self, clients: list, limit: int) -> dict:
+        """Split number of tasks among clients with waiting tasks
+        :param clients: list of client ids
+        :param limit: number of tasks to split
+        :return: dict client id -> number of tasks
+        """
+        if not clients or limit <= 0:
+            return {}
+        # clients returning after idle time start from the current virtual time, not from their old one
+        self._floor = max(self._floor, min((self._vtime.get(c, self._floor) for c in clients)))
+        heap = [(max(self._vtime.get(c, self._floor), self._floor), i, c) for i, c in enumerate(clients)]
+        heapq.heapify(heap)
+        shares = {}
+        for _ in range(limit):
+            vtime, i, client = heapq.heappop(heap)
+            shares[client] = shares.get(client, 0) + 1
+            heapq.heappush(heap, (vtime + 1.0 / self.weight(client), i, client))
+        return shares
+
+    def charge(self, client, count: int):
+        """Record tasks claimed for the client
+        :param client: client id
+        :param count: number of claimed tasks
+        :return:
+        """
+        self._vtime[client] = max(self._vtime.get(client, self._floor), self._floor) + count / self.weight(client)
+        if len(self._vtime) > FAIR_SHARE_MAX_CLIENTS:
+            # clients behind current virtual time are forgotten, they start from it again anyway
+            self._vtime = {c: t for c, t in self._vtime.items() if t > self._floor}
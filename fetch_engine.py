@@ -0,0 +1,252 @@
+import asyncio
+import collections
+import contextlib
+import datetime
+import logging
+import ssl
+import time
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from urllib.parse import urlsplit
+
+import httpx
+
+from consts import *
+from utils import parse_http_date
+
+try:
+    import h2
+except ImportError:  # HTTP/2 transport is optional
+    h2 = None
+
+
+class BodyTooLarge(Exception):
+    """
+    Response body exceeds allowed size
+    """
+
+
+async def limit_stream(chunks, max_bytes: int = None):
+    """Pass chunks of the body through, aborting when body exceeds max size
+    :param chunks: async iterator of body chunks
+    :param max_bytes: max body size (None - no limit)
+    :return: async iterator of chunks
+    """
+    received = 0
+    async for chunk in chunks:
+        received += len(chunk)
+        if max_bytes and received > max_bytes:
+            raise BodyTooLarge(f"Body exceeds {max_bytes} bytes")
+        yield chunk
+
+
+def classify_error(err: BaseException, via_proxy: bool = False) -> HttpCheckStatus:
+    """Map exception raised while fetching to fetching status
+    :param err: exception raised by engine
+    :param via_proxy: True if request was sent through proxy server
+    :return: HttpCheckStatus value
+    """
+    if isinstance(err, BodyTooLarge):
+        return HttpCheckStatus.BODY_TOO_LARGE
+    if isinstance(err, httpx.HTTPStatusError):
+        return HttpCheckStatus.HTTP_ERROR
+    if isinstance(err, httpx.ProxyError):
+        return HttpCheckStatus.HTTP_PROXY_ERROR
+    if isinstance(err, (httpx.InvalidURL, httpx.UnsupportedProtocol)):
+        return HttpCheckStatus.HTTP_PROXY_INVALID_URL
+    if isinstance(err, httpx.ConnectTimeout):
+        return HttpCheckStatus.CONN_ERROR
+    if isinstance(err, httpx.TimeoutException):
+        return HttpCheckStatus.TIMEOUT_ERROR
+    cause = err
+    while cause is not None:  # transport errors may wrap the original ssl exception
+        if isinstance(cause, ssl.SSLError):
+            return HttpCheckStatus.SSL_ERROR
+        cause = cause.__cause__ or cause.__context__
+    if isinstance(err, (httpx.NetworkError, httpx.ProtocolError)):
+        if via_proxy and isinstance(err, httpx.ConnectError):
+            return HttpCheckStatus.HTTP_PROXY_ERROR
+        return HttpCheckStatus.CONN_ERROR
+    return HttpCheckStatus.GENERAL_ERROR
+
+
+def error_http_code(err: BaseException):
+    """HTTP response code carried by exception
+    :param err: exception raised by engine
+    :return: response code or None
+    """
+    if isinstance(err, httpx.HTTPStatusError):
+        return err.response.status_code
+    return None
+
+
+def error_retry_after(err: BaseException):
+    """Delay requested by Retry-After header of the error response
+    :param err: exception raised by engine
+    :return: seconds or None if header is missing or invalid
+    """
+    if not isinstance(err, httpx.HTTPStatusError):
+        return None
+    value = (err.response.headers.get("retry-after") or "").strip()
+    if value.isdigit():
+        return float(value)
+    ts = parse_http_date(value)
+    if ts is None:
+        return None
+    return max((ts - datetime.datetime.utcnow()).total_seconds(), 0.0)
+
+
+class FetchEngine:
+    """
+    Asyncio HTTP client keeping connection pools per proxy server and per host,
+    HTTPS origins may be fetched over HTTP/2 with concurrent requests multiplexed on shared connection
+    """
+
+    def __init__(self, pool_size: int = FETCH_POOL_SIZE,
+                 pool_keepalive: int = FETCH_POOL_KEEPALIVE,
+                 pool_per_host: int = FETCH_POOL_PER_HOST,
+                 http2: bool = FETCH_HTTP2, http2_streams: int = FETCH_HTTP2_STREAMS):
+        """Init fetching engine
+        :param pool_size: max number of connections in the pool of single proxy (or direct connections)
+        :param pool_keepalive: max number of idle connections kept alive in the pool
+        :param pool_per_host: max number of concurrent requests to one host through one pool
+        :param http2: offer HTTP/2 to HTTPS origins of requests allowing it
+        :param http2_streams: max number of concurrent requests to one origin over HTTP/2 connection
+        """
+        if http2 and h2 is None:
+            logging.warning("h2 package not installed, fetching over HTTP/1.1 only")
+            http2 = False
+        self._limits = httpx.Limits(max_connections=pool_size,
+                                    max_keepalive_connections=pool_keepalive)
+        self._pool_per_host = pool_per_host
+        self.http2 = http2
+        self._http2_streams = http2_streams
+        self._clients = {}  # (proxy server (None for direct connection), HTTP/2) -> client with its own pool
+        self._requests = collections.Counter()  # client -> requests in progress
+        self._retired = set()  # clients of removed proxies, closed after their last request
+        self._host_slots = {}  # (proxy server, host, HTTP/2) -> semaphore, dropped when host is idle
+        self._host_users = collections.Counter()  # (proxy server, host, HTTP/2) -> requests holding or waiting
+        self._http1_origins = {}  # (proxy server, host) which did not negotiate HTTP/2 -> time of the next offer
+
+    @property
+    def max_per_host(self) -> int:
+        """Max number of concurrent requests to one host"""
+        return max(self._pool_per_host, self._http2_streams if self.http2 else 0)
+
+    def _get_client(self, proxy: str = None, http2: bool = False) -> httpx.AsyncClient:
+        client = self._clients.get((proxy, http2))
+        if client is None:
+            # cookies set by servers must not leak between tasks sharing the same pool
+            jar = CookieJar(policy=DefaultCookiePolicy(allowed_domains=[]))
+            client = httpx.AsyncClient(proxies=f"http://{proxy}" if proxy else None,
+                                       limits=self._limits, cookies=jar,
+                                       follow_redirects=True, http2=http2)
+            self._clients[(proxy, http2)] = client
+        return client
+
+    @contextlib.asynccontextmanager
+    async def _host_slot(self, proxy: str, host: str, http2: bool = False):
+        key = (proxy, host, http2)
+        slot = self._host_slots.get(key)
+        if slot is None:
+            # requests over HTTP/2 share one connection, its streams replace connections of HTTP/1.1 pool
+            slot = asyncio.Semaphore(self._http2_streams if http2 else self._pool_per_host)
+            self._host_slots[key] = slot
+        self._host_users[key] += 1
+        try:
+            async with slot:
+                yield
+        finally:
+            self._host_users[key] -= 1
+            if not self._host_users[key]:
+                # semaphore of idle host holds no state, crawls of many hosts do not grow the map
+                del self._host_users[key]
+                self._host_slots.pop(key, None)
+
+    def _offer_http2(self, proxy: str, host: str) -> bool:
+        until = self._http1_origins.get((proxy, host))
+        if until is None:
+            return True
+        if until > time.monotonic():
+            return False
+        del self._http1_origins[(proxy, host)]  # origin may have enabled HTTP/2 meanwhile
+        return True
+
+    def _remember_http1(self, proxy: str, host: str):
+        self._http1_origins.pop((proxy, host), None)
+        self._http1_origins[(proxy, host)] = time.monotonic() + FETCH_HTTP1_ORIGIN_TTL
+        if len(self._http1_origins) > FETCH_HTTP1_ORIGINS_MAX:
+            del self._http1_origins[next(iter(self._http1_origins))]  # oldest entry
+
+    async def drop_proxies(self, proxies):
+        """Close connection pools of proxies which are not used anymore - pools still sending requests
+        are closed after their last request
+        :param proxies: proxy servers removed from the pool
+        :return:
+        """
+        proxies = set(proxies)
+        for key in [key for key in self._http1_origins if key[0] in proxies]:
+            del self._http1_origins[key]
+        for key in [key for key in self._clients if key[0] in proxies]:
+            client = self._clients.pop(key)
+            if self._requests[client]:
+                self._retired.add(client)
+            else:
+                del self._requests[client]
+                await client.aclose()
+
+    @contextlib.asynccontextmanager
+    async def stream(self, method: str, url: str, params: dict = None, data: dict = None,
+                     headers: dict = None, cookies: dict = None, timeout: float = 60,
+                     proxy: str = None, max_bytes: int = None, http2: bool = False):
+        """Send single HTTP request using pooled connection, body is read by the caller
+        :param method: HTTP method
+        :param url: URL address
+        :param params: query string params
+        :param data: form data send in body
+        :param headers: HTTP request headers
+        :param cookies: cookies send with request
+        :param timeout: connection and read timeout in seconds
+        :param proxy: proxy server (host:port) or None for direct connection
+        :param max_bytes: max body size declared in Content-Length
+        :param http2: request may be sent over HTTP/2 (used if enabled in engine and negotiated by server)
+        :return: response with not loaded content, raises exception for HTTP error and redirect statuses
+                 except 304 Not Modified (answer to conditional request)
+        """
+        headers = dict(headers or {})
+        if cookies:
+            headers["Cookie"] = "; ".join(f"{k}={v}" for k, v in cookies.items())
+
+        parts = urlsplit(url)
+        host = parts.netloc.lower()
+        # HTTP/2 is negotiated with TLS ALPN only, origins answering with HTTP/1.1 go to HTTP/1.1 pool
+        http2 = http2 and self.http2 and parts.scheme.lower() == "https" and self._offer_http2(proxy, host)
+        client = self._get_client(proxy, http2)
+        self._requests[client] += 1
+        try:
+            async with self._host_slot(proxy, host, http2):
+                async with client.stream(method, url, params=params, data=data,
+                                         headers=headers, timeout=timeout) as r:
+                    if http2 and r.http_version != "HTTP/2":
+                        self._remember_http1(proxy, host)
+                    if r.status_code != 304:
+                        r.raise_for_status()
+                    length = r.headers.get("content-length", "")
+                    if max_bytes and length.isdigit() and int(length) > max_bytes:
+                        raise BodyTooLarge(f"Content-Length {length} exceeds {max_bytes} bytes")
+                    yield r
+        finally:
+            self._requests[client] -= 1
+            if not self._requests[client]:
+                del self._requests[client]
+                if client in self._retired:
+                    self._retired.discard(client)
+                    await client.aclose()
+
+    async def close(self):
+        """Close all connection pools
+        :return:
+        """
+        clients, self._clients = list(self._clients.values()) + list(self._retired), {}
+        self._retired = set()
+        for client in clients:
+            await client.aclose()
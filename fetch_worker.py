@@ -1,233 +1,558 @@
 import asyncio
 import logging
-import random
-import shutil
-import threading
+import socket
 import time
-
-import pymongo
-import requests
-from deepdiff import DeepDiff
-from starlette.concurrency import run_in_threadpool
-
+import uuid
+from urllib.parse import urlsplit
+
+import metrics
+from blob_store import BlobStore
+from concurrency import ConcurrencyController
+from fair_share import FairShare
+from fetch_engine import FetchEngine, classify_error, error_http_code, error_retry_after, limit_stream
+from politeness import DomainScheduler
+from proxy_pool import ProxyPool
+from request_spec import RequestSpec, RequestSpecs
+from retry_policy import CircuitBreakers, RetryPolicy, host_outcome
+from task_events import TaskEvents
 from utils import *
+from write_back import WriteBack
 
 
 class FetchWorker:
     """
-    Class for reading tasks from mongodb and fetching data from URLs
+    Class for reading tasks from storage and fetching data from URLs
     """
 
-    def __init__(self, db, max_workers: int = 3):
-        self._db = db
+    def __init__(self, storage, max_workers: int = 3, blobs: BlobStore = None, events: TaskEvents = None):
+        """
+        Init fetch worker
+        :param storage: Storage object
+        :param max_workers: upper bound of in-flight tasks
+        :param blobs: store of downloaded bodies (default store in CACHE_DIR)
+        :param events: notifications of clients waiting for finished tasks
+        """
+        self._storage = storage
         self._ua_list = get_user_agents()  # get UA list
         self._MAX_WORKERS = max_workers
-        self._workers = 0
-        self._lock = threading.Lock()
-        self._proxies = []
-        self._proxies_premium = get_premium_proxies()
-        os.makedirs(CACHE_DIR, exist_ok=True)
+        self._worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._engine = FetchEngine()
+        self._concurrency = ConcurrencyController(max_workers, self._engine.max_per_host)
+        self._scheduler = DomainScheduler()
+        self._in_flight = set()  # ids of tasks leased by this worker
+        self._tasks = set()  # running grab_data tasks
+        self._background = []  # heartbeat and claiming tasks
+        self._dispatcher = None
+        self._running = False
+        self._proxy_pool = ProxyPool(get_premium_proxies())
+        self._write_back = WriteBack(storage)
+        self._blobs = blobs or BlobStore(storage, write_back=self._write_back)
+        self._events = events
+        self._flights = {}  # (request fingerprint, max_bytes) -> future with result of the fetch in progress
+        self._fair_share = FairShare()
+        self._specs = RequestSpecs()  # task options compiled once per distinct options
+        self._retry_policy = RetryPolicy()
+        self._breakers = CircuitBreakers()  # target hosts failing repeatedly are short-circuited
+
+    def stats(self) -> dict:
+        """
+        Current concurrency limits of the worker
+        :return: dict with stats
+        """
+        return {"worker_id": self._worker_id, "tasks": len(self._in_flight),
+                "concurrency": self._concurrency.stats(), "scheduler": self._scheduler.stats(),
+                "proxies": self._proxy_pool.stats(), "breakers": self._breakers.stats()}
 
     async def grab_data(self, doc):
         """
         Wrapper method for fetching data from URL
-        :param doc: task document from mongoDB
+        :param doc: task document from mongoDB (already claimed by this worker)
         :return:
         """
-        self._lock.acquire()
-        self._workers += 1
-        self._lock.release()
+        ts_start = time.monotonic()
+        released = False
+        try:
+            spec = self._specs.get(doc)
+            fingerprint = doc.get('fingerprint') or request_fingerprint(doc.get('url'), spec.options)
+            if not spec.use_cache:
+                task_result = await self.exec_shared(doc, spec, fingerprint)
+            else:
+                cached = await self.find_in_cache(doc.get('_id'), fingerprint, spec.revalidate)
+                if cached:
+                    cached.pop("_id")
+                if cached and (not spec.revalidate or
+                               is_fresh(cached, datetime.datetime.utcnow(), spec.max_age, spec.min_fresh)):
+                    task_result = {"status": TaskStatus.DONE.value, "cache": True, **cached,
+                                   "update_ts": datetime.datetime.utcnow() }
+                else:
+                    # stale copy is revalidated with conditional request
+                    task_result = await self.exec_shared(doc, spec, fingerprint, cached)
+
+            logging.info(task_result)
+            if '_id' in task_result:
+                task_result.pop('_id')
+            task_result["lease_expire_ts"] = None
+            if not doc.get('fingerprint'):
+                task_result["fingerprint"] = fingerprint  # tasks stored before fingerprints were introduced
+
+            if task_result.get("coalesced"):
+                outcome = "coalesced"
+            elif task_result.get("cache"):
+                outcome = "cached"
+            else:
+                outcome = "done" if task_result.get("status") == TaskStatus.DONE.value else "error"
+            metrics.TASK_DURATION.labels(outcome).observe(time.monotonic() - ts_start)
+
+            # result is written with the next bulk write, slot is free for the next task meanwhile,
+            # the task stays leased (and recoverable after crash) until the result is flushed;
+            # only the current lease holder is allowed to store the result
+            self._concurrency.release()
+            released = True
+            stored = await self._write_back.add("complete_tasks", (doc.get('_id'), self._worker_id), task_result)
+            if stored and self._events is not None:
+                self._events.publish(doc.get('_id'), task_result)
+        finally:
+            self._in_flight.discard(doc.get('_id'))
+            if not released:
+                self._concurrency.release()
+        return
 
-        query = {"_id": ObjectId(doc.get('_id'))}
-        await self._db[COLLECTION_TASKS]. \
-            update_one(query, {"$set": {"status": TaskStatus.INPROGRESS.value}})
+    async def select_tasks(self, limit: int, exclude_domains=None) -> list:
+        """
+        Choose NEW tasks to claim - priority lanes are served in strict order, higher first,
+        capacity of the lane is split among its clients by weighted fair share, oldest tasks
+        of the client go first. Capacity left by a lane goes to the lower ones.
+        :param limit: max number of tasks
+        :param exclude_domains: domains which should not be claimed now
+        :return: list of task ids
+        """
+        # lanes and clients are read from index only, domains are filtered with tasks of the client
+        ids = []
+        lanes = await self._storage.queue_lanes()
+        for priority in sorted(lanes, key=lambda p: -(p or 0)):
+            clients = await self._storage.lane_clients(priority)
+            while clients and len(ids) < limit:
+                exhausted = []
+                for client, count in self._fair_share.allocate(clients, limit - len(ids)).items():
+                    candidates = await self._storage.queued_tasks(priority, client, count, ids, exclude_domains)
+                    self._fair_share.charge(client, len(candidates))
+                    ids.extend(candidates)
+                    if len(candidates) < count:
+                        exhausted.append(client)  # its share goes to the other clients
+                clients = [c for c in clients if c not in exhausted]
+            if len(ids) >= limit:
+                break
+        return ids
+
+    async def claim_tasks(self, limit: int, exclude_domains=None) -> list:
+        """
+        Lease NEW tasks to this worker with single update
+        :param limit: max number of claimed tasks
+        :param exclude_domains: domains which should not be claimed now
+        :return: list of claimed task documents (empty if queue is empty)
+        """
+        ids = await self.select_tasks(limit, exclude_domains)
+        if not ids:
+            return []
 
-        task_json = json.loads(doc.get('task',"{}"))
-        cache_id, use_cache = None, task_json.get('use_cache',False)
-        if not use_cache:
-            task_result = await run_in_threadpool(self.exec_task, doc)
-        else:
-            cache_id = await self.find_in_cache(doc.get('_id'), doc.get('url'), doc.get('task'))
-            if cache_id:
-                task_result = {"status": TaskStatus.DONE.value, "cache": True, "update_ts": datetime.datetime.utcnow() }
-            else:
-                task_result = await run_in_threadpool(self.exec_task, doc)
+        # tasks claimed by other workers in the meantime are not NEW anymore and stay with them
+        lease_expire_ts = datetime.datetime.utcnow() + datetime.timedelta(seconds=TASK_LEASE_TIME)
+        return await self._storage.lease_tasks(ids, self._worker_id, lease_expire_ts)
 
-        logging.info(task_result)
-        if '_id' in task_result:
-            task_result.pop('_id')
-        await self._db[COLLECTION_TASKS]. \
-            update_one(query, {"$set": task_result })
+    async def renew_leases(self):
+        """
+        Extend leases of tasks processed by this worker and return expired leases to the queue
+        :return:
+        """
+        now = datetime.datetime.utcnow()
+        if self._in_flight:
+            await self._storage.renew_leases(list(self._in_flight), self._worker_id,
+                                             now + datetime.timedelta(seconds=TASK_LEASE_TIME))
 
-        self._lock.acquire()
-        self._workers -= 1
-        self._lock.release()
-        return
+        expired = await self._storage.expire_leases(now)
+        if expired:
+            logging.warning(f"Returned {expired} tasks with expired lease to the queue")
 
-    async def run(self):
+    async def load_proxies(self):
         """
-        Start listening mongoDB collection for retrieving data
+        Load alive proxies sorted by latency
         :return:
         """
-        logging.info("Fetch worker start...")
-        loop = asyncio.get_event_loop()
-        colls = await self._db.list_collection_names()
-        if not COLLECTION_TASKS in colls:
-            await self._db.create_collection(COLLECTION_TASKS,
-                                             capped=True, max=1_000_000, size=50 * 1024 * 1024)
+        proxies = await self._storage.find_proxies(alive=True)
+        premium = [p for p in proxies if p.get("premium")]
+        # premium proxies from premium file are used until the checker confirms any of them
+        removed = self._proxy_pool.load([p for p in proxies if not p.get("premium")], premium or None)
+        await self._engine.drop_proxies(removed)  # connection pools of removed proxies are closed
 
+    async def heartbeat(self):
+        """
+        Periodically renew leases and refresh proxies list
+        :return:
+        """
         while True:
-            # take only alive proxies
-            condition = {"status_check": HttpCheckStatus.OK.value}
-            self._proxies = await self._db[COLLECTION_PROXIES]. \
-                find(condition, {"_id": 0, "response": 0}). \
-                sort([('latency', 1)]).to_list(None)
+            await asyncio.sleep(TASK_HEARTBEAT_INTERVAL)
+            try:
+                await self.renew_leases()
+                await self.load_proxies()
+            except Exception as exc:
+                logging.exception(str(exc))
 
-            cursor = self._db[COLLECTION_TASKS].find(
-                {"status": TaskStatus.NEW.value}, cursor_type=pymongo.CursorType.TAILABLE_AWAIT).limit(
-                self._MAX_WORKERS)
-            while cursor.alive:
+    async def claim_loop(self):
+        """
+        Claim tasks into scheduler buffer, skipping domains which already have full buffer
+        :return:
+        """
+        capacity = 2 * self._MAX_WORKERS
+        while True:
+            await self._scheduler.wait_below(capacity)
+            try:
+                docs = await self.claim_tasks(min(TASK_CLAIM_BATCH, capacity - self._scheduler.size),
+                                              self._scheduler.saturated())
+            except Exception as exc:
+                docs = []
+                logging.exception(str(exc))
+            if not docs:
+                await asyncio.sleep(TASK_CLAIM_POLL_INTERVAL)
+                continue
 
-                async for doc in cursor:
-                    loop.create_task(self.grab_data(doc))
-                    while self._workers >= self._MAX_WORKERS:
-                        await asyncio.sleep(5)
+            now = datetime.datetime.utcnow()
+            for doc in docs:
+                self._in_flight.add(doc.get('_id'))
+                if doc.get('insert_ts'):
+                    metrics.TASK_QUEUE_WAIT.labels(doc.get('priority') or 0) \
+                        .observe((now - doc.get('insert_ts')).total_seconds())
+                spec = self._specs.get(doc)
+                self._scheduler.submit(doc, doc.get('domain') or registrable_domain(doc.get('url')),
+                                       spec.rate_limit, spec.burst, doc.get('priority') or 0)
 
-            await asyncio.sleep(5)
-        logging.debug('run - done')
+    async def run(self):
+        """
+        Start claiming tasks from storage and fetching data
+        :return:
+        """
+        if self._running:
+            return
+        self._running = True
+        logging.info(f"Fetch worker {self._worker_id} start...")
+        loop = asyncio.get_event_loop()
+        await self._blobs.check_shared()
+        await self.load_proxies()
+        self._background = [loop.create_task(self.heartbeat()), loop.create_task(self.claim_loop())]
+        self._dispatcher = loop.create_task(self.dispatch_loop())
+        try:
+            await self._dispatcher
+        except asyncio.CancelledError:
+            if self._running:
+                raise
+        logging.info(f"Fetch worker {self._worker_id} stopped")
+
+    async def dispatch_loop(self):
+        """
+        Start tasks released by the per-domain scheduler
+        :return:
+        """
+        loop = asyncio.get_event_loop()
+        while self._running:
+            await self._concurrency.acquire()
+            doc = await self._scheduler.next()
+            task = loop.create_task(self.grab_data(doc))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def stop(self, timeout: float = WORKER_DRAIN_TIMEOUT):
+        """
+        Stop claiming and drain the worker - tasks being fetched are given timeout to finish,
+        tasks waiting in scheduler buffer and the ones not finished in time are returned to the queue
+        :param timeout: max seconds to wait for tasks being fetched
+        :return:
+        """
+        if not self._running:
+            return
+        self._running = False
+        heartbeat, claimer = self._background or (None, None)
+        for task in (claimer, self._dispatcher):
+            if task:
+                task.cancel()
+
+        buffered = [doc.get('_id') for doc in self._scheduler.drain()]
+        self._in_flight.difference_update(buffered)
+        logging.info(f"Fetch worker {self._worker_id} draining {len(self._tasks)} tasks...")
+        unfinished = []
+        if self._tasks:
+            _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+            unfinished = list(self._in_flight)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        # results already buffered are written before leases of unfinished tasks are released
+        await self._write_back.flush()
+        if buffered or unfinished:
+            await self.release_tasks(buffered + unfinished)
+        if heartbeat:
+            heartbeat.cancel()
+        await self.close()
+
+    async def release_tasks(self, ids: list):
+        """
+        Return tasks leased by this worker to the queue
+        :param ids: ids of tasks
+        :return:
+        """
+        released = await self._storage.release_tasks(ids, self._worker_id)
+        logging.info(f"Returned {released} unfinished tasks to the queue")
 
-    def exec_task(self, doc):
+    async def close(self):
+        """
+        Close connection pools of fetching engine
+        :return:
         """
-        Execute single URL downloading
+        await self._engine.close()
+
+    async def exec_shared(self, doc, spec: RequestSpec, fingerprint: str, cached: dict = None):
+        """
+        Execute URL downloading once for concurrent tasks with the same request fingerprint (single-flight) -
+        duplicates of GET/HEAD request wait for the fetch in progress and take its result. After network error
+        or HTTP error through proxy the next waiting duplicate fetches by itself, as its options (proxy, timeout,
+        retries) may differ. Only tasks with the same max_bytes share the fetch, it is not part of the fingerprint
         :param doc: document from task collection from mongo
+        :param spec: compiled task options
+        :param fingerprint: request fingerprint of the task
+        :param cached: stale cached copy to revalidate
+        :return: status of downloading URL
+        """
+        if spec.method not in ("GET", "HEAD"):
+            return await self.exec_task(doc, spec, cached)
+
+        key = (fingerprint, spec.max_bytes)
+        while key in self._flights:
+            # waiting duplicate leaves its worker slot to other tasks
+            self._concurrency.release()
+            try:
+                shared = await asyncio.shield(self._flights[key])
+            except asyncio.CancelledError:
+                self._concurrency.acquire_nowait()  # slot is returned by grab_data
+                raise
+            if shared.get("status") == TaskStatus.DONE.value or \
+                    (shared.get("error_reason") == HttpCheckStatus.HTTP_ERROR.value and shared.get("proxy") is None):
+                self._concurrency.acquire_nowait()  # returned by grab_data right after the result is taken
+                logging.info(f"{doc.get('_id')} : Task coalesced")
+                result = {k: v for k, v in shared.items() if k not in ("_id", "proxy", "download_time")}
+                result.update({"coalesced": True, "update_ts": datetime.datetime.utcnow()})
+                if result["status"] == TaskStatus.DONE.value:
+                    result["cache"] = True  # body stored by the other task
+                return result
+            await self.acquire_slot()  # fetched by itself
+
+        flight = self._flights[key] = asyncio.get_event_loop().create_future()
+        result = {}
+        try:
+            result = await self.exec_task(doc, spec, cached)
+            return result
+        finally:
+            del self._flights[key]
+            flight.set_result(result)
+
+    async def exec_task(self, doc, spec: RequestSpec, cached: dict = None):
+        """
+        Execute URL downloading - failed attempts are repeated according to retry policy with backoff,
+        attempts to host with open circuit breaker are not sent at all
+        :param doc: document from task collection from mongo
+        :param spec: compiled task options
+        :param cached: stale cached copy (body and validator fields) to revalidate
         :return: status of downloading URL
         """
-        task_params = json.loads(doc.get('task', {}))
         _id = str(doc.get('_id'))
         _url = doc.get('url')
-
-        _headers = {"Accept-Encoding": "gzip, deflate, br"}
-        if task_params.get('user_agent') is None or task_params.get('user_agent', "") == "":
-            _headers["User-Agent"] = self._ua_list[random.randint(0, len(self._ua_list) - 1)]
-        else:
-            _headers["User-Agent"] = task_params.get('user_agent', "")
-        if task_params.get('headers'):
-            _headers.update(task_params.get('headers'))
-
-        _method = task_params.get('method', 'GET').upper()
-        _cookies = task_params.get('cookies', {})
-        _timeout = task_params.get('timeout', 60)
-        _params = task_params.get('params')
-        _retries = task_params.get('retries', 0)
-
-        params_get, params_post = None, None
-        if _method == "GET":
-            params_get = _params
-        if _method == "POST":
-            params_post = _params
+        _host = urlsplit(_url).hostname
 
         logging.info(f"{_id} : Task start")
 
-        status = HttpCheckStatus.OK
         result = {"_id": _id}
+        failed_proxies = []  # the next attempt goes through another proxy if possible
+        attempt = 0
         while True:
-            try:
+            if self._breakers.allow(_host):
+                status, http_code, retry_after = await self.fetch_once(_id, _url, spec, cached, result,
+                                                                       failed_proxies)
+                if status == HttpCheckStatus.OK:
+                    return result
+            else:
+                status, http_code, retry_after = HttpCheckStatus.CIRCUIT_OPEN, None, None
+                result.pop("proxy", None)
+                metrics.FETCH_SHORT_CIRCUITS.inc()
+                logging.warning(f"{_id} : Circuit breaker of {_host} is open")
+
+            _proxy = result.get("proxy")
+            if attempt >= spec.retries or not self._retry_policy.retryable(status, http_code, _proxy is not None):
+                break
+            attempt += 1
+            _proxy_class = metrics.proxy_class(_proxy, _url.lower().startswith("https"), spec.premium_proxy)
+            metrics.FETCH_RETRIES.labels(status.name.lower(), _proxy_class).inc()
+            logging.error(f"{_id} : Error while fetching {_url} : {status}")
+            # open breaker of the host is waited out like Retry-After
+            await self.backoff(self._retry_policy.delay(attempt, max(retry_after or 0.0,
+                                                                     self._breakers.retry_in(_host))))
 
-                _proxies = None
-                if not task_params.get('no_proxy', False):
-                    is_https = _url.lower().startswith("https")
-                    avail_proxies = [p for p in self._proxies if p["https"] == is_https]
-                    if task_params.get("premium_proxy", False):
-                        avail_proxies = self._proxies_premium
-                    if len(avail_proxies):
-                        proxy = avail_proxies[random.randint(0, len(avail_proxies) - 1)]
-                        _proxies = {
-                            'http': f'http://{proxy.get("proxy_server")}',
-                            'https': f'http://{proxy.get("proxy_server")}',
-                        }
-                        result.update({"proxy": proxy.get('proxy_server')})
-                        logging.info(f"{str(doc.get('_id'))} : use proxy {proxy.get('proxy_server')}")
+        logging.info(f"{_id} : Task error : {status.value}")
+        result.update({"status": TaskStatus.ERROR.value, "error_reason": status.value, "update_ts": datetime.datetime.utcnow() })
+        return result
 
+    async def fetch_once(self, _id: str, _url: str, spec: RequestSpec, cached: dict, result: dict,
+                         failed_proxies: list):
+        """
+        Single download attempt - its outcome is fed to concurrency limits, proxy pool and circuit breakers
+        :param _id: task id
+        :param _url: URL to download
+        :param spec: compiled task options
+        :param cached: stale cached copy to revalidate
+        :param result: task result, updated with proxy and fetched fields
+        :param failed_proxies: proxies to avoid, extended with the proxy if the next attempt should rotate
+        :return: tuple (fetching status, HTTP response code, seconds requested by Retry-After)
+        """
+        _headers = spec.request_headers(self._ua_list, cached)
+        _host = urlsplit(_url).hostname
+        _https = _url.lower().startswith("https")
+        _premium = spec.premium_proxy
+        _proxy, _proxy_class, ts1 = None, "direct", None
+        result.pop("proxy", None)
+        try:
+            if not spec.no_proxy:
+                ts_pick = time.monotonic()
+                _proxy = self._proxy_pool.pick(_https, _premium, failed_proxies)
+                _proxy_class = metrics.proxy_class(_proxy, _https, _premium)
+                metrics.PROXY_SELECT.labels(_proxy_class).observe(time.monotonic() - ts_pick)
+                if _proxy:
+                    result.update({"proxy": _proxy})
+                    logging.info(f"{_id} : use proxy {_proxy}")
+
+            async with self._concurrency.host_slot(_host):
                 ts1 = time.monotonic()
-                r = requests.request(_method, url=_url,
-                                     params=params_get, data=params_post,
-                                     headers=_headers, cookies=_cookies,
-                                     timeout=_timeout, proxies=_proxies)
-                r.raise_for_status()
+                async with self._engine.stream(spec.method, _url,
+                                               params=spec.params_get, data=spec.params_post,
+                                               headers=_headers,
+                                               timeout=spec.timeout, proxy=_proxy,
+                                               max_bytes=spec.max_bytes,
+                                               http2=_proxy is None or _premium) as r:
+                    metrics.FETCH_RESPONSES.labels(r.http_version, _proxy_class).inc()
+                    now = datetime.datetime.utcnow()
+                    if r.status_code == 304 and cached:
+                        # not modified - cached body is reused with freshness from the new response
+                        headers = {"etag": cached.get("etag"), "last-modified": cached.get("last_modified"),
+                                   "cache-control": cached.get("cache_control"),
+                                   "expires": cached.get("expires")}
+                        headers.update((k.lower(), v) for k, v in r.headers.items())
+                        stored = {**{name: cached.get(name) for name in BODY_FIELDS},
+                                  **cache_validators(headers, now), "cache": True, "revalidated": True}
+                        await self._blobs.touch(cached.get("blob"))
+                    else:
+                        # store in cache
+                        stored = await self.store_body(r, spec.max_bytes)
+                        stored.update(cache_validators(r.headers, now))
+                    if cached:
+                        metrics.REVALIDATION.labels("not_modified" if stored.get("revalidated") else "modified") \
+                            .inc()
                 ts2 = time.monotonic()
+            self._concurrency.record(_host, ts2 - ts1, HttpCheckStatus.OK)
+            self._breakers.record(_host, True)
+            metrics.FETCH_ATTEMPT.labels("ok", _proxy_class).observe(ts2 - ts1)
+            if _proxy:
+                self._proxy_pool.record(_proxy, True, ts2 - ts1)
+
+            result.update({"status": TaskStatus.DONE.value, **stored,
+                           "download_time": ts2 - ts1, "update_ts": datetime.datetime.utcnow() })
+            logging.info(f"{_id} : Task done")
+            return HttpCheckStatus.OK, None, None
+
+        except Exception as err:
+            status = classify_error(err, via_proxy=_proxy is not None)
+            http_code = error_http_code(err)
+            if ts1 is not None:
+                self._concurrency.record(_host, time.monotonic() - ts1, status, http_code)
+                metrics.FETCH_ATTEMPT.labels(status.name.lower(), _proxy_class) \
+                    .observe(time.monotonic() - ts1)
+                host_ok = host_outcome(status, http_code, _proxy is not None)
+                if host_ok is not None:
+                    self._breakers.record(_host, host_ok)
+            if _proxy:
+                self._proxy_pool.record(_proxy, status == HttpCheckStatus.BODY_TOO_LARGE or
+                                        (status == HttpCheckStatus.HTTP_ERROR and
+                                         http_code not in PROXY_FAILURE_HTTP_CODES))
+                if self._retry_policy.rotate(status, http_code):
+                    failed_proxies.append(_proxy)
+            logging.exception(str(err))
+            return status, http_code, error_retry_after(err)
+
+    async def backoff(self, delay: float):
+        """
+        Wait before repeated attempt without holding worker slot
+        :param delay: seconds to wait
+        :return:
+        """
+        metrics.RETRY_BACKOFF.observe(delay)
+        self._concurrency.release()
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self._concurrency.acquire_nowait()  # slot is returned by grab_data
+            raise
+        await self.acquire_slot()
+
+    async def acquire_slot(self):
+        """
+        Take worker slot back after waiting without it
+        :return:
+        """
+        try:
+            await self._concurrency.acquire()
+        except asyncio.CancelledError:
+            self._concurrency.acquire_nowait()  # slot is returned by grab_data
+            raise
 
-                # store in cache
-                filename = f"{_id}.cache"
-                with open(os.path.join(CACHE_DIR, filename), "wb") as fd:
-                    fd.write(r.content)
-
-                result.update({"status": TaskStatus.DONE.value,
-                               "download_time": ts2 - ts1, "update_ts": datetime.datetime.utcnow() })
-                logging.info(f"{_id} : Task done")
-                return result
-
-            except requests.exceptions.HTTPError as err:
-                status = HttpCheckStatus.HTTP_ERROR
-                logging.exception(str(err))
-            except requests.exceptions.ProxyError as err:
-                status = HttpCheckStatus.HTTP_PROXY_ERROR
-                logging.exception(str(err))
-            except requests.exceptions.InvalidProxyURL as err:
-                status = HttpCheckStatus.HTTP_PROXY_INVALID_URL
-                logging.exception(str(err))
-            except requests.exceptions.ConnectionError as err:
-                status = HttpCheckStatus.CONN_ERROR
-                logging.exception(str(err))
-            except requests.exceptions.SSLError as err:
-                status = HttpCheckStatus.SSL_ERROR
-                logging.exception(str(err))
-            except requests.exceptions.Timeout as err:
-                status = HttpCheckStatus.TIMEOUT_ERROR
-                logging.exception(str(err))
-            except Exception as err:
-                status = HttpCheckStatus.GENERAL_ERROR
-                logging.exception(str(err))
-
-            if status != HttpCheckStatus.OK and _retries > 0:
-                _retries -= 1
-                logging.error(f"{_id} : Error while fetching {_url} : {status}")
-                continue
-
-            break
-
-        logging.info(f"{_id} : Task error : {status.value}")
-        result.update({"status": TaskStatus.ERROR, "error_reason": status.value, "update_ts": datetime.datetime.utcnow() })
-        return result
-
-    async def find_in_cache(self, curr_id, url, params):
+    async def store_body(self, r, max_bytes: int = None) -> dict:
+        """
+        Stream response body to blob store - compressed with CACHE_COMPRESSION
+        or kept as received if it is already compressed
+        :param r: streamed response
+        :param max_bytes: max body size
+        :return: body fields of the task (blob, size, encoding, content_encoding, content_type)
+        """
+        content_encoding = r.headers.get("content-encoding", "").strip().lower() or "identity"
+        content_type = r.headers.get("content-type")
+        compression = self._blobs.compression
+        if compression and content_type and content_type.lower().startswith(CACHE_COMPRESSED_TYPES):
+            compression = None
+
+        if content_encoding == (compression or "identity") or content_encoding not in CACHE_DECODABLE_ENCODINGS:
+            writer, chunks = self._blobs.writer(content_encoding), r.aiter_raw()
+        else:
+            writer, chunks = self._blobs.writer(compression=compression), r.aiter_bytes()
+        try:
+            async for chunk in limit_stream(chunks, max_bytes):
+                await writer.write(chunk)
+            digest, size = await writer.commit()
+        except BaseException:
+            writer.abort()
+            raise
+        return {"blob": digest, "size": size, "encoding": writer.encoding,
+                "content_encoding": content_encoding, "content_type": content_type}
+
+    async def find_in_cache(self, curr_id, fingerprint, revalidate: bool = False):
         """
-        Finding objects in cache - comparing URL, HTTP method and params
+        Finding objects in cache - newest finished task with the same request fingerprint
         :param curr_id: current object id
-        :param url: url of data
-        :param params: params of task
-        :return: None if not found object in cache, otherwise document id of cached document
+        :param fingerprint: request fingerprint of current task
+        :param revalidate: skip responses which must not be stored (Cache-Control: no-store)
+        :return: None if not found object in cache, otherwise cached document (_id, body and validator fields)
         """
         logging.info(f"{curr_id} : Looking in cache...")
-        params = json.loads(params)
-        condition = {"url": url, "status": TaskStatus.DONE.value}
-        items = await self._db[COLLECTION_TASKS] \
-            .find(condition) \
-            .sort([('_id', -1)]) \
-            .limit(1).to_list(None)
-        if len(items) == 0:
+        ts1 = time.monotonic()
+        item = await self._storage.find_cached(fingerprint, list(BODY_FIELDS + VALIDATOR_FIELDS), revalidate)
+        if item is not None and not os.path.exists(self._blobs.path(item.get("blob"))):
+            item = None  # blob evicted by compaction after the record was read or re-registered
+        metrics.CACHE_LOOKUP.labels("miss" if item is None else "hit").observe(time.monotonic() - ts1)
+        if item is None:
             return None
 
-        for item in items:
-            task = json.loads(item.get('task'))
-            if task.get('method') == params.get('method'):
-                # check params
-                diff: DeepDiff = DeepDiff(task.get('params'), params.get('params'))
-                if diff.to_dict() == {}:
-                    object_id = item.get("_id")
-                    fn = os.path.join(CACHE_DIR, f"{object_id}.cache")
-                    if os.path.exists(fn):
-                        dest_fn = os.path.join(CACHE_DIR, f"{curr_id}.cache")
-                        shutil.copy(fn, dest_fn)
-                        return object_id
-
-        return None
+        await self._blobs.touch(item.get("blob"))
+        return item
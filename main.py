@@ -1,15 +1,23 @@
 import asyncio
 import logging
+import tempfile
 
 import uvicorn
-from fastapi import FastAPI, Response, status, HTTPException
-from fastapi.responses import JSONResponse, FileResponse
-from fastapi_utils.tasks import repeat_every
+from fastapi import FastAPI, Query, Request, Response, status, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
+import metrics
+from blob_response import BlobResponse, accepts_encoding, parse_range
+from blob_store import BlobStore, make_decompressor, read_decoded
+from export import EXPORT_FORMATS, export_page, ndjson_archive, tar_archive
 from fetch_worker import FetchWorker
-from model import FetchManyUrl, FetchOneUrl, TaskIds
+from model import FetchManyUrl, FetchOneUrl, TaskExport, TaskIds, TaskSelection
 from proxy_manager import ProxyManager
+from storage import open_storage
+from task_events import TaskEvents
 from utils import *
+from worker import maintain_cache, maintain_proxies, maintain_tasks
 
 # Apply configuration for logger
 log_format = "%(asctime)s:%(levelname)s:%(filename)s:%(message)s"
@@ -23,27 +31,34 @@ logging.basicConfig(
     datefmt="%Y-%m-%dT%H:%M:%S%z"
 )
 
-db_conn = get_db_conn()  # connect to database
-proxy_manager = ProxyManager(db_conn, PROXY_FILE)  # initialization of Proxy Manager
-fetch_worker = FetchWorker(db_conn, 5)  # initialization of fetching module
+storage = open_storage()  # connect to database (STORAGE)
+proxy_manager = ProxyManager(storage, PROXY_FILE, extra_list_files=PROXY_EXTRA_FILES,
+                             premium_list_file=PROXY_PREMIUM_FILE)  # initialization of Proxy Manager
+task_events = TaskEvents(storage)  # notifications of finished tasks for waiting clients
+fetch_worker = FetchWorker(storage, MAX_FETCH_WORKERS, events=task_events)  # initialization of fetching module
+blob_store = BlobStore(storage)  # store of cached bodies
 
 app = FastAPI(description="API for fetching URLs")
 
 
 @app.on_event("startup")
-@repeat_every(seconds=3600 * 3)
-async def update_proxies():
-    await asyncio.sleep(5)
-    await proxy_manager.fetch_from_github()  # upload local assets with proxy list
-    asyncio.create_task(proxy_manager.set())
+async def start_worker():
+    await storage.prepare()  # create tables (collections) and indexes
+    await blob_store.check_shared()  # cached bodies are read from the cache shared by all nodes
+    asyncio.create_task(task_events.run())  # deliver tasks finished by separate worker processes
+    if not API_RUN_WORKER:
+        return  # tasks are fetched by separate worker processes (worker.py)
+    asyncio.create_task(fetch_worker.run())  # start worker for fetch data
+    asyncio.create_task(maintain_proxies(proxy_manager))  # update and check proxies
+    asyncio.create_task(maintain_cache(blob_store))  # keep cached bodies within disk budget
+    asyncio.create_task(maintain_tasks(storage))  # delete finished tasks older than TASK_RETENTION
 
 
-@app.on_event("startup")
-@repeat_every(seconds=3600)
-async def check_proxies():
-    asyncio.create_task(fetch_worker.run())  # start worker for fetch data
-    await asyncio.sleep(15)
-    asyncio.create_task(proxy_manager.check())  # check proxies availability
+@app.on_event("shutdown")
+async def stop_worker():
+    if API_RUN_WORKER:
+        await fetch_worker.stop()  # finish in-flight tasks, return the rest to the queue
+    await storage.close()
 
 
 @app.get("/proxies", description="Get list of proxy servers")
@@ -53,61 +68,208 @@ async def get_proxies(alive: int = 0):
     - **alive**: if positive - returning only alive proxies
     - **return**: list of proxies
     """
-    if alive > 0:  # you can grab only alive servers
-        condition = {"status_check": HttpCheckStatus.OK.value}
-    else:
-        condition = {}
-
-    proxies = await db_conn[COLLECTION_PROXIES]. \
-        find(condition, {"_id": 0, "response": 0}). \
-        sort([('latency', 1)]).to_list(None)
+    # premium proxies contain credentials, you can grab only alive servers
+    proxies = await storage.find_proxies(alive=alive > 0, premium=False)
     return proxies
 
-@app.get("/get_object/{task_id}", response_class=FileResponse)
-async def get_object(task_id: str):
+
+@app.get("/worker_stats", description="Get fetch worker concurrency limits and queue depth")
+async def worker_stats():
+    """
+    Get fetch worker stats
+    - **return**: current in-flight limits (process-wide and per host), waiting tasks and queue depth
+    """
+    stats = fetch_worker.stats()
+    stats["queue"] = await storage.count_tasks(TaskStatus.NEW.value)
+    return stats
+
+
+@app.get("/metrics", description="Get pipeline metrics in Prometheus text format")
+async def get_metrics():
+    """
+    Get metrics for Prometheus scraper
+    - **return**: counters and latency histograms of fetching stages, worker slots and queue depth
+    """
+    if API_RUN_WORKER:
+        metrics.update_worker(fetch_worker.stats())  # worker processes report their own state
+    metrics.update_queue(await storage.count_tasks(TaskStatus.NEW.value))
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/get_object/{task_id}", response_class=BlobResponse)
+async def get_object(task_id: str, request: Request):
     """
-    Get object for the task
+    Get object for the task - with original content type, ETag validation and byte ranges.
+    Stored compressed body is sent as-is if client accepts its encoding, otherwise it is decoded
     :param task_id: ID of the task
+    :param request: request with conditional and Range headers
     :return: if object exists content is returned , otherwise - returns 404
     """
     try:
-        filename = os.path.join(CACHE_DIR, f"{task_id}.cache")
-        return FileResponse(filename)
+        task = await storage.get_task(ObjectId(task_id), list(BODY_FIELDS))
     except Exception as exc:
         raise HTTPException(status_code=404, detail=str(exc))
+    task = task or {}
+    if task.get("blob"):
+        filename = blob_store.path(task.get("blob"))
+        etag = task.get("blob")
+    else:
+        filename = os.path.join(CACHE_DIR, f"{task_id}.cache")  # objects stored before blob store
+        etag = None
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="object not found")
+    if etag is None:
+        etag = f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+    headers = {}
+    encoding = task.get("encoding", "identity")
+    decode = encoding != "identity" and make_decompressor(encoding) is not None and \
+        not accepts_encoding(request.headers.get("accept-encoding", ""), encoding)
+    if encoding != "identity":
+        headers["Vary"] = "Accept-Encoding"
+        if decode:
+            etag += "-identity"
+        else:
+            headers["Content-Encoding"] = encoding  # body is stored compressed
+    headers["ETag"] = f'"{etag}"'
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or headers["ETag"] in if_none_match):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    media_type = task.get("content_type")
+    if decode:
+        # decoded size is unknown, ranges are not supported
+        return StreamingResponse(read_decoded(filename, encoding), media_type=media_type, headers=headers)
+
+    headers["Accept-Ranges"] = "bytes"
+    byte_range = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if byte_range and (not if_range or if_range.strip() == headers["ETag"]):
+        try:
+            byte_range = parse_range(byte_range, stat.st_size)
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                                headers={"Content-Range": f"bytes */{stat.st_size}"})
+        if byte_range:
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+            return BlobResponse(filename, start, end, status_code=status.HTTP_206_PARTIAL_CONTENT,
+                                headers=headers, media_type=media_type)
+    return BlobResponse(filename, headers=headers, media_type=media_type)
 
 
 @app.get("/get_task/{task_id}", status_code=status.HTTP_200_OK)
-async def get_task(task_id: str):
+async def get_task(task_id: str, wait: float = Query(0, ge=0, le=TASK_WAIT_MAX)):
     """
     Get status of the task
     :param task_id: ID of the task
-    :return: if task exists document from mongo is returned, otherwise - returns 404
+    :param wait: max seconds to wait until the task is finished (long-poll)
+    :return: if task exists its document is returned, otherwise - returns 404
     """
-    condition = {"_id": ObjectId(task_id)}
-    task = await db_conn[COLLECTION_TASKS]. \
-        find_one(condition, {"_id": 0})
+    task_id = ObjectId(task_id)
+    if wait:
+        async with task_events.subscribe([task_id]) as subscription:
+            await subscription.wait(wait)
+    task = await storage.get_task(task_id)
     if task:
+        task.pop("_id")
         return task
     raise HTTPException(status_code=404, detail="task not found")
 
 
 @app.post("/get_tasks", status_code=status.HTTP_200_OK)
-async def get_tasks(task_data: TaskIds, response: Response):
+async def get_tasks(task_data: TaskIds, response: Response, wait: float = Query(0, ge=0, le=TASK_WAIT_MAX)):
     """
     Get tasks status
     - **task_data**: TaskIds object
     - **response**:
+    - **wait**: max seconds to wait until all tasks are finished (long-poll)
     - **return** JSON with ObjectIDs
     """
-    condition = {"_id": {"$in": [ObjectId(t) for t in task_data.ids]}}
-    tasks = await db_conn[COLLECTION_TASKS]. \
-        find(condition).to_list(None)
+    ids = [ObjectId(t) for t in task_data.ids]
+    if wait:
+        async with task_events.subscribe(ids) as subscription:
+            await subscription.wait(wait)
+    tasks = await storage.find_tasks(ids)
     if tasks is None or len(tasks)==0:
         raise HTTPException(status_code=404, detail="tasks not found")
     return JSONEncoder().encode(tasks)
 
 
+@app.post("/export_tasks", status_code=status.HTTP_200_OK)
+async def export_tasks(task_data: TaskExport):
+    """
+    Export page of tasks metadata
+    - **task_data**: TaskExport object - task ids or batch_id, returned fields, cursor of the page and page size
+    - **return** JSON {"tasks": [...], "next": cursor of the next page or null}
+    """
+    ids = None if task_data.batch_id else [ObjectId(t) for t in task_data.ids]
+    tasks, last_id = await export_page(storage, ids, task_data.batch_id, task_data.fields,
+                                       ObjectId(task_data.after) if task_data.after else None, task_data.limit)
+    return Response(dumps({"tasks": tasks, "next": last_id}), media_type="application/json")
+
+
+@app.post("/export_objects", status_code=status.HTTP_200_OK)
+async def export_objects(task_data: TaskSelection, format: str = Query("tar", regex="^(tar|ndjson)$")):
+    """
+    Export cached bodies of tasks as one archive streamed while it is built
+    - **task_data**: TaskSelection object - task ids or batch_id
+    - **format**: "tar" - bodies as stored (compressed ones with .gz/.zst suffix) with task metadata
+      in UNICORN.* PAX headers, "ndjson" - task metadata with base64 body per line
+    - **return** archive stream
+    """
+    ids = None if task_data.batch_id else [ObjectId(t) for t in task_data.ids]
+    archive = tar_archive if format == "tar" else ndjson_archive
+    return StreamingResponse(archive(storage, blob_store, ids, task_data.batch_id), media_type=EXPORT_FORMATS[format],
+                             headers={"Content-Disposition": f'attachment; filename="export.{format}"'})
+
+
+async def task_event_stream(ids: list):
+    """
+    Server-sent events with tasks finished, in order of finishing
+    :param ids: list of task ObjectIds
+    :return: iterator of "task" events with stored fields of the task, "missing" events for tasks not found,
+        "end" event when all tasks are finished
+    """
+    async with task_events.subscribe(ids) as subscription:
+        while subscription.pending:
+            event = await subscription.get(TASK_EVENTS_KEEPALIVE)
+            if event is None:
+                yield ": keep-alive\n\n"
+                continue
+            task_id, result = event
+            if result is None:
+                yield f"event: missing\ndata: {JSONEncoder().encode({'task_id': task_id})}\n\n"
+                continue
+            yield f"event: task\ndata: {JSONEncoder().encode({'task_id': task_id, **result})}\n\n"
+    yield "event: end\ndata: {}\n\n"
+
+
+@app.get("/task_events", description="Stream finished tasks as server-sent events")
+async def get_task_events(ids: str):
+    """
+    Stream status of tasks - usable with EventSource
+    - **ids**: comma separated task IDs
+    - **return** event stream, see task_event_stream
+    """
+    return StreamingResponse(task_event_stream([ObjectId(t) for t in ids.split(",") if t]),
+                             media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.post("/task_events", description="Stream finished tasks as server-sent events")
+async def post_task_events(task_data: TaskIds):
+    """
+    Stream status of tasks - for batches too large for query string
+    - **task_data**: TaskIds object
+    - **return** event stream, see task_event_stream
+    """
+    return StreamingResponse(task_event_stream([ObjectId(t) for t in task_data.ids]),
+                             media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
 @app.post("/fetch_one", status_code=status.HTTP_200_OK)
 async def fetch_url(fetch_data: FetchOneUrl, response: Response):
     """
@@ -116,13 +278,11 @@ async def fetch_url(fetch_data: FetchOneUrl, response: Response):
     - **response**:
     - **return** JSON with ObjectID
     """
-    task = json.dumps(fetch_data.dict(exclude={'url'}))
     url = fetch_data.url
-    res = await db_conn[COLLECTION_TASKS].insert_one(
-        {"url": url, "task": task, "insert_ts": datetime.datetime.utcnow(),
-         "status": TaskStatus.NEW.value,
-         "cache": False, "update_ts": datetime.datetime.utcnow(), "download_time": 0.0})
-    result = {"url": url, "task_id": str(res.inserted_id)}
+    task_id, = await storage.insert_tasks([
+        make_task(url, fetch_data.dict(exclude={'url'}), datetime.datetime.utcnow(),
+                  priority=TASK_PRIORITY_INTERACTIVE)])
+    result = {"url": url, "task_id": str(task_id)}
     return JSONResponse(content=result, status_code=200)
 
 
@@ -134,17 +294,98 @@ async def fetch_urls(fetch_data: FetchManyUrl, response: Response):
     - **response**:
     - **return** JSON with ObjectID
     """
-    result = []
-    task = json.dumps(fetch_data.dict(exclude={'urls'}))
-    for url in fetch_data.urls:
-        res = await db_conn[COLLECTION_TASKS].insert_one(
-            {"url": url, "task": task, "insert_ts": datetime.datetime.utcnow(),
-             "status": TaskStatus.NEW.value,
-             "cache": False, "update_ts": datetime.datetime.utcnow(), "download_time": 0.0})
-        result.append({"url": url, "task_id": str(res.inserted_id)})
+    task_dict = fetch_data.dict(exclude={'urls'})
+    task_key = options_key(task_dict)
+    now = datetime.datetime.utcnow()
+    docs = [make_task(url, task_dict, now, task_key) for url in fetch_data.urls]
+    ids = await storage.insert_tasks(docs)
+    result = [{"url": url, "task_id": str(task_id)}
+              for url, task_id in zip(fetch_data.urls, ids)]
     return JSONResponse(content=result, status_code=200)
 
 
+async def insert_stream_chunk(chunk, out):
+    """
+    Insert chunk of validated tasks and write their ids as NDJSON lines
+    :param chunk: list of FetchOneUrl objects
+    :param out: file for response lines
+    :return:
+    """
+    now = datetime.datetime.utcnow()
+    docs = [make_task(f.url, f.dict(exclude={'url'}), now) for f in chunk]
+    ids = await storage.insert_tasks(docs)
+    for f, task_id in zip(chunk, ids):
+        out.write(json.dumps({"url": f.url, "task_id": str(task_id)}).encode() + b"\n")
+    chunk.clear()
+
+
+@app.post("/fetch_stream", status_code=status.HTTP_200_OK)
+async def fetch_stream(request: Request):
+    """
+    Fetch URLs sent as stream of lines, without limit of URLs number
+    - **body**: NDJSON with FetchOneUrl objects or plain text with one URL per line
+    - **query params**: default options for every line (method, retries, no_proxy, premium_proxy, use_cache, timeout,
+      user_agent, priority, client_id, batch_id)
+    - **return** NDJSON with {"url", "task_id"} for every accepted line and {"line", "error"} for rejected ones
+    """
+    defaults = {k: v for k, v in request.query_params.items() if k in STREAM_DEFAULT_OPTIONS}
+    out = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    chunk, line_no, buffer = [], 0, b""
+    skip = False  # rest of too long line is discarded up to the next newline
+
+    def reject(error: str):
+        out.write(json.dumps({"line": line_no, "error": error}).encode() + b"\n")
+
+    async def process(line: bytes):
+        nonlocal line_no
+        line_no += 1
+        line = line.strip()
+        if not line:
+            return
+        if len(line) > STREAM_MAX_LINE:
+            reject("line too long")
+            return
+        try:
+            if line.startswith(b"{"):
+                fetch_data = FetchOneUrl(**{**defaults, **json.loads(line)})
+            else:
+                fetch_data = FetchOneUrl(url=line.decode(), **defaults)
+        except (ValueError, UnicodeDecodeError) as exc:
+            reject(str(exc))
+            return
+        chunk.append(fetch_data)
+        if len(chunk) >= STREAM_CHUNK_SIZE:
+            await insert_stream_chunk(chunk, out)
+
+    async for data in request.stream():
+        buffer += data
+        lines = buffer.split(b"\n")
+        buffer = lines.pop()
+        for line in lines:
+            if skip:
+                skip = False  # tail of too long line
+            else:
+                await process(line)
+        if skip:
+            buffer = b""
+        elif len(buffer) > STREAM_MAX_LINE:
+            # rejected without waiting for its end, tasks of previous lines are already inserted
+            line_no += 1
+            reject("line too long")
+            skip, buffer = True, b""
+    if not skip:
+        await process(buffer)
+    if chunk:
+        await insert_stream_chunk(chunk, out)
+
+    def read_result():
+        out.seek(0)
+        with out:
+            yield from out
+
+    return StreamingResponse(read_result(), media_type="application/x-ndjson")
+
+
 # run uvicorn server and start FastAPI app on port 8000 of localhost
 if __name__ == "__main__":
     uvicorn.run("main:app", host="127.0.0.1", port=8000, reload=True)
@@ -0,0 +1,80 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+# buckets in seconds, from local cache lookups up to slow downloads through proxies
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+FETCH_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+QUEUE_BUCKETS = (0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 3600.0, 4 * 3600.0)
+
+TASK_QUEUE_WAIT = Histogram("unicorn_task_queue_wait_seconds",
+                            "Time from task insert to claim by a worker", ["priority"], buckets=QUEUE_BUCKETS)
+TASK_DURATION = Histogram("unicorn_task_duration_seconds",
+                          "Time from dispatch of the task to stored result", ["outcome"], buckets=FETCH_BUCKETS)
+CACHE_LOOKUP = Histogram("unicorn_cache_lookup_seconds",
+                         "Time of looking for the task body in cache", ["result"], buckets=FAST_BUCKETS)
+PROXY_SELECT = Histogram("unicorn_proxy_select_seconds",
+                         "Time of choosing proxy for the request", ["proxy_class"], buckets=FAST_BUCKETS)
+FETCH_ATTEMPT = Histogram("unicorn_fetch_attempt_seconds",
+                          "Time of single download attempt including storing the body",
+                          ["outcome", "proxy_class"], buckets=FETCH_BUCKETS)
+FETCH_RESPONSES = Counter("unicorn_fetch_responses_total",
+                          "Responses received by negotiated HTTP version", ["http_version", "proxy_class"])
+REVALIDATION = Counter("unicorn_revalidations_total",
+                       "Conditional requests for stale cached responses", ["result"])
+FETCH_RETRIES = Counter("unicorn_fetch_retries_total",
+                        "Download attempts repeated after error", ["outcome", "proxy_class"])
+RETRY_BACKOFF = Histogram("unicorn_retry_backoff_seconds",
+                          "Time waited before repeated download attempt", buckets=FETCH_BUCKETS)
+FETCH_SHORT_CIRCUITS = Counter("unicorn_fetch_short_circuits_total",
+                               "Download attempts skipped because circuit breaker of the host is open")
+WRITE_BACK = Histogram("unicorn_write_back_seconds",
+                       "Time of single bulk write of buffered updates", ["operation"], buckets=FAST_BUCKETS)
+WRITE_BACK_OPS = Counter("unicorn_write_back_operations_total",
+                         "Buffered updates written to database", ["operation", "result"])
+PROXY_CHECK = Histogram("unicorn_proxy_check_seconds",
+                        "Time of single proxy check", ["outcome", "proxy_class"], buckets=FETCH_BUCKETS)
+PROXY_CHECK_BATCH = Histogram("unicorn_proxy_check_batch_seconds",
+                              "Time of checking batch of due proxies", buckets=QUEUE_BUCKETS)
+
+WORKER_SLOTS_LIMIT = Gauge("unicorn_worker_slots_limit", "Current limit of in-flight tasks")
+WORKER_SLOTS_IN_FLIGHT = Gauge("unicorn_worker_slots_in_flight", "Tasks being fetched")
+WORKER_SLOTS_WAITING = Gauge("unicorn_worker_slots_waiting", "Tasks waiting for free slot")
+WORKER_BUFFERED = Gauge("unicorn_worker_buffered_tasks", "Claimed tasks waiting in politeness scheduler")
+WORKER_LEASED = Gauge("unicorn_worker_leased_tasks", "Tasks leased by the worker")
+QUEUE_DEPTH = Gauge("unicorn_queue_depth", "Tasks waiting in database queue")
+BREAKERS_OPEN = Gauge("unicorn_breakers_open", "Hosts short-circuited by circuit breaker")
+
+
+def proxy_class(proxy: str = None, https: bool = False, premium: bool = False) -> str:
+    """Label of the proxy used for request
+    :param proxy: proxy server or None for direct connection
+    :param https: proxy is used for HTTPS URLs
+    :param premium: proxy is premium proxy
+    :return: "direct", "premium", "https" or "http"
+    """
+    if not proxy:
+        return "direct"
+    if premium:
+        return "premium"
+    return "https" if https else "http"
+
+
+def update_worker(stats: dict):
+    """Set gauges of worker state before scrape
+    :param stats: FetchWorker.stats() result
+    :return:
+    """
+    concurrency = stats.get("concurrency", {})
+    WORKER_SLOTS_LIMIT.set(concurrency.get("limit", 0))
+    WORKER_SLOTS_IN_FLIGHT.set(concurrency.get("in_flight", 0))
+    WORKER_SLOTS_WAITING.set(concurrency.get("waiting", 0))
+    WORKER_BUFFERED.set(stats.get("scheduler", {}).get("buffered", 0))
+    WORKER_LEASED.set(stats.get("tasks", 0))
+    BREAKERS_OPEN.set(stats.get("breakers", {}).get("open", 0))
+
+
+def update_queue(queue_depth: int):
+    """Set gauge of database queue before scrape
+    :param queue_depth: number of NEW tasks
+    :return:
+    """
+    QUEUE_DEPTH.set(queue_depth)
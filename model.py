@@ -3,6 +3,8 @@ from typing import List, Dict, Optional
 import validators
 from pydantic import BaseModel, validator, Field
 
+from consts import EXPORT_MAX_PAGE, EXPORT_PAGE_SIZE, TASK_PRIORITY_MAX
+
 """
  Input data organized with Pydantic library
  Model based approach
@@ -23,6 +25,18 @@ class FetchDataBase(BaseModel):
     premium_proxy: bool = False       # use with option no_proxy for using own proxy
     use_cache: bool = False           # if you want use cache set to True
     timeout: int = 60                 # connection timeout
+    fingerprint_headers: List[str] = None  # headers (or "cookie") distinguishing cached responses
+    rate_limit: float = Field(None, description="max requests per second to the domain", gt=0)
+    burst: int = Field(None, description="requests sent at once to idle domain", ge=1)
+    max_bytes: int = Field(None, description="max size of downloaded body in bytes", gt=0)
+    revalidate: bool = False          # with use_cache - serve only fresh cached copy, revalidate stale one
+    max_age: int = Field(None, description="max age in seconds of cached response served without revalidation", ge=0)
+    min_fresh: int = Field(None, description="min seconds cached response must stay fresh to be served", ge=0)
+    priority: int = Field(None, description="priority lane, higher is fetched first (default: interactive lane "
+                                            "for /fetch_one, bulk lane otherwise)", ge=0, le=TASK_PRIORITY_MAX)
+    client_id: str = Field(None, description="submitter - capacity of the lane is shared fairly among clients",
+                           max_length=100)
+    batch_id: str = Field(None, description="label of the batch, tasks can be exported by it", max_length=100)
 
     @validator("method")
     def method_validator(cls, method: str):
@@ -72,4 +86,20 @@ class TaskIds(BaseModel):
     """
     Class for setting tasks ID
     """
-    ids: List[str] = []         # list of ObjectIDs
\ No newline at end of file
+    ids: List[str] = []         # list of ObjectIDs
+
+
+class TaskSelection(TaskIds):
+    """
+    Class for selecting exported tasks - by ids or batch_id
+    """
+    batch_id: str = None        # export tasks of the batch instead of ids
+
+
+class TaskExport(TaskSelection):
+    """
+    Class for paginated export of tasks - selected by ids or batch_id
+    """
+    fields: List[str] = None    # returned fields, all if not set
+    after: str = None           # "next" value returned with previous page
+    limit: int = Field(EXPORT_PAGE_SIZE, description="max number of tasks in page", ge=1, le=EXPORT_MAX_PAGE)
@@ -0,0 +1,274 @@
+import logging
+
+import pymongo
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from consts import *
+from storage import FINISHED_STATUSES, Storage
+
+
+def _bson_ts(ts):
+    # datetimes are stored with millisecond precision
+    return ts.replace(microsecond=ts.microsecond // 1000 * 1000) if ts is not None else None
+
+
+class MongoStorage(Storage):
+    """
+    Storage in MongoDB - tasks, proxies and blobs collections
+    """
+
+    def __init__(self, db):
+        """Init storage
+        :param db: pointer to database (Motor)
+        """
+        self._db = db
+
+    async def prepare(self):
+        colls = await self._db.list_collection_names()
+        if not COLLECTION_TASKS in colls:
+            # regular collection - leased documents grow, what is not allowed in capped collections,
+            # finished tasks are deleted after TASK_RETENTION
+            await self._db.create_collection(COLLECTION_TASKS)
+        else:
+            options = await self._db[COLLECTION_TASKS].options()
+            if options.get("capped"):
+                logging.warning(f"Collection {COLLECTION_TASKS} is capped, task leases require regular collection")
+        tasks = self._db[COLLECTION_TASKS]
+        await tasks.create_index([("status", 1), ("_id", 1)])
+        await tasks.create_index([("status", 1), ("priority", -1), ("client_id", 1), ("_id", 1)])
+        await tasks.create_index([("batch_id", 1), ("_id", 1)], sparse=True)
+        # tasks inserted before priority lanes go to the bulk lane
+        await tasks.update_many(
+            {"status": TaskStatus.NEW.value, "priority": {"$exists": False}},
+            {"$set": {"priority": TASK_PRIORITY_BULK, "client_id": None}})
+        await tasks.create_index([("status", 1), ("lease_expire_ts", 1)])
+        await tasks.create_index([("fingerprint", 1), ("status", 1), ("_id", -1)])
+        await tasks.create_index([("blob", 1)], sparse=True)
+        await tasks.create_index([("update_ts", 1)])
+        await self._db[COLLECTION_BLOBS].create_index([("last_access_ts", 1)])
+
+        proxies = self._db[COLLECTION_PROXIES]
+        try:
+            await proxies.create_index("proxy_server", unique=True)
+        except pymongo.errors.OperationFailure:
+            # duplicates left by earlier syncs
+            duplicates = proxies.aggregate([
+                {"$group": {"_id": "$proxy_server", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+                {"$match": {"count": {"$gt": 1}}}])
+            async for dup in duplicates:
+                await proxies.delete_many({"_id": {"$in": dup["ids"][1:]}})
+            await proxies.create_index("proxy_server", unique=True)
+        await proxies.create_index([("next_check", 1), ("last_check", 1)])
+
+    async def close(self):
+        self._db.client.close()
+
+    # TASKS
+
+    async def insert_tasks(self, docs: list) -> list:
+        if len(docs) == 1:
+            res = await self._db[COLLECTION_TASKS].insert_one(docs[0])
+            return [res.inserted_id]
+        res = await self._db[COLLECTION_TASKS].insert_many(docs, ordered=True)
+        return res.inserted_ids
+
+    async def get_task(self, task_id, fields: list = None):
+        return await self._db[COLLECTION_TASKS].find_one({"_id": task_id}, self._projection(fields))
+
+    async def find_tasks(self, ids: list, fields: list = None, statuses: list = None) -> list:
+        condition = {"_id": {"$in": ids}}
+        if statuses is not None:
+            condition["status"] = {"$in": statuses}
+        return await self._db[COLLECTION_TASKS].find(condition, self._projection(fields)).to_list(None)
+
+    async def page_tasks(self, ids: list = None, batch_id: str = None, fields: list = None,
+                         after=None, limit: int = EXPORT_PAGE_SIZE) -> list:
+        condition = {"batch_id": batch_id} if batch_id else {"_id": {"$in": ids}}
+        if after is not None:
+            condition["_id"] = {**condition.get("_id", {}), "$gt": after}
+        return await self._db[COLLECTION_TASKS] \
+            .find(condition, self._projection(fields)) \
+            .sort([("_id", 1)]) \
+            .limit(limit) \
+            .to_list(None)
+
+    async def count_tasks(self, status: int) -> int:
+        return await self._db[COLLECTION_TASKS].count_documents({"status": status})
+
+    async def queue_lanes(self) -> list:
+        # lanes and clients are read from index only
+        return await self._db[COLLECTION_TASKS].distinct("priority", {"status": TaskStatus.NEW.value})
+
+    async def lane_clients(self, priority) -> list:
+        return await self._db[COLLECTION_TASKS].distinct(
+            "client_id", {"status": TaskStatus.NEW.value, "priority": priority})
+
+    async def queued_tasks(self, priority, client_id, limit: int, exclude_ids: list = None,
+                           exclude_domains=None) -> list:
+        condition = {"status": TaskStatus.NEW.value, "priority": priority, "client_id": client_id}
+        if exclude_ids:
+            condition["_id"] = {"$nin": exclude_ids}
+        if exclude_domains:
+            condition["domain"] = {"$nin": list(exclude_domains)}
+        candidates = await self._db[COLLECTION_TASKS]. \
+            find(condition, {"_id": 1}).sort([("_id", 1)]).limit(limit).to_list(None)
+        return [c["_id"] for c in candidates]
+
+    async def lease_tasks(self, ids: list, worker_id: str, lease_expire_ts) -> list:
+        await self._db[COLLECTION_TASKS].update_many(
+            {"_id": {"$in": ids}, "status": TaskStatus.NEW.value},
+            {"$set": {"status": TaskStatus.INPROGRESS.value,
+                      "worker_id": worker_id, "lease_expire_ts": lease_expire_ts}})
+        return await self._db[COLLECTION_TASKS]. \
+            find({"_id": {"$in": ids}, "worker_id": worker_id, "status": TaskStatus.INPROGRESS.value}). \
+            sort([("priority", -1), ("_id", 1)]).to_list(None)
+
+    async def renew_leases(self, ids: list, worker_id: str, lease_expire_ts):
+        await self._db[COLLECTION_TASKS].update_many(
+            {"_id": {"$in": ids}, "worker_id": worker_id, "status": TaskStatus.INPROGRESS.value},
+            {"$set": {"lease_expire_ts": lease_expire_ts}})
+
+    async def expire_leases(self, now) -> int:
+        res = await self._db[COLLECTION_TASKS].update_many(
+            {"status": TaskStatus.INPROGRESS.value, "lease_expire_ts": {"$lt": now}},
+            {"$set": {"status": TaskStatus.NEW.value, "worker_id": None, "lease_expire_ts": None}})
+        return res.modified_count
+
+    async def release_tasks(self, ids: list, worker_id: str) -> int:
+        res = await self._db[COLLECTION_TASKS].update_many(
+            {"_id": {"$in": ids}, "worker_id": worker_id, "status": TaskStatus.INPROGRESS.value},
+            {"$set": {"status": TaskStatus.NEW.value, "worker_id": None, "lease_expire_ts": None}})
+        return res.modified_count
+
+    async def complete_tasks(self, entries: list) -> list:
+        # task re-leased after lost lease or already finished by another worker is not overwritten
+        operations = [pymongo.UpdateOne({"_id": task_id, "worker_id": worker_id,
+                                         "status": TaskStatus.INPROGRESS.value}, {"$set": fields})
+                      for (task_id, worker_id), fields in entries]
+        results, unmatched = await self._bulk_write(COLLECTION_TASKS, operations)
+        if unmatched:
+            # bulk result has only total count - written results are told apart by reading the tasks back
+            ids = [task_id for ((task_id, _), _), ok in zip(entries, results) if ok]
+            docs = await self._db[COLLECTION_TASKS] \
+                .find({"_id": {"$in": ids}}, {"worker_id": 1, "update_ts": 1}).to_list(None)
+            stored = {doc["_id"]: (doc.get("worker_id"), doc.get("update_ts")) for doc in docs}
+            results = [ok and stored.get(task_id) == (worker_id, _bson_ts(fields.get("update_ts")))
+                       for ((task_id, worker_id), fields), ok in zip(entries, results)]
+        return results
+
+    async def find_cached(self, fingerprint: str, fields: list, storable_only: bool = False):
+        condition = {"fingerprint": fingerprint, "status": TaskStatus.DONE.value, "blob": {"$ne": None}}
+        if storable_only:
+            condition["no_store"] = {"$ne": True}
+        return await self._db[COLLECTION_TASKS] \
+            .find_one(condition, dict.fromkeys(fields, 1), sort=[('_id', -1)])
+
+    async def purge_tasks(self, before) -> int:
+        res = await self._db[COLLECTION_TASKS].delete_many(
+            {"update_ts": {"$lt": before}, "status": {"$in": FINISHED_STATUSES}})
+        return res.deleted_count
+
+    async def watch_finished(self):
+        pipeline = [{"$match": {"operationType": "update",
+                                "updateDescription.updatedFields.status": {"$in": FINISHED_STATUSES}}}]
+        async with self._db[COLLECTION_TASKS].watch(pipeline) as stream:
+            async for change in stream:
+                yield change["documentKey"]["_id"], change["updateDescription"]["updatedFields"]
+
+    # RECORDS OF CACHED BLOBS
+
+    async def save_blobs(self, entries: list) -> list:
+        operations = []
+        for digest, fields in entries:
+            fields = dict(fields)
+            update = {"$set": {"last_access_ts": fields.pop("last_access_ts")}}
+            if fields:
+                update["$setOnInsert"] = fields
+            operations.append(pymongo.UpdateOne({"_id": digest}, update, upsert=bool(fields)))
+        results, _ = await self._bulk_write(COLLECTION_BLOBS, operations)
+        return results
+
+    async def iter_blobs(self):
+        cursor = self._db[COLLECTION_BLOBS] \
+            .find({}, {"size": 1, "last_access_ts": 1}) \
+            .sort([("last_access_ts", -1)])
+        async for blob in cursor:
+            yield blob
+
+    async def delete_blobs(self, digests: list):
+        await self._db[COLLECTION_BLOBS].delete_many({"_id": {"$in": digests}})
+        await self._db[COLLECTION_TASKS].update_many({"blob": {"$in": digests}}, {"$set": {"blob": None}})
+
+    # SETTINGS
+
+    async def init_setting(self, name: str, value: str) -> str:
+        try:
+            doc = await self._db[COLLECTION_SETTINGS].find_one_and_update(
+                {"_id": name}, {"$setOnInsert": {"value": value}}, upsert=True,
+                return_document=pymongo.ReturnDocument.AFTER)
+        except DuplicateKeyError:  # inserted by concurrent upsert
+            doc = await self._db[COLLECTION_SETTINGS].find_one({"_id": name})
+        return doc["value"]
+
+    # PROXIES
+
+    async def proxy_servers(self) -> set:
+        return set(await self._db[COLLECTION_PROXIES].distinct("proxy_server"))
+
+    async def sync_proxies(self, add: list, remove: list) -> tuple:
+        operations = [pymongo.UpdateOne({"proxy_server": doc["proxy_server"]}, {"$setOnInsert": doc}, upsert=True)
+                      for doc in add]
+        operations += [pymongo.DeleteOne({"proxy_server": server}) for server in remove]
+        if not operations:
+            return 0, 0
+        res = await self._db[COLLECTION_PROXIES].bulk_write(operations, ordered=False)
+        return res.upserted_count, res.deleted_count
+
+    async def due_proxies(self, now, limit: int) -> list:
+        condition = {"$or": [{"next_check": {"$lte": now}}, {"next_check": None}]}
+        return await self._db[COLLECTION_PROXIES]. \
+            find(condition, {"_id": 0, "proxy_server": 1, "https": 1, "premium": 1, "fail_count": 1}). \
+            sort([("next_check", 1), ("last_check", 1)]).limit(limit).to_list(None)
+
+    async def save_proxy_checks(self, results: list):
+        operations = [pymongo.UpdateOne({"proxy_server": server}, {"$set": fields}) for server, fields in results]
+        await self._db[COLLECTION_PROXIES].bulk_write(operations, ordered=False)
+
+    async def find_proxies(self, alive: bool = False, premium: bool = None) -> list:
+        condition = {}
+        if premium is not None:
+            condition["premium"] = True if premium else {"$ne": True}
+        if alive:
+            condition["status_check"] = HttpCheckStatus.OK.value
+        return await self._db[COLLECTION_PROXIES]. \
+            find(condition, {"_id": 0, "response": 0}). \
+            sort([('latency', 1)]).to_list(None)
+
+    @staticmethod
+    def _projection(fields: list = None):
+        return dict.fromkeys(fields, 1) if fields else None
+
+    async def _bulk_write(self, collection: str, operations: list) -> tuple:
+        """Unordered bulk write of single-document updates
+        :param collection: collection name
+        :param operations: list of UpdateOne operations
+        :return: tuple (list of bools - False for failed operations, number of operations which matched nothing)
+        """
+        failed, duplicates = set(), 0
+        try:
+            res = await self._db[collection].bulk_write(operations, ordered=False)
+            matched = res.matched_count + res.upserted_count
+        except BulkWriteError as exc:
+            # duplicate key errors of concurrent upserts mean the document exists
+            errors = exc.details.get("writeErrors", [])
+            failed = {e["index"] for e in errors if e.get("code") != 11000}
+            duplicates = len(errors) - len(failed)
+            matched = exc.details.get("nMatched", 0) + exc.details.get("nUpserted", 0)
+            if failed:
+                logging.error(f"Bulk write to {collection} : {len(failed)} operations failed")
+
+        # bulk result has no per-operation counts, unmatched updates are reported as a total
+        unmatched = len(operations) - len(failed) - duplicates - matched
+        if unmatched > 0:
+            logging.warning(f"Bulk write to {collection} : {unmatched} documents not matched")
+        return [i not in failed for i in range(len(operations))], max(unmatched, 0)
@@ -0,0 +1,177 @@
+import asyncio
+import collections
+import heapq
+import itertools
+import time
+
+from consts import *
+
+
+class TokenBucket:
+    """
+    Token bucket limiting request rate to single domain
+    """
+    __slots__ = ("rate", "burst", "tokens", "ts")
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.ts = time.monotonic()
+
+    def wait_time(self, now: float, rate: float = None, burst: int = None) -> float:
+        """Refill bucket and count time to the next token
+        :param now: current monotonic time
+        :param rate: new tokens per second
+        :param burst: new bucket capacity
+        :return: 0 if token is available, otherwise seconds to wait
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+        if rate:
+            self.rate = rate
+        if burst:
+            self.burst = burst
+            self.tokens = min(self.tokens, burst)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class DomainScheduler:
+    """
+    Buffer of claimed tasks released to fetching by per-domain token buckets -
+    while one domain is throttled tasks of other domains go ahead
+    """
+
+    def __init__(self, rate: float = POLITENESS_RATE, burst: int = POLITENESS_BURST,
+                 domain_buffer: int = POLITENESS_DOMAIN_BUFFER):
+        """Init scheduler
+        :param rate: default requests per second to one domain
+        :param burst: default number of requests sent at once to idle domain
+        :param domain_buffer: max number of buffered tasks of one domain
+        """
+        self._rate = rate
+        self._burst = burst
+        self._domain_buffer = domain_buffer
+        self._queues = {}  # domain -> deque of (doc, rate, burst, priority)
+        self._buckets = {}  # domain -> TokenBucket
+        self._ready = []  # heap of (time when domain may be checked again, seq, domain)
+        self._seq = itertools.count()
+        self._saturated = set()  # domains with full buffer
+        self._event = None  # set when new task is submitted, created in running loop
+        self._space = None  # set when task leaves the buffer, created in running loop
+        self.size = 0
+
+    def saturated(self) -> set:
+        """Domains which should not be claimed until their buffered tasks are dispatched
+        :return: set of domains
+        """
+        return self._saturated
+
+    def submit(self, doc, domain: str, rate: float = None, burst: int = None, priority: int = 0):
+        """Add claimed task to the domain queue
+        :param doc: task document
+        :param domain: registrable domain of task URL
+        :param rate: requests per second override
+        :param burst: burst override
+        :param priority: priority lane - task goes before lower priority tasks of the domain
+        :return:
+        """
+        queue = self._queues.get(domain)
+        if queue is None:
+            queue = collections.deque()
+            self._queues[domain] = queue
+            heapq.heappush(self._ready, (0.0, next(self._seq), domain))
+        index = len(queue)
+        while index > 0 and queue[index - 1][3] < priority:
+            index -= 1
+        queue.insert(index, (doc, rate, burst, priority))
+        if len(queue) >= self._domain_buffer:
+            self._saturated.add(domain)
+        self.size += 1
+        if self._event is not None:
+            self._event.set()
+
+    async def next(self):
+        """Wait for the task whose domain has a token available
+        :return: task document
+        """
+        if self._event is None:
+            self._event = asyncio.Event()
+        while True:
+            now = time.monotonic()
+            while self._ready and self._ready[0][0] <= now:
+                _, _, domain = heapq.heappop(self._ready)
+                queue = self._queues[domain]
+                doc, rate, burst, _ = queue[0]
+                bucket = self._buckets.get(domain)
+                if bucket is None:
+                    bucket = TokenBucket(self._rate, self._burst)
+                    self._buckets[domain] = bucket
+                wait = bucket.wait_time(now, rate or self._rate, burst or self._burst)
+                if wait > 0:
+                    heapq.heappush(self._ready, (now + wait, next(self._seq), domain))
+                    continue
+
+                bucket.take()
+                queue.popleft()
+                self.size -= 1
+                if self._space is not None:
+                    self._space.set()
+                if len(queue) < self._domain_buffer:
+                    self._saturated.discard(domain)
+                if queue:
+                    heapq.heappush(self._ready, (now, next(self._seq), domain))
+                else:
+                    del self._queues[domain]
+                    self._prune(now)
+                return doc
+
+            timeout = self._ready[0][0] - now if self._ready else None
+            self._event.clear()
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def wait_below(self, size: int):
+        """Wait until number of buffered tasks drops below size
+        :param size: buffer capacity
+        :return:
+        """
+        if self._space is None:
+            self._space = asyncio.Event()
+        while self.size >= size:
+            self._space.clear()
+            await self._space.wait()
+
+    def drain(self) -> list:
+        """Remove all buffered tasks
+        :return: list of task documents
+        """
+        docs = [doc for queue in self._queues.values() for doc, *_ in queue]
+        self._queues.clear()
+        self._ready.clear()
+        self._saturated.clear()
+        self.size = 0
+        if self._space is not None:
+            self._space.set()
+        return docs
+
+    def _prune(self, now: float):
+        # buckets of idle domains which are full again carry no state
+        if len(self._buckets) <= POLITENESS_MAX_DOMAINS:
+            return
+        for domain, bucket in list(self._buckets.items()):
+            if domain not in self._queues and bucket.wait_time(now) == 0 and bucket.tokens >= bucket.burst:
+                del self._buckets[domain]
+
+    def stats(self) -> dict:
+        """Number of buffered tasks and domains
+        :return: dict with stats
+        """
+        return {"buffered": self.size, "domains": len(self._queues), "saturated": len(self._saturated)}
@@ -1,12 +1,14 @@
 import asyncio
 import logging
 import time
-from concurrent.futures import ThreadPoolExecutor
-from datetime import datetime
+from datetime import datetime, timedelta
 
+import httpx
 import requests
 
 from consts import *
+import metrics
+from fetch_engine import classify_error, error_http_code
 from utils import check_ip
 
 
@@ -15,129 +17,185 @@ class ProxyManager:
     Proxy servers manager
     """
 
-    def __init__(self, db, proxy_list_file: str = None):
+    def __init__(self, storage, proxy_list_file: str = None, extra_list_files: list = None,
+                 premium_list_file: str = None):
         """Init proxy manager
-        :param db: pointer to database
+        :param storage: Storage object
         :param proxy_list_file: location of file with proxies
+        :param extra_list_files: locations of additional files with proxies in the same format
+        :param premium_list_file: location of file with premium proxies (username:password@hostname:port)
         """
-        self._db = db
+        self._storage = storage
         self._proxy_list_file = proxy_list_file
+        self._extra_list_files = extra_list_files or []
+        self._premium_list_file = premium_list_file
+        self._running = False
+
+    def parse_proxy_list(self, filename: str):
+        """Parse txt file with proxies
+        :param filename: location of the file
+        :return: dict proxy server -> (sign "+" to add or "-" to remove, document)
+        """
+        entries = {}
+        with open(filename, "rt") as fd:
+            for line in fd:
+                items = line.strip().split(" ")
+                if len(items) < 3:
+                    continue
+
+                if not ":" in items[0]: continue
+                ip_addr, port = items[0].split(":", 1)
+                if not port.isdigit():
+                    continue
+                port = int(port)
+
+                is_https = False
+                props = items[1].split("-")
+                if len(props) and 'S' in props[-1]:
+                    is_https = True
+
+                country = items[1].split("-")[0]
+
+                if not check_ip(ip_addr) or not 80 <= port <= 65535:
+                    continue
+                if items[2] not in ('+', '-'):
+                    continue
+
+                entries[items[0]] = (items[2], {"proxy_server": items[0],
+                                                "status_check": HttpCheckStatus.UNKNOWN.value,
+                                                "https": is_https, "country": country})
+        return entries
+
+    def parse_premium_list(self, filename: str):
+        """Parse txt file with premium proxies
+        :param filename: location of the file
+        :return: dict proxy server -> ("+", document)
+        """
+        entries = {}
+        with open(filename, "rt") as fd:
+            for line in fd:
+                line = line.strip()
+                if len(line) > 0 and not line.startswith("#"):
+                    entries[line] = ("+", {"proxy_server": line,
+                                           "status_check": HttpCheckStatus.UNKNOWN.value,
+                                           "https": True, "premium": True})
+        return entries
 
     async def set(self):
-        """Parse txt file with proxies and store to MongoDB
+        """Parse txt files with proxies and sync them to storage with one bulk write
         :return: none
         """
         if self._proxy_list_file is None:
-            self.fetch_from_github()
+            await self.fetch_from_github()
+            self._proxy_list_file = PROXY_FILE
 
         try:
-            with open(self._proxy_list_file, "rt") as fd:
-                for line in fd:
-                    items = line.strip().split(" ")
-                    if len(items) < 3:
-                        continue
-
-                    if not ":" in items[0]: continue
-                    ip_addr, port = items[0].split(":")
-                    port = int(port)
-
-                    is_https = False
-                    props = items[1].split("-")
-                    if len(props) and 'S' in props[-1]:
-                        is_https = True
-
-                    country = items[1].split("-")[0]
-
-                    if not check_ip(ip_addr) or not 80 <= port <= 65535:
-                        continue
-
-                    query = {"proxy_server": {"$eq": items[0]}}
-                    res = await self._db[COLLECTION_PROXIES].find_one(query)
-                    if res:
-                        if items[2] == '-':
-                            await self._db[COLLECTION_PROXIES].delete_one(query)
-                        continue
-
-                    if items[2] == '+':
-                        query = {"proxy_server": items[0],
-                                 "status_check": HttpCheckStatus.UNKNOWN.value,
-                                 "https": is_https, "country": country}
-
-                        await self._db[COLLECTION_PROXIES].insert_one(query)
+            entries = {}
+            for filename in [self._proxy_list_file] + self._extra_list_files:
+                entries.update(self.parse_proxy_list(filename))
+            if self._premium_list_file and os.path.exists(self._premium_list_file):
+                entries.update(self.parse_premium_list(self._premium_list_file))
+
+            existing = await self._storage.proxy_servers()
+            add = [doc for server, (sign, doc) in entries.items() if sign == '+' and server not in existing]
+            remove = [server for server, (sign, _) in entries.items() if sign == '-' and server in existing]
+            if add or remove:
+                added, removed = await self._storage.sync_proxies(add, remove)
+                logging.info(f"Proxies sync - added {added}, removed {removed}")
         except Exception as exc:
             logging.critical(exc, exc_info=True)
             raise exc
 
-    def validate_proxy(self, row):
+    async def validate_proxy(self, row):
         """Validating proxy server
-        :param row: document taken from mongo collection
-        :return: none
+        :param row: document of proxy due for the check
+        :return: tuple (proxy server, fields with check result)
         """
-        if not row.get('proxy_server'):
-            return
-        if row.get("is_https", False):
-            url = "https://lumtest.com/myip.json"
+        if row.get("https", False):
+            url = PROXY_CHECK_URL_HTTPS
         else:
-            url = "http://lumtest.com/myip.json"
+            url = PROXY_CHECK_URL_HTTP
 
         status, latency, response, response_code, last_alive = [None] * 5
+        ts_start = time.monotonic()
         try:
-            _proxies = {
-                "http": f"http://{row.get('proxy_server')}",
-                "https": f"https://{row.get('proxy_server')}",
-            }
-            ts1 = time.monotonic()
-            r = requests.get(url,
-                             timeout=(PROXY_CONNECT_TIMEOUT, PROXY_CHECK_TIMEOUT),
-                             proxies=_proxies)
-            r.raise_for_status()
-            ts2 = time.monotonic()
+            timeout = httpx.Timeout(PROXY_CHECK_TIMEOUT, connect=PROXY_CONNECT_TIMEOUT)
+            async with httpx.AsyncClient(proxies=f"http://{row.get('proxy_server')}",
+                                         timeout=timeout) as client:
+                ts1 = time.monotonic()
+                r = await client.get(url)
+                r.raise_for_status()
+                ts2 = time.monotonic()
             latency = ts2 - ts1
             status = HttpCheckStatus.OK
             response = r.text
             response_code = r.status_code
             if response_code == 200:
                 last_alive = datetime.utcnow()
-        except requests.exceptions.HTTPError as err:
-            status = HttpCheckStatus.HTTP_ERROR
-        except requests.exceptions.ConnectionError as err:
-            status = HttpCheckStatus.CONN_ERROR
-        except requests.exceptions.Timeout as err:
-            status = HttpCheckStatus.TIMEOUT_ERROR
         except Exception as err:
-            status = HttpCheckStatus.GENERAL_ERROR
-
+            status = classify_error(err)
+            response_code = error_http_code(err)
+        metrics.PROXY_CHECK.labels(status.name.lower(),
+                                   metrics.proxy_class(row.get("proxy_server"), row.get("https"), row.get("premium"))) \
+            .observe(time.monotonic() - ts_start)
+
+        # alive proxies are checked every PROXY_CHECK_INTERVAL, failing ones with exponential backoff,
+        # so proxies which failed recently are verified again before long dead ones
+        now = datetime.utcnow()
+        fail_count = 0 if status == HttpCheckStatus.OK else row.get("fail_count", 0) + 1
+        delay = min(PROXY_CHECK_INTERVAL * 2 ** max(fail_count - 1, 0), PROXY_CHECK_MAX_INTERVAL)
         status_data = {"status_check": status.value, "http_code": response_code,
-                       "last_check": datetime.utcnow(),
-                       "latency": latency, "response": response}
+                       "last_check": now, "next_check": now + timedelta(seconds=delay),
+                       "fail_count": fail_count, "latency": latency, "response": response}
         if last_alive:
             status_data["last_alive"] = last_alive
 
-        values = {"$set": status_data}
-        logging.debug(f"{row.get('proxy_server')}, {values}")
-        return row.get('proxy_server'), values
+        logging.debug(f"{row.get('proxy_server')}, {status_data}")
+        return row.get('proxy_server'), status_data
 
     async def check(self):
-        """Checking state of proxy server and updates database
+        """Checking state of proxies due for the check (never checked and stalest first)
+        and updates storage with bulk writes
+        :return: number of checked proxies
+        """
+        docs = await self._storage.due_proxies(datetime.utcnow(), PROXY_CHECK_BATCH)
+        if not docs:
+            return 0
+        logging.info(f"Check {len(docs)} proxies status...")
+        ts_start = time.monotonic()
+
+        slots = asyncio.Semaphore(MAX_PROXY_WORKERS)
+
+        async def probe(doc):
+            async with slots:
+                return await self.validate_proxy(doc)
+
+        results = []
+        for future in asyncio.as_completed([probe(doc) for doc in docs if doc.get('proxy_server')]):
+            results.append(await future)
+            if len(results) >= PROXY_CHECK_WRITE_BATCH:
+                await self._storage.save_proxy_checks(results)
+                results = []
+        if results:
+            await self._storage.save_proxy_checks(results)
+        metrics.PROXY_CHECK_BATCH.observe(time.monotonic() - ts_start)
+        return len(docs)
+
+    async def run(self):
+        """Check proxies continuously as they become due
         :return:
         """
-        logging.info("Check proxies status...")
-        docs = await self._db[COLLECTION_PROXIES].find({}, {"_id": 0}).to_list(None)
-
-        with ThreadPoolExecutor(max_workers=MAX_PROXY_WORKERS) as pool:
-            loop = asyncio.get_running_loop()
-            futures = [
-                loop.run_in_executor(pool, self.validate_proxy, doc)
-                for doc in docs
-            ]
+        if self._running:
+            return
+        self._running = True
+        while True:
             try:
-                results = await asyncio.gather(*futures, return_exceptions=False)
-            except Exception as ex:
-                raise
-
-        for server, values in results:
-            query = {"proxy_server": server}
-            await self._db[COLLECTION_PROXIES].update_one(query, values)
+                checked = await self.check()
+            except Exception as exc:
+                checked = 0
+                logging.exception(str(exc))
+            if not checked:
+                await asyncio.sleep(PROXY_CHECK_IDLE_TIME)
 
     async def fetch_from_github(self):
         """Fetching file with proxies from Github
@@ -157,6 +215,5 @@ class ProxyManager:
         :param limit: number of the servers
         :return: list of objects
         """
-        await self._db[COLLECTION_PROXIES]. \
-            find({"latency": {"$gt": 0}}, {"_id": 0, "response": 0}). \
-            sort([('latency', 1)]).to_list(None)
+        proxies = await self._storage.find_proxies(alive=True)
+        return proxies[:limit]
@@ -0,0 +1,126 @@
+import bisect
+import itertools
+import random
+import time
+
+from consts import *
+
+
+class ProxyState:
+    """
+    Live health of single proxy server
+    """
+    __slots__ = ("server", "success", "latency", "failures", "cooldown_until")
+
+    def __init__(self, server: str, latency: float = None):
+        self.server = server
+        self.success = 1.0  # moving average of successful fetches fraction
+        self.latency = latency or PROXY_DEFAULT_LATENCY  # moving average of fetch time
+        self.failures = 0  # consecutive failures
+        self.cooldown_until = 0.0
+
+    @property
+    def weight(self) -> float:
+        return max(self.success, 0.01) / max(self.latency, 0.05)
+
+
+class ProxyPool:
+    """
+    Alive proxies split into HTTP, HTTPS and premium buckets, picked with weights
+    based on moving averages of success rate and latency of real fetches
+    """
+
+    def __init__(self, premium: list = None):
+        """Init proxy pool
+        :param premium: list of premium proxies ({"proxy_server": ...})
+        """
+        self._buckets = {"http": [], "https": [], "premium": []}
+        self._states = {}  # proxy server -> ProxyState
+        self._weights = {}  # bucket -> (states, cumulative weights)
+        self._rebuild_ts = 0.0
+        self.load([], premium or [])
+
+    def load(self, proxies: list, premium: list = None):
+        """Replace list of proxies, keeping live stats of proxies already known
+        :param proxies: alive proxies documents from database
+        :param premium: list of premium proxies, None keeps current list
+        :return: list of proxy servers which left the pool
+        """
+        states, buckets = {}, {"http": [], "https": [], "premium": self._buckets["premium"]}
+        for proxy in proxies:
+            server = proxy.get("proxy_server")
+            if not server:
+                continue
+            state = self._states.get(server) or ProxyState(server, proxy.get("latency"))
+            states[server] = state
+            buckets["https" if proxy.get("https") else "http"].append(state)
+        if premium is not None:
+            buckets["premium"] = [self._states.get(p["proxy_server"]) or ProxyState(p["proxy_server"])
+                                  for p in premium]
+        for state in buckets["premium"]:
+            states[state.server] = state
+        removed = [server for server in self._states if server not in states]
+        self._states, self._buckets = states, buckets
+        self._rebuild_ts = 0.0
+        return removed
+
+    def pick(self, https: bool, premium: bool = False, exclude=()):
+        """Choose proxy for the request
+        :param https: True for HTTPS target URL
+        :param premium: use premium proxies
+        :param exclude: proxies already failed for the task, used only if no other proxy is left
+        :return: proxy server (host:port) or None if there is no proxy in the bucket
+        """
+        now = time.monotonic()
+        if now >= self._rebuild_ts:
+            self._rebuild(now)
+        name = "premium" if premium else ("https" if https else "http")
+        states, cumulative = self._weights[name]
+        if not states:
+            return None
+        if exclude:
+            others = [s for s in states if s.server not in exclude]
+            if others:
+                return random.choices(others, weights=[s.weight for s in others])[0].server
+        idx = bisect.bisect_right(cumulative, random.random() * cumulative[-1])
+        return states[min(idx, len(states) - 1)].server
+
+    def record(self, server: str, ok: bool, latency: float = None):
+        """Update proxy health with outcome of the fetch
+        :param server: proxy server
+        :param ok: True if proxy delivered response
+        :param latency: fetch time in seconds
+        :return:
+        """
+        state = self._states.get(server)
+        if state is None:
+            return
+        state.success = (1 - PROXY_EWMA_ALPHA) * state.success + PROXY_EWMA_ALPHA * ok
+        if ok:
+            state.failures = 0
+            if latency is not None:
+                state.latency = (1 - PROXY_EWMA_ALPHA) * state.latency + PROXY_EWMA_ALPHA * latency
+        else:
+            state.failures += 1
+            if state.failures >= PROXY_FAIL_THRESHOLD:
+                state.cooldown_until = time.monotonic() + PROXY_COOLDOWN
+                # half-open after cooldown - single failure sends the proxy back, success closes the breaker
+                state.failures = PROXY_FAIL_THRESHOLD - 1
+                self._rebuild_ts = 0.0  # proxy leaves the pool now
+
+    def stats(self) -> dict:
+        """Number of proxies and proxies in cooldown per bucket
+        :return: dict with stats
+        """
+        now = time.monotonic()
+        return {name: {"proxies": len(states),
+                       "cooldown": sum(1 for s in states if s.cooldown_until > now)}
+                for name, states in self._buckets.items()}
+
+    def _rebuild(self, now: float):
+        # cumulative weights are refreshed periodically, proxies in cooldown are skipped
+        # unless all proxies of the bucket are cooling down
+        for name, states in self._buckets.items():
+            active = [s for s in states if s.cooldown_until <= now] or states
+            self._weights[name] = (active, list(itertools.accumulate(s.weight for s in active)))
+        self._rebuild_ts = now + PROXY_POOL_REBUILD_INTERVAL
@@ -0,0 +1,106 @@
+"""
+ Request specs - task options compiled once into immutable objects shared by all tasks with the same options
+"""
+import json
+import random
+from typing import NamedTuple
+
+from consts import *
+from utils import options_key
+
+
+class RequestSpec(NamedTuple):
+    """
+    Task options prepared for fetching - shared by tasks with identical options, must not be modified
+    """
+    options: dict  # task options as stored (FetchDataBase fields)
+    method: str
+    headers: dict  # request headers with cookies, User-Agent is missing when it is picked per request
+    random_ua: bool
+    params_get: dict
+    params_post: dict
+    timeout: int
+    retries: int
+    max_bytes: int
+    no_proxy: bool
+    premium_proxy: bool
+    use_cache: bool
+    revalidate: bool  # serve only fresh cached copy (revalidate, max_age or min_fresh set)
+    max_age: int
+    min_fresh: int
+    rate_limit: float
+    burst: int
+
+    @classmethod
+    def compile(cls, options: dict) -> "RequestSpec":
+        """Build spec from task options
+        :param options: task options (FetchDataBase fields)
+        :return: RequestSpec object
+        """
+        method = (options.get("method") or "GET").upper()
+        headers = {"Accept-Encoding": "gzip, deflate, br"}
+        if options.get("user_agent"):
+            headers["User-Agent"] = options.get("user_agent")
+        headers.update(options.get("headers") or {})
+        if options.get("cookies"):
+            headers["Cookie"] = "; ".join(f"{k}={v}" for k, v in options.get("cookies").items())
+        params = options.get("params")
+        max_age, min_fresh = options.get("max_age"), options.get("min_fresh")
+        return cls(options=options, method=method, headers=headers, random_ua="User-Agent" not in headers,
+                   params_get=params if method == "GET" else None,
+                   params_post=params if method == "POST" else None,
+                   timeout=options.get("timeout", 60), retries=options.get("retries", 0),
+                   max_bytes=options.get("max_bytes") or FETCH_MAX_BYTES,
+                   no_proxy=options.get("no_proxy", False), premium_proxy=options.get("premium_proxy", False),
+                   use_cache=options.get("use_cache", False),
+                   revalidate=options.get("revalidate", False) or max_age is not None or min_fresh is not None,
+                   max_age=max_age, min_fresh=min_fresh,
+                   rate_limit=options.get("rate_limit"), burst=options.get("burst"))
+
+    def request_headers(self, ua_list: list, cached: dict = None) -> dict:
+        """Headers of single request
+        :param ua_list: User-Agents to pick from
+        :param cached: stale cached copy to revalidate with conditional request
+        :return: dict with headers (shared prebuilt dict if nothing is added)
+        """
+        if not (self.random_ua and ua_list) and not cached:
+            return self.headers
+        headers = dict(self.headers)
+        if self.random_ua and ua_list:
+            headers["User-Agent"] = random.choice(ua_list)
+        if cached and cached.get('etag'):
+            headers["If-None-Match"] = cached.get('etag')
+        if cached and cached.get('last_modified'):
+            headers["If-Modified-Since"] = cached.get('last_modified')
+        return headers
+
+
+class RequestSpecs:
+    """
+    Bounded cache of compiled specs keyed by task_key - tasks of a batch share one spec
+    """
+
+    def __init__(self, max_size: int = REQUEST_SPEC_CACHE_SIZE):
+        """Init cache
+        :param max_size: max number of kept specs, the oldest ones are dropped above it
+        """
+        self._specs = {}
+        self._max_size = max_size
+
+    def get(self, doc: dict) -> RequestSpec:
+        """Spec of the task
+        :param doc: task document
+        :return: RequestSpec object
+        """
+        options = doc.get('task') or {}
+        key = doc.get('task_key')
+        if key is None:
+            # tasks stored before task_key - options serialized to JSON are their own key
+            key = options if isinstance(options, str) else options_key(options)
+        spec = self._specs.get(key)
+        if spec is None:
+            spec = RequestSpec.compile(json.loads(options) if isinstance(options, str) else options)
+            if len(self._specs) >= self._max_size:
+                del self._specs[next(iter(self._specs))]
+            self._specs[key] = spec
+        return spec
@@ -0,0 +1,168 @@
+import random
+import time
+
+from consts import *
+
+
+class RetryPolicy:
+    """
+    Decides which failed attempts are repeated, when, and whether the next attempt goes through another proxy
+    """
+
+    def __init__(self, http_codes: set = None, errors: set = None, base: float = RETRY_BACKOFF_BASE,
+                 max_delay: float = RETRY_BACKOFF_MAX):
+        """Init policy
+        :param http_codes: HTTP errors worth another attempt (default RETRY_HTTP_CODES)
+        :param errors: HttpCheckStatus names of transient errors (default RETRY_ERRORS)
+        :param base: backoff of the first retry in seconds
+        :param max_delay: max backoff in seconds
+        """
+        self._http_codes = http_codes if http_codes is not None else RETRY_HTTP_CODES
+        self._errors = {HttpCheckStatus[name] for name in (errors if errors is not None else RETRY_ERRORS)}
+        self._base = base
+        self._max_delay = max_delay
+
+    def retryable(self, status: HttpCheckStatus, http_code: int = None, via_proxy: bool = False) -> bool:
+        """Check if failed attempt may succeed when repeated
+        :param status: fetching status of the attempt
+        :param http_code: HTTP response code (for HTTP errors)
+        :param via_proxy: attempt was sent through proxy
+        :return: True if attempt should be repeated
+        """
+        if status == HttpCheckStatus.CIRCUIT_OPEN:
+            return True
+        if status == HttpCheckStatus.HTTP_ERROR:
+            return http_code in self._http_codes or (via_proxy and http_code in PROXY_FAILURE_HTTP_CODES)
+        return status in self._errors
+
+    @staticmethod
+    def rotate(status: HttpCheckStatus, http_code: int = None) -> bool:
+        """Check if the next attempt must use another proxy
+        :param status: fetching status of the attempt sent through proxy
+        :param http_code: HTTP response code (for HTTP errors)
+        :return: True if the proxy should not be used again for the task
+        """
+        return status != HttpCheckStatus.HTTP_ERROR or http_code in PROXY_FAILURE_HTTP_CODES
+
+    def delay(self, attempt: int, retry_after: float = None) -> float:
+        """Backoff before retry - exponential with full jitter, Retry-After of the response if longer
+        :param attempt: number of the retry (1 - first retry)
+        :param retry_after: seconds requested by the server
+        :return: seconds to wait
+        """
+        delay = random.uniform(0, min(self._max_delay, self._base * 2 ** (attempt - 1)))
+        if retry_after:
+            delay = max(delay, min(retry_after, self._max_delay))
+        return delay
+
+
+def host_outcome(status: HttpCheckStatus, http_code: int = None, via_proxy: bool = False):
+    """Outcome of the attempt for circuit breaker of the target host
+    :param status: fetching status of the attempt
+    :param http_code: HTTP response code (for HTTP errors)
+    :param via_proxy: attempt was sent through proxy
+    :return: True - host responded, False - host failed, None - failure not caused by the host
+    """
+    if status in (HttpCheckStatus.OK, HttpCheckStatus.BODY_TOO_LARGE):
+        return True
+    if status == HttpCheckStatus.HTTP_ERROR:
+        return http_code not in BREAKER_HTTP_CODES
+    if status in (HttpCheckStatus.CONN_ERROR, HttpCheckStatus.TIMEOUT_ERROR, HttpCheckStatus.SSL_ERROR):
+        return None if via_proxy else False  # failures through proxy are counted to the proxy
+    return None
+
+
+class Breaker:
+    """
+    Circuit breaker of single host
+    """
+    __slots__ = ("failures", "open_until", "cooldown", "probe_until")
+
+    def __init__(self, cooldown: float):
+        self.failures = 0  # consecutive failures
+        self.open_until = 0.0  # host is short-circuited until this time
+        self.cooldown = cooldown  # short-circuit time of the next opening
+        self.probe_until = 0.0  # single probe request is in progress until this time
+
+
+class CircuitBreakers:
+    """
+    Circuit breakers of target hosts - after BREAKER_THRESHOLD consecutive failures the host is short-circuited
+    for cooldown, then single probe request decides whether it is closed again or opened for twice as long
+    """
+
+    def __init__(self, threshold: int = BREAKER_THRESHOLD, cooldown: float = BREAKER_COOLDOWN,
+                 max_cooldown: float = BREAKER_MAX_COOLDOWN):
+        """Init breakers
+        :param threshold: consecutive failures opening the breaker
+        :param cooldown: seconds host is short-circuited after opening
+        :param max_cooldown: max seconds host is short-circuited
+        """
+        self._threshold = threshold
+        self._cooldown = cooldown
+        self._max_cooldown = max_cooldown
+        self._breakers = {}  # host -> Breaker
+
+    def allow(self, host: str) -> bool:
+        """Check if request to host may be sent
+        :param host: target host name
+        :return: False if host is short-circuited
+        """
+        breaker = self._breakers.get(host)
+        if breaker is None or breaker.failures < self._threshold:
+            return True
+        now = time.monotonic()
+        if now < breaker.open_until or now < breaker.probe_until:
+            return False
+        # half-open - one probe, others wait for its outcome (or until the probe times out)
+        breaker.probe_until = now + breaker.cooldown
+        return True
+
+    def retry_in(self, host: str) -> float:
+        """Seconds until host accepts requests again
+        :param host: target host name
+        :return: 0 if host is not short-circuited
+        """
+        breaker = self._breakers.get(host)
+        if breaker is None:
+            return 0.0
+        return max(breaker.open_until, breaker.probe_until, time.monotonic()) - time.monotonic()
+
+    def record(self, host: str, ok: bool):
+        """Feed outcome of request to host
+        :param host: target host name
+        :param ok: True if host responded
+        :return:
+        """
+        breaker = self._breakers.get(host)
+        if ok:
+            if breaker is not None:
+                del self._breakers[host]  # closed
+            return
+        if breaker is None:
+            if len(self._breakers) >= BREAKER_MAX_HOSTS:
+                self._forget()
+            breaker = self._breakers[host] = Breaker(self._cooldown)
+        now = time.monotonic()
+        if breaker.failures >= self._threshold:
+            if now < breaker.open_until or not breaker.probe_until:
+                return  # request sent before the breaker opened
+            # half-open probe failed
+            breaker.cooldown = min(breaker.cooldown * 2, self._max_cooldown)
+            breaker.open_until = now + breaker.cooldown
+            breaker.probe_until = 0.0
+            return
+        breaker.failures += 1
+        if breaker.failures >= self._threshold:
+            breaker.open_until = now + breaker.cooldown
+
+    def stats(self) -> dict:
+        """Number of hosts with open breaker
+        :return: dict with stats
+        """
+        return {"open": sum(1 for b in self._breakers.values() if b.failures >= self._threshold),
+                "failing": len(self._breakers)}
+
+    def _forget(self):
+        # hosts with failures below threshold start counting again
+        self._breakers = {host: b for host, b in self._breakers.items() if b.failures >= self._threshold}
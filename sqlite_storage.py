@@ -0,0 +1,428 @@
+import asyncio
+import concurrent.futures
+import datetime
+import json
+
+import sqlalchemy as sa
+from bson import ObjectId
+from sqlalchemy.dialects.sqlite import insert
+
+from consts import *
+from storage import FINISHED_STATUSES, Storage
+
+metadata = sa.MetaData()
+
+# fields of task document kept in columns (used in conditions), other fields are kept in "data" JSON
+TASK_COLUMNS = ("url", "task", "fingerprint", "domain", "priority", "client_id", "batch_id", "status",
+                "worker_id", "lease_expire_ts", "blob", "no_store", "insert_ts", "update_ts")
+
+tasks = sa.Table(
+    COLLECTION_TASKS, metadata,
+    sa.Column("id", sa.String(24), primary_key=True),  # ObjectId hex - ordered by insert time like in MongoDB
+    sa.Column("url", sa.Text),
+    sa.Column("task", sa.JSON),
+    sa.Column("fingerprint", sa.String(64)),
+    sa.Column("domain", sa.Text),
+    sa.Column("priority", sa.Integer),
+    sa.Column("client_id", sa.Text),
+    sa.Column("batch_id", sa.Text),
+    sa.Column("status", sa.Integer, nullable=False),
+    sa.Column("worker_id", sa.Text),
+    sa.Column("lease_expire_ts", sa.DateTime),
+    sa.Column("blob", sa.String(64)),
+    sa.Column("no_store", sa.Boolean),
+    sa.Column("insert_ts", sa.DateTime),
+    sa.Column("update_ts", sa.DateTime),
+    sa.Column("data", sa.JSON),
+)
+sa.Index("ix_tasks_queue", tasks.c.status, tasks.c.priority.desc(), tasks.c.client_id, tasks.c.id)
+sa.Index("ix_tasks_lease", tasks.c.status, tasks.c.lease_expire_ts)
+sa.Index("ix_tasks_fingerprint", tasks.c.fingerprint, tasks.c.status, tasks.c.id)
+sa.Index("ix_tasks_batch", tasks.c.batch_id, tasks.c.id)
+sa.Index("ix_tasks_blob", tasks.c.blob)
+sa.Index("ix_tasks_update", tasks.c.update_ts)
+
+blobs = sa.Table(
+    COLLECTION_BLOBS, metadata,
+    sa.Column("digest", sa.String(64), primary_key=True),
+    sa.Column("size", sa.Integer),
+    sa.Column("encoding", sa.Text),
+    sa.Column("insert_ts", sa.DateTime),
+    sa.Column("last_access_ts", sa.DateTime, index=True),
+)
+
+settings = sa.Table(
+    COLLECTION_SETTINGS, metadata,
+    sa.Column("name", sa.Text, primary_key=True),
+    sa.Column("value", sa.Text),
+)
+
+PROXY_COLUMNS = ("proxy_server", "https", "premium", "country", "status_check", "http_code", "last_check",
+                 "next_check", "last_alive", "fail_count", "latency", "response")
+
+proxies = sa.Table(
+    COLLECTION_PROXIES, metadata,
+    sa.Column("proxy_server", sa.Text, primary_key=True),
+    sa.Column("https", sa.Boolean),
+    sa.Column("premium", sa.Boolean),
+    sa.Column("country", sa.Text),
+    sa.Column("status_check", sa.Integer),
+    sa.Column("http_code", sa.Integer),
+    sa.Column("last_check", sa.DateTime),
+    sa.Column("next_check", sa.DateTime),
+    sa.Column("last_alive", sa.DateTime),
+    sa.Column("fail_count", sa.Integer),
+    sa.Column("latency", sa.Float),
+    sa.Column("response", sa.Text),
+)
+sa.Index("ix_proxies_check", proxies.c.next_check, proxies.c.last_check)
+
+MAX_PARAMS = 1000  # ids in single IN condition
+
+
+def _json_default(o):
+    if isinstance(o, datetime.datetime):
+        return {"$date": o.isoformat()}
+    if isinstance(o, ObjectId):
+        return {"$oid": str(o)}
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+def _json_hook(d: dict):
+    if len(d) == 1:
+        if "$date" in d:
+            return datetime.datetime.fromisoformat(d["$date"])
+        if "$oid" in d:
+            return ObjectId(d["$oid"])
+    return d
+
+
+def dumps(obj) -> str:
+    return json.dumps(obj, default=_json_default)
+
+
+def loads(value: str):
+    return json.loads(value, object_hook=_json_hook)
+
+
+def _chunks(items: list, size: int = MAX_PARAMS):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _task_row(doc: dict) -> dict:
+    row = {"id": str(doc["_id"]), "data": {}}
+    for name, value in doc.items():
+        if name in TASK_COLUMNS:
+            row[name] = value
+        elif name != "_id":
+            row["data"][name] = value
+    return row
+
+
+def _task_doc(row, fields: list = None) -> dict:
+    doc = {"_id": ObjectId(row.id)}
+    for name in TASK_COLUMNS:
+        doc[name] = row[name]
+    doc.update(row.data or {})
+    if fields:
+        doc = {name: value for name, value in doc.items() if name == "_id" or name in fields}
+    return doc
+
+
+class SqliteStorage(Storage):
+    """
+    Storage in embedded SQLite database in WAL mode - for single node deployments and tests.
+    Queries run in one background thread, worker processes on the same node share the database file.
+    """
+
+    def __init__(self, path: str = SQLITE_PATH):
+        """Init storage
+        :param path: location of database file
+        """
+        self._engine = sa.create_engine(f"sqlite:///{path}", json_serializer=dumps, json_deserializer=loads,
+                                        poolclass=sa.pool.StaticPool,
+                                        connect_args={"check_same_thread": False, "timeout": 30})
+        sa.event.listen(self._engine, "connect", self._configure)
+        self._executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="sqlite")
+
+    @staticmethod
+    def _configure(connection, _):
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")  # readers do not block writer
+        cursor.execute("PRAGMA synchronous=NORMAL")  # commit without fsync, WAL keeps database consistent
+        cursor.close()
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._executor, fn, *args)
+
+    async def prepare(self):
+        await self._run(metadata.create_all, self._engine)
+
+    async def close(self):
+        await self._run(self._engine.dispose)
+        self._executor.shutdown(wait=False)
+
+    # TASKS
+
+    async def insert_tasks(self, docs: list) -> list:
+        for doc in docs:
+            doc.setdefault("_id", ObjectId())
+
+        def run():
+            with self._engine.begin() as conn:
+                conn.execute(tasks.insert(), [_task_row(doc) for doc in docs])
+        await self._run(run)
+        return [doc["_id"] for doc in docs]
+
+    async def get_task(self, task_id, fields: list = None):
+        def run():
+            with self._engine.connect() as conn:
+                return conn.execute(tasks.select().where(tasks.c.id == str(task_id))).first()
+        row = await self._run(run)
+        return _task_doc(row, fields) if row is not None else None
+
+    async def find_tasks(self, ids: list, fields: list = None, statuses: list = None) -> list:
+        def run():
+            rows = []
+            with self._engine.connect() as conn:
+                for chunk in _chunks([str(i) for i in ids]):
+                    query = tasks.select().where(tasks.c.id.in_(chunk))
+                    if statuses is not None:
+                        query = query.where(tasks.c.status.in_(statuses))
+                    rows.extend(conn.execute(query))
+            return rows
+        return [_task_doc(row, fields) for row in await self._run(run)]
+
+    async def page_tasks(self, ids: list = None, batch_id: str = None, fields: list = None,
+                         after=None, limit: int = EXPORT_PAGE_SIZE) -> list:
+        def run():
+            with self._engine.connect() as conn:
+                if batch_id:
+                    query = tasks.select().where(tasks.c.batch_id == batch_id)
+                    if after is not None:
+                        query = query.where(tasks.c.id > str(after))
+                    return list(conn.execute(query.order_by(tasks.c.id).limit(limit)))
+                rows = []
+                for chunk in _chunks(sorted(str(i) for i in ids if after is None or str(i) > str(after))):
+                    query = tasks.select().where(tasks.c.id.in_(chunk)).order_by(tasks.c.id).limit(limit - len(rows))
+                    rows.extend(conn.execute(query))
+                    if len(rows) >= limit:
+                        break
+                return rows
+        return [_task_doc(row, fields) for row in await self._run(run)]
+
+    async def count_tasks(self, status: int) -> int:
+        def run():
+            with self._engine.connect() as conn:
+                return conn.execute(sa.select(sa.func.count()).where(tasks.c.status == status)).scalar()
+        return await self._run(run)
+
+    async def queue_lanes(self) -> list:
+        def run():
+            with self._engine.connect() as conn:
+                return [p for p, in conn.execute(
+                    sa.select(tasks.c.priority).distinct().where(tasks.c.status == TaskStatus.NEW.value))]
+        return await self._run(run)
+
+    async def lane_clients(self, priority) -> list:
+        def run():
+            with self._engine.connect() as conn:
+                return [c for c, in conn.execute(
+                    sa.select(tasks.c.client_id).distinct()
+                    .where(tasks.c.status == TaskStatus.NEW.value, tasks.c.priority == priority))]
+        return await self._run(run)
+
+    async def queued_tasks(self, priority, client_id, limit: int, exclude_ids: list = None,
+                           exclude_domains=None) -> list:
+        def run():
+            query = sa.select(tasks.c.id) \
+                .where(tasks.c.status == TaskStatus.NEW.value, tasks.c.priority == priority,
+                       tasks.c.client_id == client_id)
+            if exclude_ids:
+                query = query.where(tasks.c.id.notin_([str(i) for i in exclude_ids]))
+            if exclude_domains:
+                query = query.where(tasks.c.domain.notin_(list(exclude_domains)))
+            with self._engine.connect() as conn:
+                return [ObjectId(i) for i, in conn.execute(query.order_by(tasks.c.id).limit(limit))]
+        return await self._run(run)
+
+    async def lease_tasks(self, ids: list, worker_id: str, lease_expire_ts) -> list:
+        def run():
+            rows = []
+            with self._engine.begin() as conn:
+                for chunk in _chunks([str(i) for i in ids]):
+                    conn.execute(tasks.update()
+                                 .where(tasks.c.id.in_(chunk), tasks.c.status == TaskStatus.NEW.value)
+                                 .values(status=TaskStatus.INPROGRESS.value, worker_id=worker_id,
+                                         lease_expire_ts=lease_expire_ts))
+                    rows.extend(conn.execute(
+                        tasks.select().where(tasks.c.id.in_(chunk), tasks.c.worker_id == worker_id,
+                                             tasks.c.status == TaskStatus.INPROGRESS.value)))
+            return rows
+        docs = [_task_doc(row) for row in await self._run(run)]
+        docs.sort(key=lambda doc: (-(doc.get("priority") or 0), doc["_id"]))
+        return docs
+
+    async def renew_leases(self, ids: list, worker_id: str, lease_expire_ts):
+        def run():
+            with self._engine.begin() as conn:
+                for chunk in _chunks([str(i) for i in ids]):
+                    conn.execute(tasks.update()
+                                 .where(tasks.c.id.in_(chunk), tasks.c.worker_id == worker_id,
+                                        tasks.c.status == TaskStatus.INPROGRESS.value)
+                                 .values(lease_expire_ts=lease_expire_ts))
+        await self._run(run)
+
+    async def expire_leases(self, now) -> int:
+        def run():
+            with self._engine.begin() as conn:
+                return conn.execute(
+                    tasks.update()
+                    .where(tasks.c.status == TaskStatus.INPROGRESS.value, tasks.c.lease_expire_ts < now)
+                    .values(status=TaskStatus.NEW.value, worker_id=None, lease_expire_ts=None)).rowcount
+        return await self._run(run)
+
+    async def release_tasks(self, ids: list, worker_id: str) -> int:
+        def run():
+            released = 0
+            with self._engine.begin() as conn:
+                for chunk in _chunks([str(i) for i in ids]):
+                    released += conn.execute(
+                        tasks.update()
+                        .where(tasks.c.id.in_(chunk), tasks.c.worker_id == worker_id,
+                               tasks.c.status == TaskStatus.INPROGRESS.value)
+                        .values(status=TaskStatus.NEW.value, worker_id=None, lease_expire_ts=None)).rowcount
+            return released
+        return await self._run(run)
+
+    async def complete_tasks(self, entries: list) -> list:
+        def run():
+            results = []
+            with self._engine.begin() as conn:
+                for (task_id, worker_id), fields in entries:
+                    row = _task_row({"_id": task_id, **fields})
+                    values = {name: row[name] for name in TASK_COLUMNS if name in row}
+                    if row["data"]:
+                        # other fields are set in stored JSON, null values are kept like in MongoDB
+                        paths = []
+                        for name, value in row["data"].items():
+                            paths += [f'$."{name}"', sa.func.json(dumps(value))]
+                        values["data"] = sa.func.json_set(sa.func.coalesce(tasks.c.data, "{}"), *paths)
+                    res = conn.execute(tasks.update()
+                                       .where(tasks.c.id == row["id"], tasks.c.worker_id == worker_id,
+                                              tasks.c.status == TaskStatus.INPROGRESS.value)
+                                       .values(**values))
+                    results.append(res.rowcount > 0)
+            return results
+        return await self._run(run)
+
+    async def find_cached(self, fingerprint: str, fields: list, storable_only: bool = False):
+        def run():
+            query = tasks.select() \
+                .where(tasks.c.fingerprint == fingerprint, tasks.c.status == TaskStatus.DONE.value,
+                       tasks.c.blob.isnot(None))
+            if storable_only:
+                query = query.where(sa.func.coalesce(tasks.c.no_store, False) == False)
+            with self._engine.connect() as conn:
+                return conn.execute(query.order_by(tasks.c.id.desc()).limit(1)).first()
+        row = await self._run(run)
+        return _task_doc(row, fields) if row is not None else None
+
+    async def purge_tasks(self, before) -> int:
+        def run():
+            with self._engine.begin() as conn:
+                return conn.execute(tasks.delete().where(tasks.c.update_ts < before,
+                                                         tasks.c.status.in_(FINISHED_STATUSES))).rowcount
+        return await self._run(run)
+
+    # RECORDS OF CACHED BLOBS
+
+    async def save_blobs(self, entries: list) -> list:
+        def run():
+            results = []
+            with self._engine.begin() as conn:
+                for digest, fields in entries:
+                    if "size" in fields:
+                        query = insert(blobs).values(digest=digest, **fields) \
+                            .on_conflict_do_update(index_elements=[blobs.c.digest],
+                                                   set_={"last_access_ts": fields["last_access_ts"]})
+                    else:
+                        query = blobs.update().where(blobs.c.digest == digest) \
+                            .values(last_access_ts=fields["last_access_ts"])
+                    results.append(conn.execute(query).rowcount > 0)
+            return results
+        return await self._run(run)
+
+    async def iter_blobs(self):
+        def run():
+            with self._engine.connect() as conn:
+                return conn.execute(sa.select(blobs.c.digest, blobs.c.size, blobs.c.last_access_ts)
+                                    .order_by(blobs.c.last_access_ts.desc())).fetchall()
+        for digest, size, last_access_ts in await self._run(run):
+            yield {"_id": digest, "size": size, "last_access_ts": last_access_ts}
+
+    async def delete_blobs(self, digests: list):
+        def run():
+            with self._engine.begin() as conn:
+                for chunk in _chunks(digests):
+                    conn.execute(blobs.delete().where(blobs.c.digest.in_(chunk)))
+                    conn.execute(tasks.update().where(tasks.c.blob.in_(chunk)).values(blob=None))
+        await self._run(run)
+
+    # SETTINGS
+
+    async def init_setting(self, name: str, value: str) -> str:
+        def run():
+            with self._engine.begin() as conn:
+                conn.execute(insert(settings).values(name=name, value=value).on_conflict_do_nothing())
+                return conn.execute(sa.select(settings.c.value).where(settings.c.name == name)).scalar()
+        return await self._run(run)
+
+    # PROXIES
+
+    async def proxy_servers(self) -> set:
+        def run():
+            with self._engine.connect() as conn:
+                return {server for server, in conn.execute(sa.select(proxies.c.proxy_server))}
+        return await self._run(run)
+
+    async def sync_proxies(self, add: list, remove: list) -> tuple:
+        def run():
+            added, removed = 0, 0
+            with self._engine.begin() as conn:
+                if add:
+                    rows = [{name: doc.get(name) for name in PROXY_COLUMNS} for doc in add]
+                    added = conn.execute(insert(proxies).on_conflict_do_nothing(), rows).rowcount
+                for chunk in _chunks(remove):
+                    removed += conn.execute(proxies.delete().where(proxies.c.proxy_server.in_(chunk))).rowcount
+            return added, removed
+        return await self._run(run)
+
+    async def due_proxies(self, now, limit: int) -> list:
+        def run():
+            with self._engine.connect() as conn:
+                return conn.execute(
+                    sa.select(proxies.c.proxy_server, proxies.c.https, proxies.c.premium, proxies.c.fail_count)
+                    .where(sa.or_(proxies.c.next_check <= now, proxies.c.next_check.is_(None)))
+                    .order_by(proxies.c.next_check, proxies.c.last_check).limit(limit)).fetchall()
+        return [{k: v for k, v in row._mapping.items() if v is not None} for row in await self._run(run)]
+
+    async def save_proxy_checks(self, results: list):
+        def run():
+            with self._engine.begin() as conn:
+                for server, fields in results:
+                    conn.execute(proxies.update().where(proxies.c.proxy_server == server)
+                                 .values(**{k: v for k, v in fields.items() if k in PROXY_COLUMNS}))
+        await self._run(run)
+
+    async def find_proxies(self, alive: bool = False, premium: bool = None) -> list:
+        def run():
+            query = sa.select(*[proxies.c[name] for name in PROXY_COLUMNS if name != "response"])
+            if premium is not None:
+                query = query.where(sa.func.coalesce(proxies.c.premium, False) == premium)
+            if alive:
+                query = query.where(proxies.c.status_check == HttpCheckStatus.OK.value)
+            with self._engine.connect() as conn:
+                return conn.execute(query.order_by(proxies.c.latency)).fetchall()
+        return [{k: v for k, v in row._mapping.items() if v is not None} for row in await self._run(run)]
@@ -0,0 +1,249 @@
+"""
+ Storage of tasks, proxies and records of cached blobs
+
+ Storage hides the database from the rest of the application - MongoStorage (mongo_storage.py)
+ for distributed deployments and SqliteStorage (sqlite_storage.py) - embedded SQLite database in WAL mode
+ for single node deployments and tests. Tasks are identified by ObjectIds with both backends.
+"""
+from consts import *
+
+FINISHED_STATUSES = [TaskStatus.DONE.value, TaskStatus.ERROR.value]
+
+
+class Storage:
+    """
+    Interface of storage backends
+    """
+
+    async def prepare(self):
+        """Create tables (collections) and indexes
+        :return:
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        """Release database connections
+        :return:
+        """
+
+    # TASKS
+
+    async def insert_tasks(self, docs: list) -> list:
+        """Enqueue new tasks
+        :param docs: task documents (see utils.make_task)
+        :return: list of ids of inserted tasks in order of docs
+        """
+        raise NotImplementedError
+
+    async def get_task(self, task_id, fields: list = None):
+        """Lookup single task
+        :param task_id: task ObjectId
+        :param fields: returned fields (None - all fields), _id is always returned
+        :return: task document or None if not found
+        """
+        raise NotImplementedError
+
+    async def find_tasks(self, ids: list, fields: list = None, statuses: list = None) -> list:
+        """Lookup many tasks
+        :param ids: list of task ObjectIds
+        :param fields: returned fields (None - all fields), _id is always returned
+        :param statuses: return only tasks with these statuses
+        :return: list of task documents in no particular order
+        """
+        raise NotImplementedError
+
+    async def page_tasks(self, ids: list = None, batch_id: str = None, fields: list = None,
+                         after=None, limit: int = EXPORT_PAGE_SIZE) -> list:
+        """Page of tasks ordered by _id
+        :param ids: list of task ObjectIds
+        :param batch_id: select tasks of the batch instead of ids
+        :param fields: returned fields (None - all fields), _id is always returned
+        :param after: _id of the last task of previous page
+        :param limit: max number of tasks
+        :return: list of task documents
+        """
+        raise NotImplementedError
+
+    async def count_tasks(self, status: int) -> int:
+        """Number of tasks with status
+        :param status: TaskStatus value
+        :return: number of tasks
+        """
+        raise NotImplementedError
+
+    async def queue_lanes(self) -> list:
+        """Priority lanes with NEW tasks
+        :return: list of priorities
+        """
+        raise NotImplementedError
+
+    async def lane_clients(self, priority) -> list:
+        """Clients with NEW tasks in priority lane
+        :param priority: priority lane
+        :return: list of client ids (None for tasks without client)
+        """
+        raise NotImplementedError
+
+    async def queued_tasks(self, priority, client_id, limit: int, exclude_ids: list = None,
+                           exclude_domains=None) -> list:
+        """Oldest NEW tasks of the client in priority lane
+        :param priority: priority lane
+        :param client_id: client id
+        :param limit: max number of tasks
+        :param exclude_ids: ids of tasks already chosen
+        :param exclude_domains: domains which should not be claimed now
+        :return: list of task ids
+        """
+        raise NotImplementedError
+
+    async def lease_tasks(self, ids: list, worker_id: str, lease_expire_ts) -> list:
+        """Lease NEW tasks to the worker - tasks claimed by other workers in the meantime stay with them
+        :param ids: list of task ObjectIds
+        :param worker_id: id of the worker
+        :param lease_expire_ts: time when unfinished task returns to the queue
+        :return: list of leased task documents ordered by priority (highest first) and _id
+        """
+        raise NotImplementedError
+
+    async def renew_leases(self, ids: list, worker_id: str, lease_expire_ts):
+        """Extend leases of tasks processed by the worker
+        :param ids: list of task ObjectIds
+        :param worker_id: id of the worker
+        :param lease_expire_ts: new expiration time
+        :return:
+        """
+        raise NotImplementedError
+
+    async def expire_leases(self, now) -> int:
+        """Return tasks with expired lease to the queue
+        :param now: current time
+        :return: number of returned tasks
+        """
+        raise NotImplementedError
+
+    async def release_tasks(self, ids: list, worker_id: str) -> int:
+        """Return tasks leased by the worker to the queue
+        :param ids: list of task ObjectIds
+        :param worker_id: id of the worker
+        :return: number of returned tasks
+        """
+        raise NotImplementedError
+
+    async def complete_tasks(self, entries: list) -> list:
+        """Store results of tasks - only the current lease holder is allowed to store the result
+        :param entries: list of ((task ObjectId, worker id), result fields)
+        :return: list of bools - False if the result was not written
+        """
+        raise NotImplementedError
+
+    async def find_cached(self, fingerprint: str, fields: list, storable_only: bool = False):
+        """Newest finished task with cached body for the request fingerprint
+        :param fingerprint: request fingerprint
+        :param fields: returned fields, _id is always returned
+        :param storable_only: skip responses which must not be stored (Cache-Control: no-store)
+        :return: task document or None if not found
+        """
+        raise NotImplementedError
+
+    async def purge_tasks(self, before) -> int:
+        """Delete finished tasks updated before given time
+        :param before: datetime
+        :return: number of deleted tasks
+        """
+        raise NotImplementedError
+
+    async def watch_finished(self):
+        """Notifications about tasks finished by any process
+        :return: async iterator of (task ObjectId, stored fields), raises NotImplementedError
+                 if backend has no change notifications
+        """
+        raise NotImplementedError
+        yield
+
+    # RECORDS OF CACHED BLOBS
+
+    async def save_blobs(self, entries: list) -> list:
+        """Record blobs in use - blob is inserted with size, encoding and insert_ts if they are given,
+        existing blob keeps them and gets only new last_access_ts
+        :param entries: list of (digest, fields)
+        :return: list of bools - False if the record was not written
+        """
+        raise NotImplementedError
+
+    async def iter_blobs(self):
+        """Records of blobs, most recently used first
+        :return: async iterator of dicts with _id (digest), size and last_access_ts
+        """
+        raise NotImplementedError
+        yield
+
+    async def delete_blobs(self, digests: list):
+        """Delete records of evicted blobs and their references in tasks
+        :param digests: list of digests
+        :return:
+        """
+        raise NotImplementedError
+
+    # SETTINGS
+
+    async def init_setting(self, name: str, value: str) -> str:
+        """Store deployment-wide setting unless it is already set
+        :param name: setting name
+        :param value: value stored if setting is missing
+        :return: stored value
+        """
+        raise NotImplementedError
+
+    # PROXIES
+
+    async def proxy_servers(self) -> set:
+        """Known proxy servers
+        :return: set of proxy servers (host:port)
+        """
+        raise NotImplementedError
+
+    async def sync_proxies(self, add: list, remove: list) -> tuple:
+        """Add and remove proxy servers
+        :param add: documents of new proxies (proxy_server, https, premium, country, status_check)
+        :param remove: proxy servers to remove
+        :return: tuple (number of added, number of removed)
+        """
+        raise NotImplementedError
+
+    async def due_proxies(self, now, limit: int) -> list:
+        """Proxies due for the check, never checked and stalest first
+        :param now: current time
+        :param limit: max number of proxies
+        :return: list of documents with proxy_server, https, premium and fail_count
+        """
+        raise NotImplementedError
+
+    async def save_proxy_checks(self, results: list):
+        """Store results of proxy checks
+        :param results: list of (proxy server, check fields)
+        :return:
+        """
+        raise NotImplementedError
+
+    async def find_proxies(self, alive: bool = False, premium: bool = None) -> list:
+        """Proxies sorted by latency, without response of the check
+        :param alive: only proxies with successful last check
+        :param premium: True/False - only premium/regular proxies, None - all
+        :return: list of proxy documents
+        """
+        raise NotImplementedError
+
+
+def open_storage(backend: str = STORAGE) -> Storage:
+    """Create storage configured in STORAGE
+    :param backend: "mongo" or "sqlite"
+    :return: Storage object
+    """
+    if backend == "sqlite":
+        from sqlite_storage import SqliteStorage
+        return SqliteStorage(SQLITE_PATH)
+    if backend == "mongo":
+        from mongo_storage import MongoStorage
+        from utils import get_db_conn
+        return MongoStorage(get_db_conn())
+    raise ValueError(f"Unsupported storage: {backend}")
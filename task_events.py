@@ -0,0 +1,137 @@
+import asyncio
+import contextlib
+import logging
+import time
+
+from consts import *
+from storage import FINISHED_STATUSES
+
+
+class Subscription:
+    """
+    Completions of the watched tasks - every task is delivered once
+    """
+
+    def __init__(self, ids):
+        self.pending = set(ids)
+        self._queue = asyncio.Queue()
+
+    def put(self, task_id, result: dict = None):
+        self._queue.put_nowait((task_id, result))
+
+    async def get(self, timeout: float = None):
+        """Wait for the next finished task
+        :param timeout: seconds to wait (None - no limit)
+        :return: tuple (task id, fields of the stored result - None if task does not exist),
+            None on timeout or when all tasks finished
+        """
+        while self.pending:
+            try:
+                task_id, result = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                return None
+            if task_id in self.pending:
+                self.pending.discard(task_id)
+                return task_id, result
+        return None
+
+    async def wait(self, timeout: float):
+        """Wait until all watched tasks finish
+        :param timeout: max seconds to wait
+        :return: True if all tasks finished
+        """
+        deadline = time.monotonic() + timeout
+        while self.pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or await self.get(remaining) is None:
+                break
+        return not self.pending
+
+
+class TaskEvents:
+    """
+    Notifications about finished tasks for waiting clients - published in process by FetchWorker,
+    and from change notifications of storage (MongoDB change stream) for tasks finished by other processes.
+    Without change notifications (standalone MongoDB server, SQLite) all watched tasks are checked
+    with one query per poll interval.
+    """
+
+    def __init__(self, storage, poll_interval: float = TASK_EVENTS_POLL_INTERVAL):
+        """Init notifications
+        :param storage: Storage object
+        :param poll_interval: seconds between checks of watched tasks when change notifications are not available
+        """
+        self._storage = storage
+        self._poll_interval = poll_interval
+        self._watchers = {}  # task id -> set of subscriptions
+
+    def publish(self, task_id, result: dict):
+        """Notify subscribers about finished task
+        :param task_id: task ObjectId
+        :param result: stored fields of the task
+        :return:
+        """
+        for subscription in self._watchers.pop(task_id, ()):
+            subscription.put(task_id, result)
+
+    @contextlib.asynccontextmanager
+    async def subscribe(self, ids: list):
+        """Watch tasks - already finished ones are delivered at once, tasks not found in storage
+        are delivered with None result and not watched
+        :param ids: list of task ObjectIds
+        :return: Subscription object
+        """
+        subscription = Subscription(ids)
+        for task_id in subscription.pending:
+            self._watchers.setdefault(task_id, set()).add(subscription)
+        try:
+            await self._check(list(subscription.pending))
+            await self._check_missing(subscription)
+            yield subscription
+        finally:
+            for task_id in subscription.pending:
+                self._unwatch(task_id, subscription)
+
+    async def _check(self, ids: list):
+        for i in range(0, len(ids), 1000):
+            for doc in await self._storage.find_tasks(ids[i:i + 1000], statuses=FINISHED_STATUSES):
+                self.publish(doc.pop("_id"), doc)
+
+    async def _check_missing(self, subscription: Subscription):
+        ids = list(subscription.pending)
+        found = set()
+        for i in range(0, len(ids), 1000):
+            found.update(doc["_id"] for doc in await self._storage.find_tasks(ids[i:i + 1000], fields=["status"]))
+        for task_id in ids:
+            if task_id not in found:
+                self._unwatch(task_id, subscription)
+                subscription.put(task_id)
+
+    def _unwatch(self, task_id, subscription: Subscription):
+        watchers = self._watchers.get(task_id)
+        if watchers is not None:
+            watchers.discard(subscription)
+            if not watchers:
+                del self._watchers[task_id]
+
+    async def run(self):
+        """Deliver tasks finished by other processes
+        :return:
+        """
+        try:
+            async for task_id, result in self._storage.watch_finished():
+                if task_id in self._watchers:
+                    self.publish(task_id, result)
+        except asyncio.CancelledError:
+            raise
+        except NotImplementedError:
+            logging.info("Storage has no change notifications, watched tasks are polled")
+        except Exception as exc:
+            logging.info(f"Task change stream not available ({exc}), watched tasks are polled")
+
+        while True:
+            await asyncio.sleep(self._poll_interval)
+            try:
+                await self._check(list(self._watchers))
+            except Exception as exc:
+                logging.exception(str(exc))
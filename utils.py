@@ -1,10 +1,21 @@
 import re
 import datetime
+import hashlib
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 import motor.motor_tornado
 from consts import *
 import json
 from bson import ObjectId
 
+try:
+    import orjson
+except ImportError:  # faster serialization of exported tasks is optional
+    orjson = None
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+SECOND_LEVEL_LABELS = {"co", "com", "net", "org", "gov", "edu", "ac", "or", "ne", "go", "gv", "nic"}
+
 
 def get_db_conn():
     """Making connection to Mongo DB
@@ -56,10 +67,192 @@ def get_premium_proxies():
     return proxies
 
 
+def normalize_url(url: str, params: dict = None) -> str:
+    """Normalize URL - lowercase scheme and host, skip default port and fragment, sort query
+    :param url: URL address
+    :param params: additional query params merged into query string
+    :return: normalized URL
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if ":" in host:
+        host = f"[{host}]"
+    if parts.port and DEFAULT_PORTS.get(scheme) != parts.port:
+        host = f"{host}:{parts.port}"
+    if parts.username:
+        host = f"{parts.username}:{parts.password or ''}@{host}"
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    if params:
+        query += [(k, str(v)) for k, v in params.items()]
+    return urlunsplit((scheme, host, parts.path or "/", urlencode(sorted(query)), ""))
+
+
+def registrable_domain(url: str) -> str:
+    """Registrable domain of URL host (approximation without public suffix list -
+    two last labels, three for country domains like co.uk or com.pl)
+    :param url: URL address
+    :return: domain name, IP address for hosts given as IP
+    """
+    host = (urlsplit(url).hostname or "").lower().rstrip(".")
+    if not host or ":" in host or check_ip(host):
+        return host
+    labels = host.split(".")
+    if len(labels) > 2 and len(labels[-1]) == 2 and labels[-2] in SECOND_LEVEL_LABELS:
+        return ".".join(labels[-3:])
+    return ".".join(labels[-2:])
+
+
+def request_fingerprint(url: str, task: dict) -> str:
+    """Canonical fingerprint of the request - hash of method, normalized URL, params/body
+    and headers selected in task option fingerprint_headers
+    :param url: URL address
+    :param task: task options (FetchDataBase fields)
+    :return: hex digest
+    """
+    method = (task.get("method") or "GET").upper()
+    params = task.get("params") or {}
+    body = None
+    if method == "GET":
+        norm_url = normalize_url(url, params)
+    else:
+        norm_url = normalize_url(url)
+        body = sorted((k, str(v)) for k, v in params.items())
+
+    sent_headers = {k.lower(): v for k, v in (task.get("headers") or {}).items()}
+    if task.get("user_agent"):
+        sent_headers.setdefault("user-agent", task.get("user_agent"))
+    headers = {}
+    for name in task.get("fingerprint_headers") or []:
+        name = name.lower()
+        if name == "cookie":
+            headers[name] = sorted((task.get("cookies") or {}).items())
+        else:
+            headers[name] = sent_headers.get(name)
+
+    key = json.dumps([method, norm_url, body, headers], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def parse_http_date(value: str):
+    """Parse HTTP date header
+    :param value: header value
+    :return: naive UTC datetime or None if value is not a valid date
+    """
+    if not value:
+        return None
+    try:
+        ts = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return ts
+
+
+def cache_validators(headers, now: datetime.datetime) -> dict:
+    """Validators and freshness of the response (RFC 9111) stored with cached body
+    :param headers: response headers (case-insensitive mapping or dict with lowercase names)
+    :param now: time when response was received
+    :return: dict with VALIDATOR_FIELDS
+    """
+    directives = {}
+    for item in (headers.get("cache-control") or "").split(","):
+        name, _, value = item.strip().partition("=")
+        if name:
+            directives[name.lower()] = value.strip('"')
+
+    age = headers.get("age") or ""
+    response_ts = now - datetime.timedelta(seconds=int(age) if age.isdigit() else 0)
+    date = parse_http_date(headers.get("date")) or response_ts
+    last_modified = parse_http_date(headers.get("last-modified"))
+
+    lifetime = None
+    for name in ("s-maxage", "max-age"):  # results are shared by clients, like in shared cache
+        if directives.get(name, "").isdigit():
+            lifetime = int(directives[name])
+            break
+    if lifetime is None and headers.get("expires"):
+        expires = parse_http_date(headers.get("expires"))
+        lifetime = max((expires - date).total_seconds(), 0) if expires else 0  # invalid date means expired
+    if lifetime is None and last_modified:
+        lifetime = min(max((date - last_modified).total_seconds(), 0) * CACHE_HEURISTIC_FRACTION,
+                       CACHE_HEURISTIC_MAX)
+    if lifetime is None or "no-cache" in directives:
+        lifetime = 0
+
+    return {"etag": headers.get("etag"), "last_modified": headers.get("last-modified"),
+            "cache_control": headers.get("cache-control"), "expires": headers.get("expires"),
+            "response_ts": response_ts, "fresh_until": response_ts + datetime.timedelta(seconds=lifetime),
+            "no_store": "no-store" in directives}
+
+
+def is_fresh(doc: dict, now: datetime.datetime, max_age: int = None, min_fresh: int = None) -> bool:
+    """Check if cached response can be used without revalidation
+    :param doc: task document with VALIDATOR_FIELDS
+    :param now: current time
+    :param max_age: max accepted age of response in seconds
+    :param min_fresh: min number of seconds response must stay fresh
+    :return: True if response is fresh
+    """
+    if doc.get("fresh_until") is None or doc.get("response_ts") is None:
+        return False  # stored before validators were introduced
+    if max_age is not None and (now - doc["response_ts"]).total_seconds() > max_age:
+        return False
+    return (doc["fresh_until"] - now).total_seconds() >= (min_fresh or 0)
+
+
+def options_key(task: dict) -> str:
+    """Key of task options - tasks with the same key share one compiled RequestSpec
+    :param task: task options (FetchDataBase fields)
+    :return: hex digest
+    """
+    key = json.dumps(task, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def make_task(url: str, task_dict: dict, now: datetime.datetime, task_key: str = None,
+              priority: int = TASK_PRIORITY_BULK) -> dict:
+    """Build new task document
+    :param url: URL address
+    :param task_dict: task options (FetchDataBase fields), stored as subdocument
+    :param now: insert timestamp
+    :param task_key: key of task options already computed for the batch (see options_key)
+    :param priority: lane of the task if not set in task options
+    :return: document for tasks collection
+    """
+    if task_dict.get("priority") is not None:
+        priority = task_dict.get("priority")
+    return {"url": url, "task": task_dict, "task_key": task_key or options_key(task_dict),
+            "fingerprint": request_fingerprint(url, task_dict),
+            "domain": registrable_domain(url),
+            "priority": priority, "client_id": task_dict.get("client_id"), "batch_id": task_dict.get("batch_id"),
+            "insert_ts": now, "status": TaskStatus.NEW.value,
+            "cache": False, "update_ts": now, "download_time": 0.0}
+
+
 class JSONEncoder(json.JSONEncoder):
     def default(self, o):
         if isinstance(o, datetime.datetime):
             return str(o)
         if isinstance(o, ObjectId):
             return str(o)
-        return json.JSONEncoder.default(self, o)
\ No newline at end of file
+        return json.JSONEncoder.default(self, o)
+
+
+def _json_default(o):
+    if isinstance(o, datetime.datetime):
+        return o.isoformat()
+    if isinstance(o, ObjectId):
+        return str(o)
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+def dumps(obj) -> bytes:
+    """Serialize to compact JSON - ObjectIds as strings, datetimes in ISO format
+    :param obj: object to serialize
+    :return: UTF-8 encoded JSON
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=_json_default)
+    return json.dumps(obj, default=_json_default, separators=(",", ":"), ensure_ascii=False).encode()
@@ -0,0 +1,191 @@
+"""
+ Standalone fetch worker
+
+ Runs FetchWorker in N processes independently of the API server. The first process also maintains
+ proxies (list updates and checking), compacts the cache and deletes finished tasks older than
+ TASK_RETENTION. SIGTERM/SIGINT drain in-flight tasks.
+
+ Usage: python worker.py --processes 4
+"""
+import argparse
+import asyncio
+import datetime
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+
+import prometheus_client
+
+import metrics
+from blob_store import BlobStore
+from consts import *
+from storage import open_storage
+
+
+async def maintain_proxies(proxy_manager):
+    """Update list of proxies periodically and check proxies continuously
+    :param proxy_manager: ProxyManager object
+    :return:
+    """
+    checker = asyncio.get_event_loop().create_task(proxy_manager.run())
+    try:
+        while True:
+            try:
+                await proxy_manager.fetch_from_github()  # upload local assets with proxy list
+                await proxy_manager.set()
+            except Exception as exc:
+                logging.exception(str(exc))
+            await asyncio.sleep(PROXY_UPDATE_INTERVAL)
+    finally:
+        checker.cancel()
+
+
+async def maintain_cache(blob_store: BlobStore):
+    """Keep cached bodies within disk budget
+    :param blob_store: BlobStore object
+    :return:
+    """
+    while True:
+        try:
+            await blob_store.compact()
+        except Exception as exc:
+            logging.exception(str(exc))
+        await asyncio.sleep(CACHE_COMPACT_INTERVAL)
+
+
+async def maintain_tasks(storage, retention: int = TASK_RETENTION):
+    """Delete finished tasks older than retention period
+    :param storage: Storage object
+    :param retention: seconds finished tasks are kept (0 - tasks are kept forever)
+    :return:
+    """
+    if retention <= 0:
+        return
+    while True:
+        try:
+            purged = await storage.purge_tasks(datetime.datetime.utcnow() - datetime.timedelta(seconds=retention))
+            if purged:
+                logging.info(f"Deleted {purged} finished tasks older than {retention} s")
+        except Exception as exc:
+            logging.exception(str(exc))
+        await asyncio.sleep(TASK_PURGE_INTERVAL)
+
+
+async def report_metrics(fetch_worker):
+    """Keep gauges of worker state current for Prometheus endpoint of the process
+    :param fetch_worker: FetchWorker object
+    :return:
+    """
+    while True:
+        metrics.update_worker(fetch_worker.stats())
+        await asyncio.sleep(WORKER_METRICS_INTERVAL)
+
+
+async def prepare_storage():
+    """Create tables and indexes once before worker processes start
+    :return:
+    """
+    storage = open_storage()
+    try:
+        await storage.prepare()
+    finally:
+        await storage.close()
+
+
+async def run_worker(max_workers: int, maintenance: bool, drain_timeout: float, metrics_port: int = None):
+    """Run fetch worker until SIGTERM/SIGINT
+    :param max_workers: max in-flight tasks
+    :param maintenance: maintain proxies, cache and task retention in this process
+    :param drain_timeout: seconds to finish in-flight tasks on shutdown
+    :param metrics_port: port of Prometheus metrics endpoint of this process (None - disabled)
+    :return:
+    """
+    from fetch_worker import FetchWorker
+    from proxy_manager import ProxyManager
+
+    loop = asyncio.get_event_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+
+    storage = open_storage()
+    fetch_worker = FetchWorker(storage, max_workers)
+    tasks = []
+    if metrics_port:
+        prometheus_client.start_http_server(metrics_port)
+        tasks.append(loop.create_task(report_metrics(fetch_worker)))
+    if maintenance:
+        proxy_manager = ProxyManager(storage, PROXY_FILE, extra_list_files=PROXY_EXTRA_FILES,
+                                     premium_list_file=PROXY_PREMIUM_FILE)
+        tasks += [loop.create_task(maintain_proxies(proxy_manager)),
+                  loop.create_task(maintain_cache(BlobStore(storage))),
+                  loop.create_task(maintain_tasks(storage))]
+    worker = loop.create_task(fetch_worker.run())
+    stopped = loop.create_task(stop.wait())
+    await asyncio.wait([worker, stopped], return_when=asyncio.FIRST_COMPLETED)
+
+    for task in tasks:
+        task.cancel()
+    try:
+        if worker.done():
+            stopped.cancel()
+            worker.result()  # worker failed, raise its error
+            return
+        await fetch_worker.stop(drain_timeout)
+        worker.cancel()  # worker may be still starting
+        await asyncio.gather(worker, return_exceptions=True)
+    finally:
+        await storage.close()
+
+
+def process_main(index: int, max_workers: int, maintenance: bool, drain_timeout: float, metrics_port: int = None):
+    log_format = f"%(asctime)s:%(levelname)s:worker-{index}:%(filename)s:%(message)s"
+    logging.basicConfig(
+        level=logging.INFO,
+        format=log_format,
+        handlers=[
+            logging.StreamHandler(),
+            logging.FileHandler("app.log")
+        ],
+        datefmt="%Y-%m-%dT%H:%M:%S%z"
+    )
+    asyncio.run(run_worker(max_workers, maintenance, drain_timeout, metrics_port))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Standalone fetch worker")
+    parser.add_argument("--processes", type=int, default=WORKER_PROCESSES, help="number of worker processes")
+    parser.add_argument("--max-workers", type=int, default=MAX_FETCH_WORKERS, help="max in-flight tasks per process")
+    parser.add_argument("--drain-timeout", type=float, default=WORKER_DRAIN_TIMEOUT,
+                        help="seconds to finish in-flight tasks on shutdown")
+    parser.add_argument("--no-maintenance", action="store_true",
+                        help="do not update and check proxies (run maintenance on another node)")
+    parser.add_argument("--metrics-port", type=int,
+                        help="first port of Prometheus metrics endpoints (one per process: port, port+1 ...)")
+    args = parser.parse_args()
+
+    asyncio.run(prepare_storage())
+    ctx = multiprocessing.get_context("spawn")
+    processes = [ctx.Process(target=process_main, name=f"worker-{i}",
+                             args=(i, args.max_workers, i == 0 and not args.no_maintenance, args.drain_timeout,
+                                   args.metrics_port + i if args.metrics_port else None))
+                 for i in range(args.processes)]
+    for process in processes:
+        process.start()
+
+    def forward(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for process in processes:
+        process.join()
+    return max(process.exitcode or 0 for process in processes)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import time
+
+import metrics
+from consts import *
+
+
+class WriteBack:
+    """
+    Buffer of single-record updates flushed as bulk writes of storage when the buffer is full
+    or flush interval passes - updates of the same record are coalesced into one operation
+    """
+
+    def __init__(self, storage, batch_size: int = WRITE_BACK_BATCH, interval: float = WRITE_BACK_INTERVAL):
+        """Init write-back buffer
+        :param storage: Storage object
+        :param batch_size: number of buffered updates which triggers flush
+        :param interval: max seconds update waits in the buffer
+        """
+        self._storage = storage
+        self._batch_size = batch_size
+        self._interval = interval
+        self._pending = {}  # operation -> {record key: [fields, futures]}
+        self._size = 0
+        self._full = None  # set when buffer is full, created in running loop
+        self._task = None
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def add(self, operation: str, key, fields: dict) -> asyncio.Future:
+        """Buffer update of single record
+        :param operation: bulk method of storage taking list of (key, fields) - "complete_tasks", "save_blobs"
+        :param key: key of the record
+        :param fields: updated fields
+        :return: future done when update is flushed, False if the operation failed
+        """
+        if self._task is None:
+            self._full = asyncio.Event()
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+        future = asyncio.get_event_loop().create_future()
+        pending = self._pending.setdefault(operation, {})
+        entry = pending.get(key)
+        if entry is None:
+            pending[key] = [dict(fields), [future]]
+            self._size += 1
+            if self._size >= self._batch_size:
+                self._full.set()
+            return future
+
+        entry[0].update(fields)  # later update of the same record wins
+        entry[1].append(future)
+        return future
+
+    async def flush(self):
+        """Write all buffered updates
+        :return: number of written operations
+        """
+        pending, self._pending, self._size = self._pending, {}, 0
+        written = 0
+        for operation, entries in pending.items():
+            ts1 = time.monotonic()
+            try:
+                results = await getattr(self._storage, operation)([(key, fields) for key, (fields, _) in entries.items()])
+            except Exception as exc:
+                # updates are lost, leased tasks return to the queue when their lease expires
+                logging.exception(str(exc))
+                results = [False] * len(entries)
+            metrics.WRITE_BACK.labels(operation).observe(time.monotonic() - ts1)
+
+            failed = results.count(False)
+            if failed:
+                logging.warning(f"Write-back {operation} : {failed} updates not written")
+            metrics.WRITE_BACK_OPS.labels(operation, "written").inc(len(results) - failed)
+            metrics.WRITE_BACK_OPS.labels(operation, "failed").inc(failed)
+            for ok, (_, futures) in zip(results, entries.values()):
+                for future in futures:
+                    if not future.done():
+                        future.set_result(ok)
+            written += len(results) - failed
+        return written
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self._interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            if self._size:
+                await self.flush()